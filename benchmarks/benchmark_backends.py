@@ -0,0 +1,74 @@
+"""
+Benchmark the latency of each backend of the CNN model
+
+The CNN model is run on one fake batch with each backend, 'eager', 'torchscript' and
+'onnxruntime' if it is installed, on the CPU. The first run includes the export,
+and this is reported separately from the time of each batch after that.
+
+Usage:
+    python benchmarks/benchmark_backends.py
+"""
+import logging
+import os
+import time
+
+import click
+import torch
+from nowcasting_dataloader.batch import BatchML
+from nowcasting_dataset.config.load import load_yaml_configuration
+
+import nowcasting_forecast
+from nowcasting_forecast.models.cnn.export import BACKENDS, is_backend_available, make_backend
+from nowcasting_forecast.models.cnn.model import Model
+
+logging.basicConfig(level=logging.WARNING)
+
+
+@click.command()
+@click.option(
+    "--repeats",
+    default=3,
+    help="The number of batches each backend is run on, after the first one",
+    type=click.INT,
+)
+def run(repeats: int):
+    """Time the forward pass of the CNN model with each backend"""
+    configuration_file = os.path.join(
+        os.path.dirname(nowcasting_forecast.__file__), "config", "mvp_v2.yaml"
+    )
+    configuration = load_yaml_configuration(filename=configuration_file)
+    tensors = Model.batch_to_tensors(BatchML.fake(configuration=configuration))
+
+    torch.manual_seed(0)
+    model = Model().eval()
+
+    for backend in BACKENDS:
+        if not is_backend_available(backend):
+            print(f"{backend:>12}: not installed")
+            continue
+
+        run_tensors = (
+            (lambda tensors: model.forward_tensors(*tensors))
+            if backend == "eager"
+            else make_backend(model=model, backend=backend).run_tensors
+        )
+
+        with torch.inference_mode():
+            # the first run includes the export
+            start_time = time.perf_counter()
+            run_tensors(tensors)
+            first_seconds = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                run_tensors(tensors)
+            seconds = (time.perf_counter() - start_time) / repeats
+
+        print(
+            f"{backend:>12}: first batch {first_seconds:.3f} seconds, "
+            f"then {seconds:.3f} seconds per batch of {tensors[0].shape[0]} examples"
+        )
+
+
+if __name__ == "__main__":
+    run()
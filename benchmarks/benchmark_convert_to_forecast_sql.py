@@ -0,0 +1,99 @@
+"""
+Benchmark converting results dataframes to ForecastSQL objects
+
+The results dataframe is made for all the gsps, with enough target times to give the number of
+rows asked for. The time per conversion is reported for each size.
+Nothing is saved to the database, but it is needed to get the locations and the model.
+
+Usage:
+    DB_URL=postgresql://... python benchmarks/benchmark_convert_to_forecast_sql.py
+"""
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+import numpy as np
+import pandas as pd
+from nowcasting_datamodel.connection import DatabaseConnection
+
+from nowcasting_forecast import N_GSP
+from nowcasting_forecast.models.utils import convert_to_forecast_sql, validate_results_df
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def make_results_df(n_rows: int) -> pd.DataFrame:
+    """Make a fake results dataframe, with about 'n_rows' rows, for all the gsps"""
+    gsp_ids = np.arange(0, N_GSP + 1)
+    n_target_times = int(np.ceil(n_rows / len(gsp_ids)))
+
+    t0_datetime_utc = datetime(2023, 1, 1, 12, tzinfo=timezone.utc)
+    target_datetimes_utc = [
+        t0_datetime_utc + timedelta(minutes=30 * i) for i in range(n_target_times)
+    ]
+
+    results_df = pd.DataFrame(
+        {
+            "t0_datetime_utc": t0_datetime_utc,
+            "target_datetime_utc": np.tile(target_datetimes_utc, len(gsp_ids)),
+            "forecast_gsp_pv_outturn_mw": np.random.uniform(-1, 100, n_target_times * len(gsp_ids)),
+            "gsp_id": np.repeat(gsp_ids, n_target_times),
+        }
+    )
+
+    return results_df.iloc[:n_rows]
+
+
+@click.command()
+@click.option(
+    "--db-url",
+    envvar="DB_URL",
+    help="The Database URL used to get the locations and the model",
+    type=click.STRING,
+)
+@click.option(
+    "--n-rows",
+    default=[1_000, 10_000, 100_000],
+    multiple=True,
+    help="The number of rows in the results dataframe, can be given several times",
+    type=click.INT,
+)
+@click.option(
+    "--repeats",
+    default=3,
+    help="The number of times each conversion is run, the fastest one is reported",
+    type=click.INT,
+)
+def run(db_url: str, n_rows, repeats: int):
+    """Time 'validate_results_df' and 'convert_to_forecast_sql' for different sized dataframes"""
+
+    connection = DatabaseConnection(url=db_url)
+    connection.create_all()
+
+    print(f"{'rows':>10} {'validate [s]':>14} {'convert [s]':>14} {'rows per second':>16}")
+    for n in n_rows:
+        results_df = make_results_df(n_rows=n)
+
+        validate_seconds, convert_seconds = [], []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            validate_results_df(results_df)
+            validate_seconds.append(time.perf_counter() - start_time)
+
+            with connection.get_session() as session:
+                start_time = time.perf_counter()
+                convert_to_forecast_sql(
+                    results_df=results_df, session=session, model_name="benchmark"
+                )
+                convert_seconds.append(time.perf_counter() - start_time)
+                session.rollback()
+
+        print(
+            f"{n:>10,d} {min(validate_seconds):>14.4f} {min(convert_seconds):>14.4f} "
+            f"{n / min(convert_seconds):>16,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    run()
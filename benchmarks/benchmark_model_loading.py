@@ -0,0 +1,112 @@
+"""
+Benchmark loading the CNN model, with and without the low memory path
+
+A CNN model with random weights is saved with 'save_pretrained' to a temporary directory,
+and then loaded with 'Model.from_pretrained', each way in a new process, so that the
+peak memory of each is measured on its own. The load time and the peak memory (resident set
+size), above the memory used after the imports, are printed for each. The peak memory includes
+reading every weight once, as memory-mapped weights are only read from disk when they are used.
+
+Usage:
+    python benchmarks/benchmark_model_loading.py run
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def reset_peak_rss_mb() -> float:
+    """
+    Reset the peak memory of this process to its current memory, and return it in MB
+
+    This only works on linux, elsewhere the peak memory so far is returned.
+    """
+    from nowcasting_forecast.profiling import get_peak_rss_mb
+
+    if not os.path.exists("/proc/self/clear_refs"):
+        return get_peak_rss_mb()
+
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return get_peak_rss_mb_linux()
+
+
+def get_peak_rss_mb_linux() -> float:
+    """Get the peak memory of this process since it was last reset, in MB"""
+    from nowcasting_forecast.profiling import get_peak_rss_mb
+
+    if not os.path.exists("/proc/self/status"):
+        return get_peak_rss_mb()
+
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return get_peak_rss_mb()
+
+
+@click.group()
+def cli():
+    """Benchmark loading the CNN model"""
+
+
+@cli.command()
+@click.option("--repeats", default=3, help="The number of times to load each way", type=click.INT)
+def run(repeats: int):
+    """Save a CNN model, and time loading it each way"""
+    from nowcasting_forecast.models.cnn.model import Model
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        Model().save_pretrained(tempdir)
+
+        for low_memory in [False, True]:
+            results = []
+            for _ in range(repeats):
+                output = subprocess.run(
+                    [sys.executable, __file__, "load", tempdir]
+                    + (["--low-memory"] if low_memory else ["--no-low-memory"]),
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+                results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+            name = "low memory" if low_memory else "random initialisation"
+            print(
+                f"{name:>21}: "
+                f"{min(r['seconds'] for r in results):.2f} seconds, "
+                f"peak memory +{min(r['peak_rss_mb'] for r in results):.0f} MB"
+            )
+
+
+@cli.command()
+@click.argument("path", type=click.Path(exists=True))
+@click.option("--low-memory/--no-low-memory", default=True, help="Use the low memory path")
+def load(path: str, low_memory: bool):
+    """Load the model once, and print the time and peak memory as json"""
+    import torch
+
+    from nowcasting_forecast.models.cnn.model import Model
+
+    start_rss_mb = reset_peak_rss_mb()
+    start_time = time.perf_counter()
+    model = Model.from_pretrained(path, low_memory=low_memory)
+    seconds = time.perf_counter() - start_time
+
+    # read every weight, so the memory-mapped weights are counted too
+    with torch.no_grad():
+        _ = sum(float(parameter.sum()) for parameter in model.parameters())
+
+    print(json.dumps(dict(seconds=seconds, peak_rss_mb=get_peak_rss_mb_linux() - start_rss_mb)))
+
+
+if __name__ == "__main__":
+    cli()
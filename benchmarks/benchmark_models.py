@@ -0,0 +1,442 @@
+"""
+Benchmark each model, from running the batches to the national forecast, for all the gsps
+
+Fake batches, with the shapes from each model's configuration, are made with 'Batch.fake',
+like in the tests. They are then run through 'general_forecast_run_all_batches', which runs the
+model on each batch, converts the results to ForecastSQL, filters them on the sun elevation and
+adds the national forecast. The time of each of these stages is saved as json.
+
+The models are the ones registered for the app, see 'nowcasting_forecast.models.registry',
+and the pytorch models are optimized in the same way as when the app loads them,
+see 'prepare_ml_model'. They use random weights, so nothing is downloaded.
+By default an in-memory sqlite database is used, so no database is needed either,
+but the gsp metadata snapshot has to exist (see GSP_METADATA_CACHE_FILE) to run offline.
+
+Usage:
+    python benchmarks/benchmark_models.py run --output before.json
+    python benchmarks/benchmark_models.py run --output after.json
+    python benchmarks/benchmark_models.py compare before.json after.json
+
+The speed up from running the batches in several processes can be measured with
+    python benchmarks/benchmark_models.py scaling --n-workers 1 --n-workers 2 --n-workers 4
+"""
+import copy
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import click
+import torch
+from nowcasting_datamodel.connection import DatabaseConnection
+from nowcasting_datamodel.fake import make_fake_input_data_last_updated
+from nowcasting_datamodel.models import InputDataLastUpdatedSQL, LocationSQL, MLModelSQL
+from nowcasting_datamodel.models.base import Base_Forecast
+from nowcasting_datamodel.read.read import get_latest_input_data_last_updated, get_model
+from nowcasting_dataset.config.load import load_yaml_configuration
+from nowcasting_dataset.dataset.batch import Batch
+
+import nowcasting_forecast
+from nowcasting_forecast import N_GSP
+from nowcasting_forecast.capacity import get_capacity_store
+from nowcasting_forecast.gsp_metadata import get_gsp_metadata
+from nowcasting_forecast.models.registry import MODELS, get_registered_model
+from nowcasting_forecast.models.utils import (
+    general_forecast_run_all_batches,
+    get_locations,
+    prepare_ml_model,
+)
+from nowcasting_forecast.profiling import profile_run
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger("nowcasting_forecast").setLevel(logging.WARNING)
+
+# the models that can be benchmarked, these are the models registered for the app
+MODEL_NAMES = list(MODELS.keys())
+
+# the stages that are timed, these are the names used in 'general_forecast_run_all_batches'
+# 'run_batch' is in the worker processes, when there are several, so 'wait_for_batches' is used
+STAGES = [
+    "get_batch",
+    "run_batch",
+    "wait_for_batches",
+    "convert_to_forecast_sql",
+    "sun_filter",
+    "national_forecast",
+]
+
+
+def get_git_commit() -> Optional[str]:
+    """Get the current git commit, if we are in a git repository"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def get_configuration_file(filename: Optional[str]) -> Optional[str]:
+    """Get the path of a configuration file of the registry, so this can be run from anywhere"""
+    if filename is None:
+        return None
+    return os.path.join(
+        os.path.dirname(nowcasting_forecast.__file__), "config", os.path.basename(filename)
+    )
+
+
+def make_fake_batches(model_name: str, n_gsps: int) -> List[Batch]:
+    """
+    Make fake batches for all the gsps, with the shapes from the model's configuration
+
+    One fake batch is made, and then copied for each batch, with the gsp ids changed.
+    """
+    configuration_file = get_configuration_file(get_registered_model(model_name).configuration_file)
+    configuration = load_yaml_configuration(filename=configuration_file)
+
+    # the fake batch needs all the data sources, so add defaults for any that are not used.
+    # Optical flow is optional, and is left out, as the default fake data is about 1 GB a batch
+    defaults = configuration.input_data.set_all_to_defaults()
+    for data_source_name in defaults.__fields__:
+        if (getattr(configuration.input_data, data_source_name) is None) and (
+            data_source_name != "opticalflow"
+        ):
+            setattr(configuration.input_data, data_source_name, getattr(defaults, data_source_name))
+
+    batch_size = configuration.process.batch_size
+    n_batches = math.ceil(n_gsps / batch_size)
+    fake_batch = Batch.fake(configuration=configuration, temporally_align_examples=True)
+
+    batches = []
+    for batch_idx in range(n_batches):
+        batch = copy.deepcopy(fake_batch)
+        for i, location in enumerate(batch.metadata.space_time_locations):
+            # wrap around, so the last batch is full, like the live batches are
+            location.id = (batch_idx * batch_size + i) % n_gsps + 1
+        batches.append(batch)
+
+    return batches
+
+
+def setup_database(connection: DatabaseConnection, model_name: str, n_gsps: int):
+    """
+    Add the locations, model and input data last updated to the database
+
+    This is done before the benchmark, so that nothing needs to be committed while it runs.
+    Only the tables that are needed are made, as the forecast value tables do not work in sqlite.
+    """
+    tables = [LocationSQL.__table__, MLModelSQL.__table__, InputDataLastUpdatedSQL.__table__]
+    Base_Forecast.metadata.create_all(connection.engine, tables=tables)
+
+    capacity_store = get_capacity_store()
+    with connection.get_session() as session:
+        locations = get_locations(session=session, gsp_ids=range(0, n_gsps + 1))
+        for gsp_id, location in locations.items():
+            if gsp_id == 0:
+                capacity = capacity_store.get_capacity(gsp_ids=range(1, n_gsps + 1)).sum()
+            else:
+                capacity = capacity_store.get_capacity(gsp_ids=[gsp_id])[0]
+            location.installed_capacity_mw = float(capacity)
+
+        _ = get_model(name=model_name, version=nowcasting_forecast.__version__, session=session)
+        if get_latest_input_data_last_updated(session=session) is None:
+            session.add(make_fake_input_data_last_updated())
+        session.commit()
+
+
+def benchmark_model(
+    connection: DatabaseConnection,
+    model_name: str,
+    n_gsps: int,
+    repeats: int,
+    n_workers: int = 1,
+    inference_batch_size: Optional[int] = None,
+) -> dict:
+    """
+    Time each stage of one model, the fastest time of each stage is returned
+
+    With 'n_workers' more than 1, the time to start the workers is included in the total.
+
+    Returns: dictionary of the seconds of each stage, and the total
+    """
+    batches = make_fake_batches(model_name=model_name, n_gsps=n_gsps)
+
+    # the model with random weights, made ready in the same way as when the app loads it
+    registered_model = get_registered_model(model_name)
+    pytorch_model = None
+    if registered_model.ml_model is not None:
+        pytorch_model = prepare_ml_model(model=registered_model.ml_model())
+
+    # time the whole model each repeat, like the first forecast after new NWP data
+    if hasattr(pytorch_model, "nwp_embedding_cache"):
+        pytorch_model.nwp_embedding_cache = None
+
+    setup_database(connection=connection, model_name=model_name, n_gsps=n_gsps)
+
+    seconds = {stage_name: [] for stage_name in STAGES + ["total"]}
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as temporary_dir, connection.get_session() as session:
+            # the batches are in memory, like the app's batches
+            if registered_model.make_dataloader is not None:
+                dataloader = registered_model.make_dataloader(
+                    temporary_dir=temporary_dir,
+                    batch_save_dir=None,
+                    batches=batches,
+                    configuration_file=None,
+                )
+            else:
+                dataloader = iter(batches)
+
+            # nothing is saved, so don't flush the forecasts when the database is queried
+            with profile_run(
+                report_filename=os.path.join(temporary_dir, "report.json")
+            ) as report, session.no_autoflush:
+                start_time = time.perf_counter()
+                general_forecast_run_all_batches(
+                    session=session,
+                    callable_function_for_on_batch=registered_model.callable_function_for_on_batch,
+                    pytorch_model=pytorch_model,
+                    model_name=model_name,
+                    configuration_file=get_configuration_file(
+                        registered_model.run_configuration_file
+                    ),
+                    n_gsps=n_gsps,
+                    dataloader=dataloader,
+                    n_workers=n_workers,
+                    inference_batch_size=inference_batch_size,
+                )
+                seconds["total"].append(time.perf_counter() - start_time)
+            session.rollback()
+
+        for stage_name in STAGES:
+            if stage_name in report.stages:
+                seconds[stage_name].append(report.stages[stage_name]["wall_seconds"])
+
+    return {stage_name: min(values) for stage_name, values in seconds.items() if len(values) > 0}
+
+
+@click.group()
+def cli():
+    """Benchmark the models"""
+
+
+@cli.command()
+@click.option(
+    "--db-url",
+    default="sqlite://",
+    envvar="DB_URL",
+    help="The Database URL used to get the locations and the model, defaults to in-memory sqlite",
+    type=click.STRING,
+)
+@click.option(
+    "--model-name",
+    "model_names",
+    default=MODEL_NAMES,
+    multiple=True,
+    help="The model to benchmark, can be given several times. Default is all the models",
+    type=click.Choice(MODEL_NAMES),
+)
+@click.option("--n-gsps", default=N_GSP, help="The number of gsps", type=click.INT)
+@click.option(
+    "--repeats",
+    default=3,
+    help="The number of times each model is run, the fastest time of each stage is saved",
+    type=click.INT,
+)
+@click.option(
+    "--n-workers", default=1, help="The number of processes to run the batches in", type=click.INT
+)
+@click.option(
+    "--inference-batch-size",
+    default=None,
+    help="The number of examples the model runs on at once, defaults to the data batch size",
+    type=click.INT,
+)
+@click.option(
+    "--output", default="benchmark_models.json", help="The json file to save the results to"
+)
+def run(
+    db_url: str,
+    model_names,
+    n_gsps: int,
+    repeats: int,
+    n_workers: int,
+    inference_batch_size: Optional[int],
+    output: str,
+):
+    """Time each stage of each model, and save the results as json"""
+
+    # load the gsp metadata first, so it is not part of the timing
+    _ = get_gsp_metadata()
+
+    connection = DatabaseConnection(url=db_url)
+
+    results = {}
+    for model_name in model_names:
+        print(f"Benchmarking {model_name}")
+        results[model_name] = benchmark_model(
+            connection=connection,
+            model_name=model_name,
+            n_gsps=n_gsps,
+            repeats=repeats,
+            n_workers=n_workers,
+            inference_batch_size=inference_batch_size,
+        )
+        for stage_name, seconds in results[model_name].items():
+            print(f"    {stage_name:<25} {seconds:>10.4f} seconds")
+
+    benchmark = dict(
+        created_utc=datetime.now(timezone.utc).isoformat(),
+        git_commit=get_git_commit(),
+        version=nowcasting_forecast.__version__,
+        python=platform.python_version(),
+        torch=torch.__version__,
+        n_threads=torch.get_num_threads(),
+        n_workers=n_workers,
+        inference_batch_size=inference_batch_size,
+        n_gsps=n_gsps,
+        repeats=repeats,
+        results=results,
+    )
+
+    with open(output, "w") as file:
+        json.dump(benchmark, file, indent=4)
+    print(f"Saved results to {output}")
+
+
+@cli.command()
+@click.option(
+    "--db-url",
+    default="sqlite://",
+    envvar="DB_URL",
+    help="The Database URL used to get the locations and the model, defaults to in-memory sqlite",
+    type=click.STRING,
+)
+@click.option(
+    "--model-name",
+    default="cnn",
+    help="The model to benchmark",
+    type=click.Choice(MODEL_NAMES),
+)
+@click.option("--n-gsps", default=N_GSP, help="The number of gsps", type=click.INT)
+@click.option(
+    "--repeats",
+    default=3,
+    help="The number of times the model is run, for each number of workers",
+    type=click.INT,
+)
+@click.option(
+    "--n-workers",
+    "n_workers_list",
+    default=[1, 2, 4, 8],
+    multiple=True,
+    help="The number of processes to try, can be given several times. Default is 1, 2, 4 and 8",
+    type=click.INT,
+)
+@click.option(
+    "--output", default="benchmark_scaling.json", help="The json file to save the results to"
+)
+def scaling(db_url: str, model_name: str, n_gsps: int, repeats: int, n_workers_list, output: str):
+    """Time one model with different numbers of worker processes, and save the results as json"""
+
+    _ = get_gsp_metadata()
+
+    connection = DatabaseConnection(url=db_url)
+
+    results = {}
+    print(f"{'workers':>8} {'total [s]':>10} {'speed up':>9}")
+    for n_workers in n_workers_list:
+        results[n_workers] = benchmark_model(
+            connection=connection,
+            model_name=model_name,
+            n_gsps=n_gsps,
+            repeats=repeats,
+            n_workers=n_workers,
+        )
+        speed_up = results[n_workers_list[0]]["total"] / results[n_workers]["total"]
+        print(f"{n_workers:>8} {results[n_workers]['total']:>10.4f} {speed_up:>8.2f}x")
+
+    benchmark = dict(
+        created_utc=datetime.now(timezone.utc).isoformat(),
+        git_commit=get_git_commit(),
+        version=nowcasting_forecast.__version__,
+        python=platform.python_version(),
+        torch=torch.__version__,
+        cpu_count=os.cpu_count(),
+        model_name=model_name,
+        n_gsps=n_gsps,
+        repeats=repeats,
+        results=results,
+    )
+
+    with open(output, "w") as file:
+        json.dump(benchmark, file, indent=4)
+    print(f"Saved results to {output}")
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True))
+@click.argument("candidate", type=click.Path(exists=True))
+@click.option(
+    "--threshold",
+    default=0.1,
+    help="The fraction slower the candidate can be before it is a regression, e.g. 0.1 is 10%",
+    type=click.FLOAT,
+)
+@click.option(
+    "--min-seconds",
+    default=0.01,
+    help="Stages faster than this, in both results, are not flagged, as they are mostly noise",
+    type=click.FLOAT,
+)
+def compare(baseline: str, candidate: str, threshold: float, min_seconds: float):
+    """
+    Compare two benchmark results, and flag any regressions
+
+    The exit code is 1 if there are any regressions, so this can be used in CI.
+    """
+    with open(baseline) as file:
+        baseline_benchmark = json.load(file)
+    with open(candidate) as file:
+        candidate_benchmark = json.load(file)
+
+    print(f"Baseline:  {baseline_benchmark['git_commit']} ({baseline_benchmark['created_utc']})")
+    print(f"Candidate: {candidate_benchmark['git_commit']} ({candidate_benchmark['created_utc']})")
+    print(f"{'model':<20} {'stage':<25} {'baseline [s]':>12} {'candidate [s]':>14} {'change':>8}")
+
+    regressions = []
+    for model_name, baseline_results in baseline_benchmark["results"].items():
+        candidate_results = candidate_benchmark["results"].get(model_name, {})
+        for stage_name, baseline_seconds in baseline_results.items():
+            if stage_name not in candidate_results:
+                continue
+            candidate_seconds = candidate_results[stage_name]
+
+            change = (candidate_seconds - baseline_seconds) / max(baseline_seconds, 1e-9)
+            is_regression = (change > threshold) and (
+                max(baseline_seconds, candidate_seconds) >= min_seconds
+            )
+            if is_regression:
+                regressions.append((model_name, stage_name))
+
+            print(
+                f"{model_name:<20} {stage_name:<25} {baseline_seconds:>12.4f} "
+                f"{candidate_seconds:>14.4f} {change:>+8.1%}"
+                f"{'  REGRESSION' if is_regression else ''}"
+            )
+
+    if len(regressions) > 0:
+        print(f"{len(regressions)} regressions of more than {threshold:.0%}")
+        raise SystemExit(1)
+
+    print(f"No regressions of more than {threshold:.0%}")
+
+
+if __name__ == "__main__":
+    cli()
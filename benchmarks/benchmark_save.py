@@ -0,0 +1,73 @@
+"""
+Benchmark saving forecasts to the database
+
+Fake forecasts are made for all the gsps, and saved with the bulk inserts and with the ORM.
+The rows per second are reported for each, where the rows are the forecast values.
+
+Usage:
+    DB_URL=postgresql://... python benchmarks/benchmark_save.py
+"""
+import logging
+import time
+from datetime import datetime, timezone
+
+import click
+from nowcasting_datamodel.connection import DatabaseConnection
+from nowcasting_datamodel.fake import make_fake_forecasts
+
+from nowcasting_forecast import N_GSP
+from nowcasting_forecast.save import DEFAULT_CHUNK_SIZE, save_forecasts
+from nowcasting_forecast.utils import floor_minutes_dt
+
+logging.basicConfig(level=logging.WARNING)
+
+
+@click.command()
+@click.option(
+    "--db-url",
+    envvar="DB_URL",
+    help="The Database URL to save the forecasts to. Please do not use a production database",
+    type=click.STRING,
+)
+@click.option("--n-gsps", default=N_GSP, help="The number of gsps", type=click.INT)
+@click.option(
+    "--chunk-size",
+    default=DEFAULT_CHUNK_SIZE,
+    help="The number of rows in each bulk insert",
+    type=click.INT,
+)
+def run(db_url: str, n_gsps: int, chunk_size: int):
+    """Time 'save_forecasts' with and without bulk inserts"""
+
+    connection = DatabaseConnection(url=db_url)
+    connection.create_all()
+
+    t0_datetime_utc = floor_minutes_dt(datetime.now(timezone.utc))
+
+    for bulk in [True, False]:
+        with connection.get_session() as session:
+            forecasts = make_fake_forecasts(
+                gsp_ids=list(range(1, n_gsps + 1)),
+                session=session,
+                t0_datetime_utc=t0_datetime_utc,
+            )
+            n_rows = sum(len(forecast.forecast_values) for forecast in forecasts)
+
+            start_time = time.perf_counter()
+            save_forecasts(
+                forecasts=forecasts,
+                session=session,
+                apply_adjuster=False,
+                bulk=bulk,
+                chunk_size=chunk_size,
+            )
+            seconds = time.perf_counter() - start_time
+
+        print(
+            f"{'bulk' if bulk else 'orm':>5}: saved {n_rows:,d} forecast values in "
+            f"{seconds:.2f} seconds, {n_rows / seconds:,.0f} rows per second"
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,71 @@
+"""
+Benchmark filtering forecasts on the sun elevation
+
+Forecasts are made for all the gsps, for several forecast horizons,
+and the time to filter them on the sun elevation is reported. No database is needed.
+
+Usage:
+    python benchmarks/benchmark_sun_filter.py
+"""
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+from nowcasting_datamodel.models import ForecastSQL, ForecastValueSQL, LocationSQL
+
+from nowcasting_forecast import N_GSP
+from nowcasting_forecast.gsp_metadata import get_gsp_metadata
+from nowcasting_forecast.models.sun import filter_forecasts_on_sun_elevation
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def make_forecasts(n_gsps: int, n_horizons: int):
+    """Make forecasts for 'n_gsps' gsps, each with 'n_horizons' half hourly values"""
+    t0_datetime_utc = datetime(2023, 1, 1, 6, tzinfo=timezone.utc)
+
+    forecasts = []
+    for gsp_id in range(1, n_gsps + 1):
+        forecast_values = [
+            ForecastValueSQL(
+                target_time=t0_datetime_utc + timedelta(minutes=30 * i),
+                expected_power_generation_megawatts=1.0,
+            )
+            for i in range(n_horizons)
+        ]
+        forecasts.append(
+            ForecastSQL(location=LocationSQL(gsp_id=gsp_id), forecast_values=forecast_values)
+        )
+
+    return forecasts
+
+
+@click.command()
+@click.option("--n-gsps", default=N_GSP, help="The number of gsps", type=click.INT)
+@click.option("--n-horizons", default=16, help="The number of forecast horizons", type=click.INT)
+@click.option(
+    "--repeats",
+    default=3,
+    help="The number of times the filter is run, the fastest one is reported",
+    type=click.INT,
+)
+def run(n_gsps: int, n_horizons: int, repeats: int):
+    """Time 'filter_forecasts_on_sun_elevation'"""
+
+    # load the gsp metadata first, so it is not part of the timing
+    _ = get_gsp_metadata()
+
+    seconds = []
+    for _ in range(repeats):
+        forecasts = make_forecasts(n_gsps=n_gsps, n_horizons=n_horizons)
+
+        start_time = time.perf_counter()
+        filter_forecasts_on_sun_elevation(forecasts=forecasts)
+        seconds.append(time.perf_counter() - start_time)
+
+    print(f"Filtered {n_gsps} gsps x {n_horizons} horizons in {min(seconds):.4f} seconds")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,151 @@
+"""
+Benchmark the bytes copied moving one batch from xarray to torch
+
+One fake batch is made for each pytorch model, like in 'benchmark_models.py', and its inputs are
+moved to torch the way the model runs them: 'BatchML.from_batch' for the CNN model,
+and the view of the NWP data for the NWP simple trained model, which used to be copied into an
+input buffer. The NWP simple model works on the xarray data, so it is not included.
+
+This is done with the previous 'torch' accessor, which copied each variable, and with
+'nowcasting_forecast.models.xr_utils', which shares memory with the batch where it can.
+For each, the bytes of the tensors that do not share memory with the batch are printed,
+and the peak memory of numpy temporaries, e.g. 'astype' of the time variables.
+
+The live data sources make float32 data, but the fake batches are float64,
+so the float data is changed to float32 first.
+
+Usage:
+    python benchmarks/benchmark_xr_to_torch.py
+"""
+import logging
+import time
+import tracemalloc
+from typing import Dict, List
+
+import click
+import numpy as np
+import torch
+import xarray as xr
+from benchmark_models import make_fake_batches
+from nowcasting_dataloader.batch import BatchML
+from nowcasting_dataset.dataset.batch import Batch
+
+from nowcasting_forecast.models import xr_utils
+from nowcasting_forecast.models.inference import InferenceRunner
+
+logging.basicConfig(level=logging.WARNING)
+
+MODEL_NAMES = ["nwp_simple_trained", "cnn"]
+
+
+class CopyingTorchAccessor:
+    """The previous 'torch' accessor of a Dataset, which copies each variable"""
+
+    def __init__(self, xdataset_obj: xr.Dataset):
+        """Accessor of the Dataset"""
+        self._obj = xdataset_obj
+
+    def to_tensor(self, data_vars: List[str]) -> dict:
+        """Convert this Dataset to dictionary of torch tensors"""
+        torch_dict = {}
+        for data_var in data_vars:
+            v = getattr(self._obj, data_var)
+            if data_var.find("time") != -1:
+                time_int = v.data.astype(int)
+                torch_dict[data_var] = torch.tensor(time_int, dtype=torch.float64)
+            else:
+                torch_dict[data_var] = torch.tensor(v.data, dtype=torch.float32)
+        return torch_dict
+
+
+def use_accessor(accessor):
+    """Use this 'torch' accessor for all Datasets"""
+    if hasattr(xr.Dataset, "torch"):
+        del xr.Dataset.torch
+    xr.register_dataset_accessor("torch")(accessor)
+
+
+def make_float32_batch(model_name: str) -> Batch:
+    """Make a fake batch for the model, with float32 data, like the live data sources"""
+    batch = make_fake_batches(model_name=model_name, n_gsps=1)[0]
+    for data_source in batch.data_sources:
+        if data_source is None:
+            continue
+        for name, variable in data_source.data_vars.items():
+            if variable.dtype == np.float64:
+                data_source[name] = variable.astype(np.float32)
+    return batch
+
+
+def get_tensors(model_name: str, batch: Batch, copy: bool) -> List[torch.Tensor]:
+    """Move the inputs of the model to torch, with the previous or the zero copy path"""
+    if model_name == "cnn":
+        batch_ml = BatchML.from_batch(batch=batch)
+        return [
+            value
+            for data_source in batch_ml.data_sources
+            if data_source is not None
+            for value in data_source.__dict__.values()
+            if isinstance(value, torch.Tensor)
+        ]
+
+    if copy:
+        runner = InferenceRunner(model=torch.nn.Identity())
+        nwp = xr_utils.re_order_dims(batch.nwp)
+        return [runner.input_tensor(name="nwp", data=nwp.data.values)]
+    return [xr_utils.to_tensor(batch.nwp.data, dims=xr_utils.NWP_DIMS)]
+
+
+def measure(model_name: str, copy: bool) -> Dict[str, float]:
+    """Measure the bytes copied, and the time, of moving one batch to torch"""
+    batch = make_float32_batch(model_name)
+    arrays = [
+        variable.data
+        for data_source in batch.data_sources
+        if data_source is not None
+        for variable in data_source.data_vars.values()
+    ]
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    tensors = get_tensors(model_name=model_name, batch=batch, copy=copy)
+    seconds = time.perf_counter() - start_time
+    _, peak_temporary_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    copied_bytes = sum(
+        tensor.element_size() * tensor.nelement()
+        for tensor in tensors
+        if not any(np.shares_memory(tensor.numpy(), array) for array in arrays)
+    )
+    total_bytes = sum(tensor.element_size() * tensor.nelement() for tensor in tensors)
+
+    return dict(
+        copied_mb=copied_bytes / 1024**2,
+        total_mb=total_bytes / 1024**2,
+        peak_temporary_mb=peak_temporary_bytes / 1024**2,
+        seconds=seconds,
+    )
+
+
+@click.command()
+def run():
+    """Print the bytes copied per batch, before and after"""
+    for model_name in MODEL_NAMES:
+        for copy, accessor in [
+            (True, CopyingTorchAccessor),
+            (False, xr_utils.DatasetTorchAccessor),
+        ]:
+            use_accessor(accessor)
+            results = measure(model_name=model_name, copy=copy)
+            print(
+                f"{model_name:20s} {'previous' if copy else 'zero copy':10s}: "
+                f"copied {results['copied_mb']:.2f} of {results['total_mb']:.2f} MB, "
+                f"numpy temporaries {results['peak_temporary_mb']:.2f} MB, "
+                f"{results['seconds']:.4f} seconds"
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -1,28 +1,44 @@
 """ Main Application """
 import logging
 import os
+import signal
 import tempfile
-from datetime import datetime
-from typing import Optional
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
 
 import click
 from nowcasting_datamodel.connection import DatabaseConnection
 from nowcasting_datamodel.fake import make_fake_forecasts, make_fake_national_forecast
-from nowcasting_datamodel.save.save import save
+from nowcasting_datamodel.models import ForecastSQL
+from nowcasting_dataset.config.save import save_yaml_configuration
+from nowcasting_dataset.dataset.batch import Batch
 from sqlalchemy.orm import Session
 
 from nowcasting_forecast import N_GSP, __version__
-from nowcasting_forecast.batch import make_batches
-from nowcasting_forecast.models.cnn.cnn import cnn_run_one_batch
-from nowcasting_forecast.models.cnn.dataloader import get_cnn_data_loader
-from nowcasting_forecast.models.cnn.model import Model as CNN_Model
-from nowcasting_forecast.models.nwp_simple_trained.model import Model
-from nowcasting_forecast.models.nwp_simple_trained.nwp_simple_trained import (
-    nwp_irradiance_simple_trained_run_one_batch,
-)
-from nowcasting_forecast.models.nwp_solar_simple import nwp_irradiance_simple_run_one_batch
+from nowcasting_forecast.batch import BatchProducer, make_batches
+from nowcasting_forecast.models.cnn.export import BACKENDS, is_backend_available
+from nowcasting_forecast.models.ensemble import (
+    BLEND_MODEL_NAME,
+    blend_forecasts,
+    iterate_model_inputs,
+    make_union_configuration,
+    make_union_input_slices,
+    parse_blend_weights,
+    parse_model_names,
+)
+from nowcasting_forecast.models.parallel import shutdown_worker_pool
+from nowcasting_forecast.models.quantization import DEFAULT_TOLERANCE_MW
+from nowcasting_forecast.models.registry import (
+    RegisteredModel,
+    get_input_slices,
+    get_registered_model,
+)
 from nowcasting_forecast.models.utils import general_forecast_run_all_batches
-from nowcasting_forecast.utils import floor_minutes_dt
+from nowcasting_forecast.profiling import profile_run, stage
+from nowcasting_forecast.save import DEFAULT_CHUNK_SIZE, save_forecasts
+from nowcasting_forecast.utils import count_database_queries, floor_minutes_dt
 
 logging.basicConfig(
     level=getattr(logging, os.getenv("LOGLEVEL", "DEBUG")),
@@ -65,7 +81,14 @@ logging.getLogger("nowcasting_datamodel").setLevel(
     "--model-name",
     default="cnn",
     envvar="MODEL_NAME",
-    help="Select which model to use",
+    help="Select which model to use, or a comma separated list of models to run together",
+    type=click.STRING,
+)
+@click.option(
+    "--blend-weights",
+    default=None,
+    envvar="BLEND_WEIGHTS",
+    help="Optional weight of each model, e.g. 'cnn:0.7,nwp_simple_trained:0.3', to save a blend",
     type=click.STRING,
 )
 @click.option(
@@ -96,95 +119,524 @@ logging.getLogger("nowcasting_datamodel").setLevel(
     help="Update the GSPS forecast in the latest table",
     type=click.BOOL,
 )
+@click.option(
+    "--streaming",
+    default=False,
+    envvar="STREAMING",
+    help="Make batches in the background, and pass each one to the model as soon as it is ready",
+    type=click.BOOL,
+)
+@click.option(
+    "--bulk-save",
+    default=False,
+    envvar="BULK_SAVE",
+    help="Save forecasts with bulk inserts. By default forecasts are saved one by one with the ORM",
+    type=click.BOOL,
+)
+@click.option(
+    "--save-chunk-size",
+    default=DEFAULT_CHUNK_SIZE,
+    envvar="SAVE_CHUNK_SIZE",
+    help="The number of rows in each insert, when using '--bulk-save'",
+    type=click.INT,
+)
+@click.option(
+    "--serve",
+    default=False,
+    envvar="SERVE",
+    help="Keep running and make forecasts on a regular cadence, rather than just once",
+    type=click.BOOL,
+)
+@click.option(
+    "--cadence-minutes",
+    default=30,
+    envvar="CADENCE_MINUTES",
+    help="How often to make forecasts, in minutes, when using '--serve'",
+    type=click.INT,
+)
+@click.option(
+    "--backend",
+    default="eager",
+    envvar="BACKEND",
+    help="How to run the CNN model, the model is exported on the first batch if not eager",
+    type=click.Choice(BACKENDS),
+)
+@click.option(
+    "--quantize",
+    default=False,
+    envvar="QUANTIZE",
+    help="Quantize the Linear layers of the pytorch models to int8, with the eager backend",
+    type=click.BOOL,
+)
+@click.option(
+    "--quantize-tolerance-mw",
+    default=DEFAULT_TOLERANCE_MW,
+    envvar="QUANTIZE_TOLERANCE_MW",
+    help="The quantized model is only used if it is this close, in MW, to the float model",
+    type=click.FLOAT,
+)
+@click.option(
+    "--n-workers",
+    default=1,
+    envvar="N_WORKERS",
+    help="The number of processes to run the batches in, each with its own copy of the model",
+    type=click.INT,
+)
+@click.option(
+    "--inference-batch-size",
+    default=None,
+    envvar="INFERENCE_BATCH_SIZE",
+    help="The number of examples the model runs on at once, defaults to the data batch size",
+    type=click.INT,
+)
+@click.option(
+    "--profile-report",
+    default=None,
+    envvar="PROFILE_REPORT",
+    help="Optional file to save the time and memory of each stage of the run to, as json",
+    type=click.STRING,
+)
+@click.option(
+    "--cprofile",
+    default=False,
+    envvar="CPROFILE",
+    help="Also save a cProfile of the run to '<profile-report>.prof'",
+    type=click.BOOL,
+)
 def run(
     db_url: str,
     fake: bool = False,
     model_name: str = "nwp_simple",
+    blend_weights: Optional[str] = None,
     batch_save_dir: Optional[str] = None,
     n_gsps: Optional[int] = N_GSP,
     update_national: Optional[bool] = True,
     update_gsps: Optional[bool] = True,
+    streaming: Optional[bool] = False,
+    bulk_save: Optional[bool] = False,
+    save_chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+    serve: Optional[bool] = False,
+    cadence_minutes: Optional[int] = 30,
+    backend: Optional[str] = "eager",
+    quantize: Optional[bool] = False,
+    quantize_tolerance_mw: Optional[float] = DEFAULT_TOLERANCE_MW,
+    n_workers: Optional[int] = 1,
+    inference_batch_size: Optional[int] = None,
+    profile_report: Optional[str] = None,
+    cprofile: Optional[bool] = False,
 ):
     """
     Run main app.
 
-    There is an option to make fake forecasts
+    There is an option to make fake forecasts.
+    There is also an option to stream batches, so that making batches and running the model
+    overlap, rather than making all the batches first.
+
+    'model_name' can be a comma separated list of models, e.g. 'cnn,nwp_simple_trained'.
+    Then the batches are made once, with the inputs of all the models, and each model's
+    forecasts are saved under its own name. With 'blend_weights', a weighted blend of the
+    models is saved too, as 'blend'.
+
+    Batches are kept in memory, unless 'batch_save_dir' is set,
+    then they are saved to disk first, which is useful for debugging.
+
+    With 'serve', the app keeps running and makes a forecast every 'cadence_minutes'.
+
+    With 'n_workers' more than 1, the batches are run in that many processes,
+    and the CPU cores are shared between them.
+
+    The model runs on 'inference_batch_size' examples at once, e.g. 317 runs all the gsps
+    in one forward pass. This does not change the batches of data that are made.
+
+    With 'profile_report', the time and memory of each stage of the run is saved as json.
+    When serving, the report is overwritten by each forecast.
     """
 
     logger.info(f"Running forecast app ({__version__})")
 
+    if not is_backend_available(backend):
+        raise click.BadParameter(
+            f"The {backend} backend needs onnxruntime, install it with 'pip install .[onnx]'",
+            param_hint="'--backend'",
+        )
+    if quantize and (backend != "eager"):
+        # the exported models have no Linear layers to quantize
+        raise click.BadParameter(
+            f"The {backend} backend can not be quantized, use the eager backend",
+            param_hint="'--quantize'",
+        )
+
     connection = DatabaseConnection(url=db_url)
-    with connection.get_session() as session:
-        if fake:
-            forecasts = make_dummy_forecasts(session=session, n_gsps=n_gsps)
-        else:
-            if model_name == "nwp_simple":
-                config_filename = "nowcasting_forecast/config/mvp_v0.yaml"
-            elif model_name == "nwp_simple_trained":
-                config_filename = "nowcasting_forecast/config/mvp_v1.yaml"
-            elif model_name == "cnn":
-                config_filename = "nowcasting_forecast/config/mvp_v2.yaml"
-            elif model_name == "pvnet":
-                config_filename = "nowcasting_forecast/config/pvnet_v1.yaml"
-            else:
-                raise NotImplementedError(f"Model {model_name} has not be implemented")
-
-            with tempfile.TemporaryDirectory() as temporary_dir:
-                # make batches
-                save_dir = batch_save_dir + "batch/" if batch_save_dir is not None else None
-                make_batches(
-                    temporary_dir=temporary_dir,
-                    config_filename=config_filename,
-                    batch_save_dir=save_dir,
-                    n_gsps=n_gsps,
-                )
 
-                # make forecasts
-                if model_name == "nwp_simple":
-                    forecasts = general_forecast_run_all_batches(
-                        session=session,
-                        batches_dir=temporary_dir,
-                        callable_function_for_on_batch=nwp_irradiance_simple_run_one_batch,
-                        model_name="nwp_simple",
-                        n_gsps=n_gsps,
-                    )
+    forecast_kwargs = dict(
+        connection=connection,
+        fake=fake,
+        model_name=model_name,
+        blend_weights=blend_weights,
+        batch_save_dir=batch_save_dir,
+        n_gsps=n_gsps,
+        update_national=update_national,
+        update_gsps=update_gsps,
+        streaming=streaming,
+        bulk_save=bulk_save,
+        save_chunk_size=save_chunk_size,
+        backend=backend,
+        quantize=quantize,
+        quantize_tolerance_mw=quantize_tolerance_mw,
+        n_workers=n_workers,
+        inference_batch_size=inference_batch_size,
+        profile_report=profile_report,
+        use_cprofile=cprofile,
+    )
+
+    if serve:
+        serve_forecasts(cadence_minutes=cadence_minutes, **forecast_kwargs)
+    else:
+        make_and_save_forecasts(**forecast_kwargs)
+
+
+def make_and_save_forecasts(
+    connection: DatabaseConnection,
+    fake: bool = False,
+    model_name: str = "nwp_simple",
+    blend_weights: Optional[str] = None,
+    batch_save_dir: Optional[str] = None,
+    n_gsps: Optional[int] = N_GSP,
+    update_national: Optional[bool] = True,
+    update_gsps: Optional[bool] = True,
+    streaming: Optional[bool] = False,
+    bulk_save: Optional[bool] = False,
+    save_chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+    backend: Optional[str] = "eager",
+    quantize: Optional[bool] = False,
+    quantize_tolerance_mw: Optional[float] = DEFAULT_TOLERANCE_MW,
+    n_workers: Optional[int] = 1,
+    inference_batch_size: Optional[int] = None,
+    profile_report: Optional[str] = None,
+    use_cprofile: Optional[bool] = False,
+):
+    """
+    Make one set of forecasts and save them to the database
+
+    The model, configuration and gsp metadata are loaded once per process,
+    so calling this again, in the same process, is much quicker than the first time.
+    The number of database queries is logged, so we can see if it goes up.
+    If 'profile_report' is set, the timings of each stage are saved there.
+
+    If 'model_name' is a comma separated list of models, the batches are made once with the
+    union of the models' configurations, and kept in memory. Each model is run on its own
+    inputs from these batches, see 'nowcasting_forecast.models.ensemble'.
+    """
+
+    models = [get_registered_model(name) for name in parse_model_names(model_name)]
+    weights = parse_blend_weights(blend_weights) if blend_weights is not None else None
+    run_kwargs = dict(
+        batch_save_dir=batch_save_dir,
+        n_gsps=n_gsps,
+        backend=backend,
+        quantize=quantize,
+        quantize_tolerance_mw=quantize_tolerance_mw,
+        n_workers=n_workers,
+        inference_batch_size=inference_batch_size,
+    )
 
-                elif model_name == "nwp_simple_trained":
-                    forecasts = general_forecast_run_all_batches(
+    with profile_run(report_filename=profile_report, use_cprofile=use_cprofile):
+        engine = connection.engine
+        with count_database_queries(engine=engine) as counter, connection.get_session() as session:
+            if fake:
+                forecasts_of_each_model = [make_dummy_forecasts(session=session, n_gsps=n_gsps)]
+            elif len(models) == 1:
+                with tempfile.TemporaryDirectory() as temporary_dir:
+                    forecasts_of_each_model = [
+                        make_forecasts(
+                            model=models[0],
+                            session=session,
+                            temporary_dir=temporary_dir,
+                            streaming=streaming,
+                            **run_kwargs,
+                        )
+                    ]
+            else:
+                with tempfile.TemporaryDirectory() as temporary_dir:
+                    forecasts = make_ensemble_forecasts(
+                        models=models,
                         session=session,
-                        batches_dir=temporary_dir,
-                        callable_function_for_on_batch=nwp_irradiance_simple_trained_run_one_batch,
-                        model_name="nwp_simple_trained",
-                        ml_model=Model,
-                        n_gsps=n_gsps,
+                        temporary_dir=temporary_dir,
+                        **run_kwargs,
                     )
-                elif model_name == "cnn":
-                    dataloader = get_cnn_data_loader(
-                        src_path=f"{temporary_dir}/live",
-                        tmp_path=f"{temporary_dir}/live",
-                        batch_save_dir=batch_save_dir,
+                if weights is not None:
+                    forecasts[BLEND_MODEL_NAME] = blend_forecasts(
+                        forecasts=forecasts, weights=weights, session=session
                     )
-                    forecasts = general_forecast_run_all_batches(
+                forecasts_of_each_model = list(forecasts.values())
+
+            # save forecasts, one model at a time
+            with stage("save"):
+                for forecasts in forecasts_of_each_model:
+                    save_forecasts(
+                        forecasts=forecasts,
                         session=session,
-                        batches_dir=temporary_dir,
-                        callable_function_for_on_batch=cnn_run_one_batch,
-                        model_name="cnn",
-                        ml_model=CNN_Model,
-                        dataloader=dataloader,
-                        use_hf=True,
-                        configuration_file="nowcasting_forecast/config/pvnet_v1.yaml",
-                        n_gsps=n_gsps,
+                        update_national=update_national,
+                        update_gsp=update_gsps,
+                        bulk=bulk_save,
+                        chunk_size=save_chunk_size,
                     )
-                else:
-                    raise NotImplementedError(f"model name {model_name} has not be implemented. ")
-
-        # save forecasts
-        save(
-            forecasts=forecasts,
-            session=session,
-            update_national=update_national,
-            update_gsp=update_gsps,
+
+        logger.info(f"Made {counter.n_queries} database queries")
+
+
+def make_forecasts(
+    model: RegisteredModel,
+    session: Session,
+    temporary_dir: str,
+    batch_save_dir: Optional[str] = None,
+    n_gsps: Optional[int] = N_GSP,
+    streaming: Optional[bool] = False,
+    **run_kwargs,
+) -> List[ForecastSQL]:
+    """
+    Make the batches for one model, and run the model on them
+
+    The batches are made with just the data sources the model reads,
+    see 'RegisteredModel.get_configuration'. The pytorch model is loaded first, so the batches
+    are made with just the time steps and systems it reads, see 'get_input_slices'.
+
+    Args:
+        model: the model
+        session: database session
+        temporary_dir: where the batches are made
+        batch_save_dir: optional directory to save the first batch to
+        n_gsps: the number of gsps to make forecasts for
+        streaming: option to make the batches in the background, see 'BatchProducer'
+        run_kwargs: arguments for 'run_model'
+
+    Returns: the forecasts
+    """
+    pytorch_model = model.load_pytorch_model(backend=run_kwargs.get("backend", "eager"))
+    input_slices = get_input_slices(pytorch_model)
+
+    config_filename = os.path.join(temporary_dir, "configuration.yaml")
+    save_yaml_configuration(
+        configuration=model.get_configuration(input_slices=input_slices), filename=config_filename
+    )
+
+    save_dir = batch_save_dir + "batch/" if batch_save_dir is not None else None
+    batches, batch_producer = None, None
+    if streaming:
+        batch_producer = BatchProducer(
+            temporary_dir=temporary_dir,
+            config_filename=config_filename,
+            batch_save_dir=save_dir,
+            n_gsps=n_gsps,
+            input_slices=input_slices,
+        ).start()
+    else:
+        batches = make_batches(
+            temporary_dir=temporary_dir,
+            config_filename=config_filename,
+            batch_save_dir=save_dir,
+            n_gsps=n_gsps,
+            in_memory=batch_save_dir is None,
+            input_slices=input_slices,
+        )
+
+    return run_model(
+        model=model,
+        session=session,
+        temporary_dir=temporary_dir,
+        batch_save_dir=batch_save_dir,
+        n_gsps=n_gsps,
+        batches=batch_producer if streaming else batches,
+        batch_producer=batch_producer,
+        configuration_file=config_filename,
+        pytorch_model=pytorch_model,
+        **run_kwargs,
+    )
+
+
+def make_ensemble_forecasts(
+    models: List[RegisteredModel],
+    session: Session,
+    temporary_dir: str,
+    batch_save_dir: Optional[str] = None,
+    n_gsps: Optional[int] = N_GSP,
+    **run_kwargs,
+) -> Dict[str, List[ForecastSQL]]:
+    """
+    Make the batches once for several models, and run each model on them
+
+    The batches are made in memory, with the union of the models' configurations and of the
+    parts of each data source they read, see 'make_union_input_slices'. Then each model is given
+    just the time steps and systems it reads, see 'get_input_slices'.
+
+    Args:
+        models: the models
+        session: database session
+        temporary_dir: where the batches are made
+        batch_save_dir: optional directory to save the first batch to
+        n_gsps: the number of gsps to make forecasts for
+        run_kwargs: arguments for 'run_model'
+
+    Returns: the forecasts of each model, keyed by model name
+    """
+    pytorch_models = {
+        model.name: model.load_pytorch_model(backend=run_kwargs.get("backend", "eager"))
+        for model in models
+    }
+    input_slices = {name: get_input_slices(pytorch_models[name]) for name in pytorch_models}
+
+    union_configuration = make_union_configuration(models, input_slices=input_slices)
+    union_input_slices = make_union_input_slices(
+        models=models, input_slices=input_slices, union_configuration=union_configuration
+    )
+    config_filename = os.path.join(temporary_dir, "configuration.yaml")
+    save_yaml_configuration(configuration=union_configuration, filename=config_filename)
+
+    batches = make_batches(
+        temporary_dir=temporary_dir,
+        config_filename=config_filename,
+        batch_save_dir=batch_save_dir + "batch/" if batch_save_dir is not None else None,
+        n_gsps=n_gsps,
+        in_memory=True,
+        input_slices=union_input_slices,
+    )
+
+    forecasts = {}
+    for model in models:
+        with stage(f"run_{model.name}"):
+            forecasts[model.name] = run_model(
+                model=model,
+                session=session,
+                temporary_dir=temporary_dir,
+                batch_save_dir=batch_save_dir,
+                n_gsps=n_gsps,
+                batches=iterate_model_inputs(
+                    batches=batches,
+                    model=model,
+                    union_configuration=union_configuration,
+                    input_slices=input_slices[model.name],
+                ),
+                configuration_file=config_filename,
+                pytorch_model=pytorch_models[model.name],
+                **run_kwargs,
+            )
+
+    return forecasts
+
+
+def run_model(
+    model: RegisteredModel,
+    session: Session,
+    temporary_dir: str,
+    batch_save_dir: Optional[str] = None,
+    n_gsps: Optional[int] = N_GSP,
+    batches: Optional[Iterable[Batch]] = None,
+    batch_producer: Optional[BatchProducer] = None,
+    configuration_file: Optional[str] = None,
+    pytorch_model: Optional = None,
+    backend: Optional[str] = "eager",
+    quantize: Optional[bool] = False,
+    quantize_tolerance_mw: Optional[float] = DEFAULT_TOLERANCE_MW,
+    n_workers: Optional[int] = 1,
+    inference_batch_size: Optional[int] = None,
+) -> List[ForecastSQL]:
+    """
+    Run a registered model on the batches
+
+    If 'batches' is None, the batches are loaded from 'temporary_dir'.
+    'configuration_file' is the configuration the batches were made with.
+    'pytorch_model' can be given if the model is already loaded, see 'load_pytorch_model'.
+    """
+    kwargs = {}
+    if model.make_dataloader is not None:
+        kwargs["dataloader"] = model.make_dataloader(
+            temporary_dir=temporary_dir,
+            batch_save_dir=batch_save_dir,
+            batches=batches,
+            configuration_file=configuration_file,
+        )
+    else:
+        kwargs["batches"] = batches
+    if model.ml_model is not None:
+        kwargs.update(
+            ml_model=model.ml_model,
+            pytorch_model=pytorch_model,
+            quantize=quantize,
+            quantize_tolerance_mw=quantize_tolerance_mw,
         )
+    if model.uses_backend:
+        kwargs["backend"] = backend
+
+    return general_forecast_run_all_batches(
+        session=session,
+        batches_dir=temporary_dir,
+        callable_function_for_on_batch=model.callable_function_for_on_batch,
+        model_name=model.name,
+        use_hf=model.use_hf,
+        configuration_file=model.run_configuration_file,
+        n_gsps=n_gsps,
+        batch_producer=batch_producer,
+        n_workers=n_workers,
+        inference_batch_size=inference_batch_size,
+        **kwargs,
+    )
+
+
+def serve_forecasts(
+    cadence_minutes: Optional[int] = 30,
+    n_cycles: Optional[int] = None,
+    trigger: Optional[threading.Event] = None,
+    **forecast_kwargs,
+):
+    """
+    Keep running, and make forecasts on a regular cadence
+
+    The first forecast is made straight away. After that, a forecast is made at the start of
+    every 'cadence_minutes' period, e.g. 10:00, 10:30, 11:00 for 30 minutes.
+    A forecast can be made out of schedule by sending the process a SIGUSR1 signal,
+    e.g. 'kill -USR1 <pid>'.
+
+    If one forecast fails, the error is logged and we carry on with the next one.
+    With N_WORKERS, the same worker processes are used for every forecast.
+
+    Args:
+        cadence_minutes: how often to make forecasts
+        n_cycles: the number of forecasts to make, defaults to running forever
+        trigger: event that makes a forecast straight away when it is set.
+            Defaults to an event which is set by SIGUSR1.
+        forecast_kwargs: arguments for 'make_and_save_forecasts'
+    """
+
+    if trigger is None:
+        trigger = threading.Event()
+        signal.signal(signal.SIGUSR1, lambda signal_number, frame: trigger.set())
+
+    logger.info(f"Serving forecasts every {cadence_minutes} minutes")
+
+    cycle = 0
+    try:
+        while (n_cycles is None) or (cycle < n_cycles):
+            if cycle > 0:
+                now = datetime.now(timezone.utc)
+                next_run = floor_minutes_dt(now, minutes=cadence_minutes) + timedelta(
+                    minutes=cadence_minutes
+                )
+                logger.info(f"Next forecast will be made at {next_run}")
+
+                if trigger.wait(timeout=(next_run - now).total_seconds()):
+                    logger.info("Forecast has been triggered out of schedule")
+                trigger.clear()
+
+            start_time = time.time()
+            try:
+                make_and_save_forecasts(**forecast_kwargs)
+            except Exception:
+                logger.exception(f"Forecast {cycle} failed, will try again next time")
+            logger.info(f"Forecast {cycle} took {time.time() - start_time:.2f} seconds")
+
+            cycle += 1
+    finally:
+        shutdown_worker_pool()
 
 
 def make_dummy_forecasts(session: Session, n_gsps: Optional[int] = N_GSP):
@@ -1,26 +1,53 @@
 """ Using ManagerLive to make batches """
 import logging
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterator, List, Optional
 
+import numpy as np
 import pandas as pd
+from nowcasting_dataset.config.model import Configuration
+from nowcasting_dataset.data_sources.metadata.metadata_model import Metadata, load_from_csv
+from nowcasting_dataset.dataset.batch import Batch
 from nowcasting_dataset.manager.manager_live import ManagerLive
+from nowcasting_dataset.utils import get_start_and_end_example_index
 
 from nowcasting_forecast import N_GSP
+from nowcasting_forecast.profiling import stage
 
 logger = logging.getLogger(__name__)
 
+# the data sources the batches can be made with
+DATA_SOURCE_NAMES = ["gsp", "nwp", "pv", "satellite", "hrvsatellite", "sun"]
 
-def make_batches(
+# the parts of each data source a model reads, e.g. {"pv": {"time_index": 7, "id_index": 128}},
+# this is the number of time steps or systems from the start of each dimension
+InputSlices = Dict[str, Dict[str, int]]
+
+# the configuration fields of the number of systems in each example. These data sources take
+# the first systems, with the central one first, so fewer systems are the first of the batch's
+N_SYSTEMS_FIELDS = {"pv": "n_pv_systems_per_example", "gsp": "n_gsp_per_example"}
+
+
+def make_manager(
     config_filename: str = "nowcasting_forecast/config/mvp_v0.yaml",
     t0_datetime_utc: datetime = None,
     temporary_dir: Optional[str] = None,
     n_gsps: Optional[int] = N_GSP,
-    batch_save_dir: Optional[str] = None,
-):
-    """Make batches from config file"""
+) -> ManagerLive:
+    """
+    Make a ManagerLive which is ready to make batches
+
+    1. Load the configuration and overwrite data paths from environment variables
+    2. Initialize the data sources, just the ones in the configuration.
+       Each model's configuration has just the data sources it reads,
+       see 'RegisteredModel.get_configuration'
+    3. Make the locations file of each example
+    """
 
     logger.info(f"Making batches using configuration file: {config_filename}")
 
@@ -60,21 +87,343 @@ def make_batches(
         )
 
     # make location file
-    manager.initialize_data_sources(
-        names_of_selected_data_sources=["gsp", "nwp", "pv", "satellite", "hrvsatellite", "sun"]
-    )
-    manager.create_files_specifying_spatial_and_temporal_locations_of_each_example(
-        t0_datetime=t0_datetime_utc,
-        n_gsps=n_gsps,
-    )
+    data_source_names = [
+        data_source_name
+        for data_source_name in DATA_SOURCE_NAMES
+        if getattr(manager.config.input_data, data_source_name) is not None
+    ]
+    logger.debug(f"Initializing data sources {data_source_names}")
+    with stage("initialize_data_sources"):
+        manager.initialize_data_sources(names_of_selected_data_sources=data_source_names)
+    with stage("make_locations"):
+        manager.create_files_specifying_spatial_and_temporal_locations_of_each_example(
+            t0_datetime=t0_datetime_utc,
+            n_gsps=n_gsps,
+        )
 
     # remove gsp as a datasource
     if not manager.config.input_data.gsp.is_live:
         manager.data_sources.pop("gsp")
 
+    return manager
+
+
+def push_down_input_slices(
+    configuration: Configuration, input_slices: Optional[InputSlices] = None
+) -> Configuration:
+    """
+    Make the configuration read just the systems the model reads from each data source
+
+    The time steps can not be set like this, as the time windows of the configuration
+    are in minutes, so these are selected after each data source is read,
+    see 'select_input_slices'.
+
+    Args:
+        configuration: the configuration, this is changed
+        input_slices: the parts of each data source the model reads
+
+    Returns: the configuration
+    """
+    for data_source_name, field in N_SYSTEMS_FIELDS.items():
+        data_source = getattr(configuration.input_data, data_source_name)
+        n_systems = (input_slices or {}).get(data_source_name, {}).get("id_index")
+        if (data_source is None) or (n_systems is None):
+            continue
+
+        if n_systems < getattr(data_source, field):
+            logger.debug(f"Reading {n_systems} systems of {data_source_name} in each example")
+            setattr(data_source, field, n_systems)
+
+    return configuration
+
+
+def select_input_slices(data_source, input_slices: Dict[str, int]):
+    """
+    Select the time steps or systems, from the start of each dimension, of one data source
+
+    Args:
+        data_source: the data of one data source in a batch
+        input_slices: the number to keep of each dimension, e.g. {"time_index": 7}
+
+    Returns: the data source with only the parts the model reads
+    """
+    slices = {
+        dimension: slice(0, n)
+        for dimension, n in input_slices.items()
+        if data_source.sizes.get(dimension, 0) > n
+    }
+    if len(slices) == 0:
+        return data_source
+
+    return type(data_source)(data_source.isel(slices))
+
+
+def iterate_batches(
+    manager: ManagerLive,
+    n_gsps: Optional[int] = N_GSP,
+    input_slices: Optional[InputSlices] = None,
+) -> Iterator[Batch]:
+    """
+    Make the batches in memory, one batch at a time
+
+    ManagerLive.create_batches makes all the batches for one data source,
+    before moving on to the next data source, and saves them to disk.
+    Here we loop over the batches, and make each batch for all data sources,
+    so each batch is ready as soon as possible and nothing is written to disk.
+
+    Args:
+        manager: ManagerLive, with data sources initialized and the locations file made
+        n_gsps: the number of gsps we want to make batches for
+        input_slices: optional parts of each data source the model reads,
+            the rest is dropped as soon as each data source is read
+
+    Returns: iterator of Batch objects
+    """
+
+    batch_size = manager.config.process.batch_size
+    n_batches = int(np.ceil(n_gsps / batch_size))
+
+    metadata = load_from_csv(
+        path=manager.config.output_data.filepath / "live", batch_size=batch_size
+    )
+    locations = metadata.space_time_locations
+
+    for data_source in manager.data_sources.values():
+        data_source.open()
+
+    for batch_idx in range(n_batches):
+        logger.debug(f"Making batch {batch_idx}")
+
+        start_example_idx, end_example_idx = get_start_and_end_example_index(
+            batch_idx=batch_idx, batch_size=batch_size
+        )
+        locations_for_batch = locations[start_example_idx:end_example_idx]
+
+        with stage("make_batch"):
+            batch_dict = {
+                data_source_name: data_source.get_batch(locations=locations_for_batch)
+                for data_source_name, data_source in manager.data_sources.items()
+            }
+            for data_source_name, data_source_input_slices in (input_slices or {}).items():
+                if data_source_name in batch_dict:
+                    batch_dict[data_source_name] = select_input_slices(
+                        data_source=batch_dict[data_source_name],
+                        input_slices=data_source_input_slices,
+                    )
+        batch_dict["metadata"] = Metadata(
+            batch_size=batch_size, space_time_locations=locations_for_batch
+        )
+
+        yield Batch(**batch_dict)
+
+
+def make_batches(
+    config_filename: str = "nowcasting_forecast/config/mvp_v0.yaml",
+    t0_datetime_utc: datetime = None,
+    temporary_dir: Optional[str] = None,
+    n_gsps: Optional[int] = N_GSP,
+    batch_save_dir: Optional[str] = None,
+    in_memory: bool = False,
+    input_slices: Optional[InputSlices] = None,
+) -> Optional[List[Batch]]:
+    """
+    Make batches from config file
+
+    By default the batches are saved to '<temporary_dir>/live'.
+    If 'in_memory' is set, the batches are returned instead, and nothing is saved to disk,
+    apart from the first batch if 'batch_save_dir' is set.
+    Only the 'input_slices' of each data source are kept in the batches made in memory,
+    see 'iterate_batches'.
+    """
+
+    manager = make_manager(
+        config_filename=config_filename,
+        t0_datetime_utc=t0_datetime_utc,
+        temporary_dir=temporary_dir,
+        n_gsps=n_gsps,
+    )
+
+    if in_memory:
+        batches = list(iterate_batches(manager=manager, n_gsps=n_gsps, input_slices=input_slices))
+
+        # save batch to s3, just save batch 0
+        if batch_save_dir is not None:
+            batches[0].save_netcdf(batch_i=0, path=batch_save_dir)
+
+        return batches
+
     # make batches
-    manager.create_batches()
+    with stage("make_batches"):
+        manager.create_batches()
 
     # save batch to s3, just save batch 0
     if batch_save_dir is not None:
         manager.save_batch(batch_idx=0, path=batch_save_dir)
+
+
+class BatchProducer:
+    """
+    Make batches in a background thread, and hand them over to the model one at a time
+
+    The batches are made in memory with 'iterate_batches',
+    so the model can start on the first batch while the next ones are being made.
+    The number of batches that are made ahead of the model is limited by 'max_queue_size'.
+
+    Iterate over this object to get the batches. The background thread is stopped with 'stop',
+    or by using the producer as a context manager:
+
+        with BatchProducer(...) as batch_producer:
+            for batch in batch_producer:
+                ...
+    """
+
+    def __init__(
+        self,
+        config_filename: str = "nowcasting_forecast/config/mvp_v0.yaml",
+        t0_datetime_utc: datetime = None,
+        temporary_dir: Optional[str] = None,
+        n_gsps: Optional[int] = N_GSP,
+        batch_save_dir: Optional[str] = None,
+        max_queue_size: int = 2,
+        input_slices: Optional[InputSlices] = None,
+    ):
+        """
+        Batch producer
+
+        Args:
+            config_filename: the configuration file used to make the batches
+            t0_datetime_utc: the t0 datetime of the batches, defaults to now
+            temporary_dir: the directory where the locations file is saved to
+            n_gsps: the number of gsps we want to make batches for
+            batch_save_dir: optional directory to save the first batch to
+            max_queue_size: the maximum number of batches made ahead of the model
+            input_slices: optional parts of each data source the model reads,
+                see 'iterate_batches'
+        """
+        self.config_filename = config_filename
+        self.t0_datetime_utc = t0_datetime_utc
+        self.temporary_dir = temporary_dir
+        self.n_gsps = n_gsps
+        self.batch_save_dir = batch_save_dir
+        self.input_slices = input_slices
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="batch-producer", daemon=True)
+
+        # timings, these are used to log how much batching and the model overlap
+        self.start_time = None
+        self.producer_seconds: List[float] = []
+        self.consumer_wait_seconds: List[float] = []
+
+    def start(self) -> "BatchProducer":
+        """Start making batches in the background"""
+        logger.info("Starting to make batches in the background")
+        self.start_time = time.time()
+        self.thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = 60):
+        """
+        Tell the background thread to stop making batches, and wait for it to finish
+
+        Args:
+            timeout: the number of seconds to wait for the thread.
+                The thread stops after the batch it is making, so this can take a while.
+        """
+        self.stop_event.set()
+
+        if self.thread.is_alive() and (self.thread is not threading.current_thread()):
+            self.thread.join(timeout=timeout)
+            if self.thread.is_alive():
+                logger.warning(f"Batch producer has not stopped after {timeout} seconds")
+
+    def __enter__(self) -> "BatchProducer":
+        """Start making batches in the background"""
+        return self.start()
+
+    def __exit__(self, *exc):
+        """Stop the background thread"""
+        self.stop()
+        return False
+
+    def _put(self, item):
+        """Put an item on the queue, but give up if we have been told to stop"""
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self):
+        """Make the batches, this is run in the background thread"""
+        try:
+            start_time = time.time()
+            manager = make_manager(
+                config_filename=self.config_filename,
+                t0_datetime_utc=self.t0_datetime_utc,
+                temporary_dir=self.temporary_dir,
+                n_gsps=self.n_gsps,
+            )
+
+            batches = iterate_batches(
+                manager=manager, n_gsps=self.n_gsps, input_slices=self.input_slices
+            )
+            for batch_idx, batch in enumerate(batches):
+                # save batch to s3, just save batch 0
+                if (batch_idx == 0) and (self.batch_save_dir is not None):
+                    batch.save_netcdf(batch_i=0, path=self.batch_save_dir)
+
+                self.producer_seconds.append(time.time() - start_time)
+                logger.debug(f"Made batch {batch_idx} in {self.producer_seconds[-1]:.2f} seconds")
+
+                self._put(batch)
+                if self.stop_event.is_set():
+                    logger.debug("Batch producer has been stopped")
+                    return
+
+                start_time = time.time()
+
+            self._put(None)
+
+        except Exception as e:
+            logger.error("Batch producer failed")
+            self._put(e)
+
+    def __iter__(self) -> Iterator[Batch]:
+        """
+        Get the batches, as soon as they are made
+
+        Any errors from the background thread are raised here.
+        """
+        batch_idx = 0
+        while True:
+            start_time = time.time()
+            item = self.queue.get()
+            self.consumer_wait_seconds.append(time.time() - start_time)
+
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                return
+
+            logger.debug(
+                f"Waited {self.consumer_wait_seconds[-1]:.2f} seconds for batch {batch_idx}"
+            )
+            yield item
+            batch_idx += 1
+
+    def log_overlap(self):
+        """Log how much time was spent on each stage, and how much they overlapped"""
+        wall_seconds = time.time() - self.start_time
+        producer_seconds = sum(self.producer_seconds)
+        consumer_seconds = wall_seconds - sum(self.consumer_wait_seconds)
+        overlap_seconds = max(producer_seconds + consumer_seconds - wall_seconds, 0)
+
+        logger.info(
+            f"Batching took {producer_seconds:.2f} seconds, "
+            f"the model took {consumer_seconds:.2f} seconds, "
+            f"and together they took {wall_seconds:.2f} seconds. "
+            f"They overlapped for {overlap_seconds:.2f} seconds"
+        )
@@ -0,0 +1,145 @@
+""" Installed capacity of each gsp
+
+The models predict the fraction of each gsp's installed capacity, so the predictions of every
+batch are multiplied by the capacity of its gsps. The capacity is kept in a dense numpy array,
+indexed by gsp id, so this is one vectorised lookup per batch.
+
+- The capacity file is loaded once per process, and is loaded again if the file changes,
+  or with 'refresh', so the app does not have to be restarted to use new capacities.
+- The file can have one capacity for each gsp, i.e. the columns 'gsp_id' and
+  'installedcapacity_mwp', or a capacity for each gsp at several times, with a 'datetime_gmt'
+  column too. Then the capacity at each t0 is the last one at or before t0 (an as-of lookup),
+  or the first one if t0 is before all of them.
+"""
+import logging
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+import nowcasting_forecast
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY_FILE = os.path.join(
+    os.path.dirname(nowcasting_forecast.__file__), "data", "gsp_capacity.csv"
+)
+
+# the capacity store that has been loaded in this process, and the file and its modified time
+_loaded_store = {}
+
+
+class CapacityStore:
+    """The installed capacity of each gsp, optionally at several times"""
+
+    def __init__(self, capacity: pd.DataFrame):
+        """
+        Capacity store
+
+        Args:
+            capacity: dataframe with columns 'gsp_id' and 'installedcapacity_mwp',
+                and optionally 'datetime_gmt'
+        """
+        capacity = capacity.reset_index()
+        capacity["gsp_id"] = capacity["gsp_id"].astype(int)
+        if capacity["gsp_id"].min() < 0:
+            raise ValueError("The gsp ids of the capacities must not be negative")
+
+        if "datetime_gmt" in capacity.columns:
+            datetimes = pd.to_datetime(capacity["datetime_gmt"], utc=True).dt.tz_convert(None)
+            capacity["datetime_gmt"] = datetimes
+        else:
+            capacity["datetime_gmt"] = pd.Timestamp.min
+
+        # times x gsp ids, each gsp keeps its last capacity until it changes,
+        # and has its first capacity before that
+        capacity = (
+            capacity.pivot_table(
+                index="datetime_gmt",
+                columns="gsp_id",
+                values="installedcapacity_mwp",
+                aggfunc="last",
+            )
+            .ffill()
+            .bfill()
+        )
+
+        self.times = capacity.index.values.astype("datetime64[ns]")
+        self.capacity_mwp = np.full((len(self.times), capacity.columns.max() + 1), np.nan)
+        self.capacity_mwp[:, capacity.columns.values] = capacity.values
+
+        logger.debug(
+            f"Capacity store has {capacity.shape[1]} gsps at {len(self.times)} time(s), "
+            f"with {self.capacity_mwp[-1][~np.isnan(self.capacity_mwp[-1])].sum():.0f} MW "
+            f"at the latest time"
+        )
+
+    @classmethod
+    def from_csv(cls, filename: str) -> "CapacityStore":
+        """Load the capacities from a csv file"""
+        logger.debug(f"Loading gsp capacities from {filename}")
+        return cls(capacity=pd.read_csv(filename))
+
+    @property
+    def has_times(self) -> bool:
+        """If the capacities change over time"""
+        return len(self.times) > 1
+
+    def get_capacity(self, gsp_ids: Sequence[int], t0s: Optional[Sequence] = None) -> np.ndarray:
+        """
+        Get the capacity of each gsp
+
+        Args:
+            gsp_ids: the gsp ids
+            t0s: optional time for each gsp id, naive datetimes are taken as UTC.
+                Defaults to the latest capacities.
+
+        Returns: capacity in MW, with the same shape as 'gsp_ids'
+        """
+        gsp_ids = np.asarray(gsp_ids, dtype=int)
+
+        if (t0s is None) or (not self.has_times):
+            time_indexes = len(self.times) - 1
+        else:
+            t0s = pd.to_datetime(np.asarray(t0s).ravel(), utc=True).tz_convert(None).values
+            time_indexes = np.searchsorted(self.times, t0s, side="right") - 1
+            time_indexes = np.maximum(time_indexes, 0).reshape(gsp_ids.shape)
+
+        valid = (gsp_ids >= 0) & (gsp_ids < self.capacity_mwp.shape[1])
+        capacity = self.capacity_mwp[time_indexes, np.where(valid, gsp_ids, 0)]
+        missing = ~valid | np.isnan(capacity)
+        if missing.any():
+            raise KeyError(f"There is no capacity for gsp ids {np.unique(gsp_ids[missing])}")
+
+        return capacity
+
+
+def get_capacity_store(filename: Optional[str] = None, refresh: bool = False) -> CapacityStore:
+    """
+    Get the capacity store of this process
+
+    Args:
+        filename: the capacity file, defaults to the 'GSP_CAPACITY_FILE' environment variable,
+            or the capacities in 'nowcasting_forecast/data/gsp_capacity.csv'
+        refresh: option to load the file again, even if it has not changed
+
+    Returns: capacity store
+    """
+    if filename is None:
+        filename = os.getenv("GSP_CAPACITY_FILE", DEFAULT_CAPACITY_FILE)
+
+    # remote files can not be checked for changes, so they are only loaded again with 'refresh'
+    modified_time = os.path.getmtime(filename) if os.path.exists(filename) else None
+
+    if (
+        (not refresh)
+        and (_loaded_store.get("filename") == filename)
+        and (_loaded_store.get("modified_time") == modified_time)
+    ):
+        return _loaded_store["store"]
+
+    store = CapacityStore.from_csv(filename)
+    _loaded_store.update(filename=filename, modified_time=modified_time, store=store)
+
+    return store
@@ -1,22 +1,28 @@
 """ Dataset and functions"""
 import logging
 import os
+from typing import Iterable, Iterator, Optional, Union
 
 from nowcasting_dataset.config.model import Configuration
 from nowcasting_dataset.dataset.batch import Batch
 
+from nowcasting_forecast.profiling import stage
+
 logger = logging.getLogger(__name__)
 
 
 class BatchDataLoader:
     """
     Loads batches
+
+    The batches are either loaded from disk, or are given as 'batches' which are already in memory.
     """
 
     def __init__(
         self,
         n_batches: int,
         configuration: Configuration,
+        batches: Optional[Iterable[Batch]] = None,
     ):
         """
         Netcdf Dataset
@@ -24,9 +30,11 @@ class BatchDataLoader:
         Args:
             n_batches: Number of batches available on disk.
             configuration: configuration object
+            batches: Optional batches already in memory, these are used instead of the files.
         """
         self.n_batches = n_batches
         self.configuration = configuration
+        self.batches = batches
 
         self.src_path = os.path.join(configuration.output_data.filepath, "live")
 
@@ -36,6 +44,14 @@ class BatchDataLoader:
         """Length of dataset"""
         return self.n_batches
 
+    def __iter__(self) -> Iterator[Union[Batch, dict]]:
+        """Iterate over the batches, in memory if we have them, otherwise from disk"""
+        if self.batches is not None:
+            yield from self.batches
+        else:
+            for batch_idx in range(self.n_batches):
+                yield self[batch_idx]
+
     def __getitem__(self, batch_idx: int) -> dict:
         """Returns a whole batch at once.
 
@@ -53,11 +69,12 @@ class BatchDataLoader:
                 "batch_idx must be in the range" f" [0, {self.n_batches}), not {batch_idx}!"
             )
 
-        batch: Batch = Batch.load_netcdf(
-            self.src_path,
-            batch_idx=batch_idx,
-            data_sources_names=["nwp"],
-        )
+        with stage("load_batch"):
+            batch: Batch = Batch.load_netcdf(
+                self.src_path,
+                batch_idx=batch_idx,
+                data_sources_names=["nwp"],
+            )
 
         batch: dict = batch.dict()
 
@@ -0,0 +1,117 @@
+""" Local cache of the gsp metadata
+
+The gsp metadata, i.e. the centroid of each gsp, is made from the ESO and PV Live metadata
+and the ESO shape files, which can mean downloading them. This is slow, and the metadata hardly
+ever changes, so we keep a snapshot of it on disk.
+
+- The snapshot is used until it is older than 'GSP_METADATA_TTL_HOURS', then it is remade.
+- If the metadata can not be remade, e.g. we are offline, the last snapshot is used.
+- The metadata is only loaded once per process, until the snapshot is too old.
+"""
+import logging
+import os
+import time
+from typing import Optional
+
+import pandas as pd
+from nowcasting_dataset.data_sources.gsp.eso import get_gsp_metadata_from_eso
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "nowcasting_forecast", "gsp_metadata.csv"
+)
+DEFAULT_TTL_HOURS = 24 * 7
+
+# metadata that has been loaded in this process, keyed by the snapshot file.
+# The values are the time the metadata was made, and the metadata.
+_loaded_metadata = {}
+
+
+def get_gsp_metadata(
+    cache_file: Optional[str] = None, ttl_hours: Optional[float] = None, refresh: bool = False
+) -> pd.DataFrame:
+    """
+    Get the gsp metadata, indexed by 'gsp_id', with columns 'centroid_lat' and 'centroid_lon'
+
+    Please do not change the returned dataframe in place.
+
+    Args:
+        cache_file: the snapshot file, defaults to the 'GSP_METADATA_CACHE_FILE' environment
+            variable, or '~/.cache/nowcasting_forecast/gsp_metadata.csv'
+        ttl_hours: how long the snapshot is used for, defaults to the 'GSP_METADATA_TTL_HOURS'
+            environment variable, or one week
+        refresh: option to remake the metadata, even if the snapshot is not too old
+
+    Returns: gsp metadata
+    """
+
+    if cache_file is None:
+        cache_file = os.getenv("GSP_METADATA_CACHE_FILE", DEFAULT_CACHE_FILE)
+    if ttl_hours is None:
+        ttl_hours = float(os.getenv("GSP_METADATA_TTL_HOURS", DEFAULT_TTL_HOURS))
+    ttl_seconds = ttl_hours * 60 * 60
+
+    # already loaded in this process
+    if (not refresh) and (cache_file in _loaded_metadata):
+        made_time, metadata = _loaded_metadata[cache_file]
+        if time.time() - made_time < ttl_seconds:
+            return metadata
+
+    snapshot_exists = os.path.exists(cache_file)
+    snapshot_is_recent = snapshot_exists and (
+        time.time() - os.path.getmtime(cache_file) < ttl_seconds
+    )
+    if (not refresh) and snapshot_is_recent:
+        logger.debug(f"Loading gsp metadata from {cache_file}")
+        metadata = load_gsp_metadata_snapshot(cache_file=cache_file)
+        made_time = os.path.getmtime(cache_file)
+    else:
+        try:
+            metadata = make_gsp_metadata()
+            save_gsp_metadata_snapshot(metadata=metadata, cache_file=cache_file)
+        except Exception as e:
+            if not snapshot_exists:
+                raise e
+            logger.warning(
+                f"Could not make the gsp metadata ({e}), so using the last snapshot {cache_file}"
+            )
+            metadata = load_gsp_metadata_snapshot(cache_file=cache_file)
+        # try to remake the metadata again after 'ttl_hours'
+        made_time = time.time()
+
+    _loaded_metadata[cache_file] = (made_time, metadata)
+
+    return metadata
+
+
+def refresh_gsp_metadata(cache_file: Optional[str] = None) -> pd.DataFrame:
+    """Remake the gsp metadata, and save the snapshot"""
+    return get_gsp_metadata(cache_file=cache_file, refresh=True)
+
+
+def make_gsp_metadata() -> pd.DataFrame:
+    """Make the gsp metadata from ESO, indexed by 'gsp_id'. For duplicate gsps, the first is used"""
+    logger.info("Making gsp metadata from ESO")
+
+    metadata = get_gsp_metadata_from_eso()
+    metadata = pd.DataFrame(metadata[["gsp_id", "centroid_lat", "centroid_lon"]])
+    metadata = metadata.drop_duplicates(subset=["gsp_id"])
+    metadata["gsp_id"] = metadata["gsp_id"].astype(int)
+
+    return metadata.set_index("gsp_id")
+
+
+def save_gsp_metadata_snapshot(metadata: pd.DataFrame, cache_file: str):
+    """Save the gsp metadata, the file is replaced at once so a partial file is never read"""
+    logger.debug(f"Saving gsp metadata to {cache_file}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    temporary_file = f"{cache_file}.tmp"
+    metadata.to_csv(temporary_file)
+    os.replace(temporary_file, cache_file)
+
+
+def load_gsp_metadata_snapshot(cache_file: str) -> pd.DataFrame:
+    """Load the gsp metadata snapshot, indexed by 'gsp_id'"""
+    return pd.read_csv(cache_file, index_col="gsp_id")
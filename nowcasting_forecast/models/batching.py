@@ -0,0 +1,172 @@
+""" Re-chunk the data batches into inference batches
+
+The data batches are made with 'configuration.process.batch_size' examples, and the last one is
+padded up to the full size. The models do not need to run on the same batches, so the examples
+are re-chunked into inference batches of 'inference_batch_size', without the padding.
+For example, all the gsps can be run in one forward pass.
+
+Both 'Batch' (xarray data) and 'BatchML' (tensors) batches can be re-chunked,
+or dictionaries of these, which are loaded from disk.
+"""
+import logging
+from typing import Iterator, List, Optional, Tuple, Union
+
+import torch
+import xarray as xr
+from nowcasting_dataloader.batch import BatchML
+from nowcasting_dataset.data_sources.metadata.metadata_model import Metadata
+from nowcasting_dataset.dataset.batch import Batch
+
+logger = logging.getLogger(__name__)
+
+
+def to_batch_object(batch: Union[Batch, BatchML, dict]) -> Union[Batch, BatchML]:
+    """Change a dictionary, loaded from disk, to a 'Batch' or 'BatchML'"""
+    if not isinstance(batch, dict):
+        return batch
+
+    # 'Batch' metadata has the locations, 'BatchML' metadata has lists of ids and t0s
+    metadata = batch["metadata"]
+    if not isinstance(metadata, dict):
+        metadata = metadata.dict()
+    if "space_time_locations" in metadata:
+        return Batch(**batch)
+    else:
+        return BatchML(**batch)
+
+
+def get_batch_size(batch: Union[Batch, BatchML, dict]) -> int:
+    """Get the number of examples in the batch, including any padding"""
+    metadata = batch["metadata"] if isinstance(batch, dict) else batch.metadata
+    return metadata["batch_size"] if isinstance(metadata, dict) else metadata.batch_size
+
+
+def concatenate_batches(
+    batch_slices: List[Tuple[Union[Batch, BatchML, dict], int, int]]
+) -> Union[Batch, BatchML, dict]:
+    """
+    Join slices of batches into one batch
+
+    Args:
+        batch_slices: list of (batch, start, end), the examples start:end are used from each batch
+
+    Returns: one batch with all the examples, in order.
+        If this is just one whole batch, that batch is returned without copying it.
+    """
+    if len(batch_slices) == 1:
+        batch, start, end = batch_slices[0]
+        if (start == 0) and (end == get_batch_size(batch)):
+            return batch
+
+    batches = [to_batch_object(batch) for batch, _, _ in batch_slices]
+    slices = [slice(start, end) for _, start, end in batch_slices]
+
+    if isinstance(batches[0], BatchML):
+        return _concatenate_batch_mls(batches=batches, slices=slices)
+    else:
+        return _concatenate_batches(batches=batches, slices=slices)
+
+
+def _concatenate_batches(batches: List[Batch], slices: List[slice]) -> Batch:
+    """Join slices of 'Batch' objects, each data source is joined on the example index"""
+    batch_size = sum(s.stop - s.start for s in slices)
+
+    data_sources = {}
+    for data_source_name in Batch.__fields__.keys():
+        if (data_source_name == "metadata") or (getattr(batches[0], data_source_name) is None):
+            continue
+
+        data_source = getattr(batches[0], data_source_name)
+        data = xr.concat(
+            [getattr(batch, data_source_name).isel(example=s) for batch, s in zip(batches, slices)],
+            dim="example",
+        )
+        data.__setitem__("example", range(0, batch_size))
+        data_sources[data_source_name] = type(data_source)(data)
+
+    space_time_locations = [
+        location
+        for batch, s in zip(batches, slices)
+        for location in batch.metadata.space_time_locations[s]
+    ]
+    metadata = Metadata(batch_size=batch_size, space_time_locations=space_time_locations)
+
+    return Batch(metadata=metadata, **data_sources)
+
+
+def _concatenate_batch_mls(batches: List[BatchML], slices: List[slice]) -> BatchML:
+    """
+    Join slices of 'BatchML' objects
+
+    The tensors and lists with a first dimension of the batch size are joined. Other values,
+    like the channel names, are the same for every example, so are taken from the first batch.
+    """
+    original_batch_size = batches[0].metadata.batch_size
+    batch_size = sum(s.stop - s.start for s in slices)
+
+    data_sources = {}
+    for data_source_name in BatchML.__fields__.keys():
+        data_source = getattr(batches[0], data_source_name)
+        if data_source is None:
+            continue
+
+        fields = {}
+        for name, value in data_source.__dict__.items():
+            if isinstance(value, (list, torch.Tensor)) and (len(value) == original_batch_size):
+                values = [getattr(getattr(batch, data_source_name), name) for batch in batches]
+                if isinstance(value, torch.Tensor):
+                    fields[name] = torch.cat([v[s] for v, s in zip(values, slices)])
+                else:
+                    fields[name] = [x for v, s in zip(values, slices) for x in list(v)[s]]
+            elif (name == "batch_size") and (value == original_batch_size):
+                fields[name] = batch_size
+            else:
+                fields[name] = value
+
+        data_sources[data_source_name] = type(data_source)(**fields)
+
+    return BatchML(**data_sources)
+
+
+def rechunk_batches(
+    dataloader: Iterator[Union[Batch, BatchML, dict]],
+    n_batches: int,
+    n_gsps: int,
+    inference_batch_size: Optional[int] = None,
+) -> Iterator[Tuple[Union[Batch, BatchML, dict], int]]:
+    """
+    Re-chunk the data batches into inference batches, without the padding
+
+    Args:
+        dataloader: iterator of the data batches, 'n_batches' are taken from this
+        n_batches: the number of data batches
+        n_gsps: the number of gsps, any examples after this are padding
+        inference_batch_size: the number of examples in each inference batch.
+            Defaults to the size of the data batches.
+
+    Returns: iterator of (batch, n_examples), where all the examples are used
+    """
+    batch_slices, n_examples, n_examples_done = [], 0, 0
+    for i in range(n_batches):
+        batch = next(dataloader)
+        batch_size = get_batch_size(batch)
+        if inference_batch_size is None:
+            inference_batch_size = batch_size
+
+        # don't use the padding at the end of the last batch
+        n_examples_in_batch = min(n_gsps - n_examples_done, batch_size)
+        n_examples_done += n_examples_in_batch
+
+        start = 0
+        while start < n_examples_in_batch:
+            end = min(n_examples_in_batch, start + inference_batch_size - n_examples)
+            batch_slices.append((batch, start, end))
+            n_examples += end - start
+            start = end
+
+            if n_examples == inference_batch_size:
+                yield concatenate_batches(batch_slices), n_examples
+                batch_slices, n_examples = [], 0
+
+    if n_examples > 0:
+        yield concatenate_batches(batch_slices), n_examples
@@ -8,14 +8,14 @@
 
 
 import logging
-import os
-from datetime import timedelta, timezone
 from typing import Optional, Union
 
+import numpy as np
 import pandas as pd
 from nowcasting_dataloader.batch import BatchML
 
-import nowcasting_forecast
+from nowcasting_forecast.capacity import get_capacity_store
+from nowcasting_forecast.models.utils import make_results_df
 
 logger = logging.getLogger(__name__)
 
@@ -39,53 +39,33 @@ def cnn_run_one_batch(
     # run model
     predictions = pytorch_model(batch)
 
-    # re-normalize
-    # load capacity
-    capacity = pd.read_csv(
-        os.path.join(os.path.dirname(nowcasting_forecast.__file__), "data", "gsp_capacity.csv"),
-        index_col=["gsp_id"],
+    # re-normalize, with the capacity of each gsp at its t0
+    capacity = get_capacity_store().get_capacity(
+        gsp_ids=batch.metadata.id, t0s=batch.metadata.t0_datetime_utc
     )
-    capacity = capacity.loc[batch.metadata.id]
 
     # multiply predictions by capacities
-    predictions = capacity.values * predictions.detach().cpu().numpy()
+    predictions = capacity[:, None] * predictions.detach().cpu().numpy()
 
     logger.debug(f"The maximum predictions is {predictions.max()}")
     logger.debug(f"The minimum predictions is {predictions.min()}")
 
-    forecasts = []
-    for i in range(batch.metadata.batch_size):
-        if i >= n_examples:
-            break
+    # t0 value, make sure its rounded down to the nearest 30 minutes
+    t0_datetimes_utc = pd.to_datetime(batch.metadata.t0_datetime_utc, utc=True).ceil("30T")
 
-        # get id from location
-        gsp_id = batch.metadata.id[i]
-
-        # t0 value, make sure its rounded down to the nearest 30 minutes
-        t0_datetime_utc = pd.Timestamp(
-            batch.metadata.t0_datetime_utc[i].replace(tzinfo=timezone.utc)
-        ).ceil("30T")
-
-        # its 12.32, t0 will be 12.30 and the predictions will be for 13.00
-        if t0_datetime_utc.minute in [0, 30]:
-            t0_datetime_utc = t0_datetime_utc + timedelta(minutes=30)
-
-        if i == 0:
-            logger.debug(f"The first target_time will be {t0_datetime_utc}")
-
-        for t_index in range(len(predictions[0])):
-            # add timezone
-            target_time = t0_datetime_utc + timedelta(minutes=30) * t_index
+    # its 12.32, t0 will be 12.30 and the predictions will be for 13.00
+    t0_datetimes_utc += pd.to_timedelta(
+        np.where(t0_datetimes_utc.minute.isin([0, 30]), 30, 0), unit="minutes"
+    )
 
-            forecasts.append(
-                dict(
-                    t0_datetime_utc=t0_datetime_utc,
-                    target_datetime_utc=target_time,
-                    forecast_gsp_pv_outturn_mw=float(predictions[i, t_index]),
-                    gsp_id=gsp_id,
-                )
-            )
+    logger.debug(f"The first target_time will be {t0_datetimes_utc[0]}")
 
-    forecasts = pd.DataFrame(forecasts)
+    forecasts = make_results_df(
+        predictions=predictions,
+        gsp_ids=batch.metadata.id,
+        t0_datetimes_utc=t0_datetimes_utc,
+        horizon_minutes=30 * np.arange(predictions.shape[1]),
+        n_examples=n_examples,
+    )
 
     return forecasts
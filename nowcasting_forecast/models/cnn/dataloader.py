@@ -1,12 +1,18 @@
 """Dataloader for the CNN forecaster"""
 import logging
 import os
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
+import fsspec
+import numpy as np
+from nowcasting_dataloader.batch import BatchML
 from nowcasting_dataloader.datasets import NetCDFDataset
-from nowcasting_dataset.config.load import load_yaml_configuration
+from nowcasting_dataset.dataset.batch import Batch
 
 import nowcasting_forecast
+from nowcasting_forecast.models import xr_utils  # noqa: F401, makes the tensors without copying
+from nowcasting_forecast.profiling import stage
+from nowcasting_forecast.utils import load_configuration
 
 logger = logging.getLogger(__name__)
 
@@ -17,21 +23,33 @@ def get_cnn_data_loader(
     src_path: Optional[str] = None,
     tmp_path: Optional[str] = None,
     batch_save_dir: Optional[str] = None,
+    batches: Optional[Iterable[Batch]] = None,
 ):
     """
     Get data laoder for cnn model
 
     configuration_file:
+    batches: Optional batches already in memory. If given, these are used instead of
+        loading batches from 'src_path'
     """
     logger.debug("Making CNN data loader")
 
+    save_first_batch = (
+        os.path.join(batch_save_dir, "batchml", "batchml_0.npy")
+        if batch_save_dir is not None
+        else None
+    )
+
+    if batches is not None:
+        return iterate_batch_ml(batches=batches, save_first_batch=save_first_batch)
+
     # make configuration
     if configuration_file is None:
         configuration_file = os.path.join(
             os.path.dirname(nowcasting_forecast.__file__), "config", "mvp_v2.yaml"
         )
 
-    configuration = load_yaml_configuration(filename=configuration_file)
+    configuration = load_configuration(filename=configuration_file)
 
     if src_path is None:
         src_path = configuration.output_data.filepath / "live"
@@ -44,11 +62,37 @@ def get_cnn_data_loader(
         tmp_path=tmp_path,
         configuration=configuration,
         mix_two_batches=False,
-        save_first_batch=os.path.join(batch_save_dir, "batchml", "batchml_0.npy")
-        if batch_save_dir is not None
-        else None,
+        save_first_batch=save_first_batch,
     )
 
     logger.debug("Done making CNN data loader.")
 
     return iter(data_loader)
+
+
+def iterate_batch_ml(
+    batches: Iterable[Batch], save_first_batch: Optional[str] = None
+) -> Iterator[BatchML]:
+    """
+    Change batches in memory to normalized ML batches
+
+    This is the same as NetCDFDataset does after it has loaded a batch from disk.
+
+    Args:
+        batches: batches in memory
+        save_first_batch: Option to save the first ML batch to disk
+
+    Returns: iterator of BatchML objects
+    """
+    for batch_idx, batch in enumerate(batches):
+        with stage("make_batch_ml"):
+            batch: BatchML = BatchML.from_batch(batch=batch)
+            batch.normalize()
+
+        if save_first_batch is not None and batch_idx == 0:
+            # Save out the dictionary to disk
+            np.save("tmp.npy", batch.dict())
+            fs = fsspec.open(save_first_batch).fs
+            fs.put("tmp.npy", save_first_batch)
+
+        yield batch
@@ -0,0 +1,320 @@
+""" Export the CNN model to TorchScript or ONNX, and run the exported model
+
+The eager model takes BatchML objects. The exported models take plain tensors,
+see 'Model.batch_to_tensors', and are traced from 'Model.forward_tensors'.
+
+The model can be exported with
+    python nowcasting_forecast/models/cnn/export.py --output-dir ./exported_model
+
+ONNX needs 'onnx' and 'onnxruntime' to be installed, e.g. with 'pip install -e .[onnx]'.
+"""
+import logging
+import os
+import tempfile
+from typing import Optional, Sequence, Tuple, Union
+
+import click
+import numpy as np
+import torch
+from nowcasting_dataloader.batch import BatchML
+from nowcasting_dataset.config.load import load_yaml_configuration
+from pytorch_lightning.core.module import _jit_is_scripting
+from torch import nn
+
+import nowcasting_forecast
+from nowcasting_forecast.models.cnn.model import Model
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ["eager", "torchscript", "onnxruntime"]
+
+# the names of the inputs of the exported model, in the order of 'Model.batch_to_tensors'
+INPUT_NAMES = [
+    "satellite",
+    "nwp",
+    "pv",
+    "gsp",
+    "gsp_id",
+    "sun_azimuth_angle",
+    "sun_elevation_angle",
+]
+OUTPUT_NAMES = ["gsp_yield"]
+
+TORCHSCRIPT_FILENAME = "model.pt"
+ONNX_FILENAME = "model.onnx"
+
+
+class TensorModel(nn.Module):
+    """
+    Wrap the model, so that calling it uses just tensors
+
+    Note lightning raises an error when 'trainer' is used outside of training, which tracing does,
+    so tracing is done with lightning's '_jit_is_scripting'.
+    """
+
+    def __init__(self, model: Model):
+        """Model to wrap"""
+        super().__init__()
+        self.model = model
+
+    def forward(self, *tensors: torch.Tensor) -> torch.Tensor:
+        """Forward pass, the tensors are in the order of 'INPUT_NAMES'"""
+        return self.model.forward_tensors(*tensors)
+
+
+def export_torchscript(model: Model, tensors: Sequence[torch.Tensor], filename: str):
+    """
+    Trace the model to TorchScript, and save it
+
+    Args:
+        model: the eager model
+        tensors: example inputs, from 'Model.batch_to_tensors'
+        filename: where to save the traced model
+    """
+    logger.info(f"Exporting model to TorchScript {filename}")
+    with torch.inference_mode(False), torch.no_grad(), _jit_is_scripting():
+        traced_model = torch.jit.trace(TensorModel(model.eval()), tuple(tensors))
+    torch.jit.save(traced_model, filename)
+
+
+def export_onnx(model: Model, tensors: Sequence[torch.Tensor], filename: str):
+    """
+    Export the model to ONNX, and save it
+
+    The batch dimension of the inputs and output is dynamic.
+
+    Args:
+        model: the eager model
+        tensors: example inputs, from 'Model.batch_to_tensors'
+        filename: where to save the onnx model
+    """
+    logger.info(f"Exporting model to ONNX {filename}")
+    dynamic_axes = {name: {0: "batch_size"} for name in INPUT_NAMES + OUTPUT_NAMES}
+    with torch.inference_mode(False), torch.no_grad(), _jit_is_scripting():
+        torch.onnx.export(
+            TensorModel(model.eval()),
+            tuple(tensors),
+            filename,
+            input_names=INPUT_NAMES,
+            output_names=OUTPUT_NAMES,
+            dynamic_axes=dynamic_axes,
+            dynamo=False,
+        )
+
+
+class TorchScriptBackend:
+    """
+    Run the model with TorchScript
+
+    This is called in the same way as the eager model, e.g. 'backend(batch)'.
+    If no file is given, the model is traced on the first batch.
+    """
+
+    def __init__(self, model: Optional[Model] = None, filename: Optional[str] = None):
+        """
+        TorchScript backend
+
+        Args:
+            model: the eager model, this is traced on the first batch
+            filename: optional TorchScript file, from 'export_torchscript'
+        """
+        self.model = model
+        self.filename = filename
+        self.traced_model = torch.jit.load(filename) if filename is not None else None
+
+    def __getstate__(self) -> dict:
+        """The traced model can not be pickled, so it is loaded or traced again after"""
+        return {"model": self.model, "filename": self.filename}
+
+    def __setstate__(self, state: dict):
+        """Load the traced model, if it was loaded from a file"""
+        self.__init__(**state)
+
+    def __call__(self, batch: Union[BatchML, dict]) -> torch.Tensor:
+        """Run the model on one batch"""
+        return self.run_tensors(Model.batch_to_tensors(batch))
+
+    def run_tensors(self, tensors: Sequence[torch.Tensor]) -> torch.Tensor:
+        """Run the model on the tensors from 'Model.batch_to_tensors'"""
+        if self.traced_model is None:
+            with tempfile.TemporaryDirectory() as temporary_dir:
+                filename = os.path.join(temporary_dir, TORCHSCRIPT_FILENAME)
+                export_torchscript(model=self.model, tensors=tensors, filename=filename)
+                self.traced_model = torch.jit.load(filename)
+
+        return self.traced_model(*tensors)
+
+
+class OnnxRuntimeBackend:
+    """
+    Run the model with ONNX Runtime, on the CPU
+
+    This is called in the same way as the eager model, e.g. 'backend(batch)'.
+    If no file is given, the model is exported to ONNX on the first batch.
+    """
+
+    def __init__(self, model: Optional[Model] = None, filename: Optional[str] = None):
+        """
+        ONNX Runtime backend
+
+        Args:
+            model: the eager model, this is exported on the first batch
+            filename: optional ONNX file, from 'export_onnx'
+        """
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is needed for the onnxruntime backend")
+
+        self.model = model
+        self.filename = filename
+        self.session = self.make_session(filename) if filename is not None else None
+
+    def __getstate__(self) -> dict:
+        """The session can not be pickled, so it is made again after"""
+        return {"model": self.model, "filename": self.filename}
+
+    def __setstate__(self, state: dict):
+        """Make the session, if it was made from a file"""
+        self.__init__(**state)
+
+    @staticmethod
+    def make_session(filename: str) -> "onnxruntime.InferenceSession":
+        """Make an ONNX Runtime session, using the torch intra op threads"""
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        return onnxruntime.InferenceSession(
+            filename, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, batch: Union[BatchML, dict]) -> torch.Tensor:
+        """Run the model on one batch"""
+        return self.run_tensors(Model.batch_to_tensors(batch))
+
+    def run_tensors(self, tensors: Sequence[torch.Tensor]) -> torch.Tensor:
+        """Run the model on the tensors from 'Model.batch_to_tensors'"""
+        if self.session is None:
+            with tempfile.TemporaryDirectory() as temporary_dir:
+                filename = os.path.join(temporary_dir, ONNX_FILENAME)
+                export_onnx(model=self.model, tensors=tensors, filename=filename)
+                self.session = self.make_session(filename)
+
+        inputs = {
+            name: tensor.detach().cpu().numpy()
+            for name, tensor in zip(INPUT_NAMES, tensors)
+            if name in self.input_names
+        }
+        (predictions,) = self.session.run(OUTPUT_NAMES, inputs)
+
+        return torch.from_numpy(predictions)
+
+    @property
+    def input_names(self):
+        """The inputs the onnx model uses, inputs that are not used are dropped by the export"""
+        return [node.name for node in self.session.get_inputs()]
+
+
+def is_backend_available(backend: str) -> bool:
+    """If the packages that the backend needs are installed"""
+    return (backend != "onnxruntime") or (onnxruntime is not None)
+
+
+def make_backend(
+    model: Model, backend: str = "eager", filename: Optional[str] = None
+) -> Union[Model, TorchScriptBackend, OnnxRuntimeBackend]:
+    """
+    Get the model, to be run with a backend
+
+    Args:
+        model: the eager model
+        backend: one of 'eager', 'torchscript' or 'onnxruntime'
+        filename: optional exported model, otherwise the model is exported on the first batch
+
+    Returns: something that can be called with a batch, in the same way as the eager model
+    """
+    if backend == "eager":
+        return model
+    elif not hasattr(model, "forward_tensors"):
+        raise NotImplementedError(
+            f"Backend {backend} needs 'forward_tensors', which {type(model).__name__} does not have"
+        )
+    elif backend == "torchscript":
+        return TorchScriptBackend(model=model, filename=filename)
+    elif backend == "onnxruntime":
+        return OnnxRuntimeBackend(model=model, filename=filename)
+    else:
+        raise NotImplementedError(
+            f"Backend {backend} has not be implemented, use one of {BACKENDS}"
+        )
+
+
+def make_example_tensors(configuration_file: Optional[str] = None) -> Tuple[torch.Tensor, ...]:
+    """Make example inputs from a fake batch, with the shapes from the configuration"""
+    if configuration_file is None:
+        configuration_file = os.path.join(
+            os.path.dirname(nowcasting_forecast.__file__), "config", "mvp_v2.yaml"
+        )
+    configuration = load_yaml_configuration(filename=configuration_file)
+
+    return Model.batch_to_tensors(BatchML.fake(configuration=configuration))
+
+
+@click.command()
+@click.option(
+    "--output-dir",
+    default="./exported_model",
+    help="The directory to save the exported models to",
+    type=click.STRING,
+)
+@click.option(
+    "--export-format",
+    "export_formats",
+    default=["torchscript", "onnx"],
+    multiple=True,
+    help="The format to export, can be given several times",
+    type=click.Choice(["torchscript", "onnx"]),
+)
+@click.option(
+    "--use-hf",
+    default=True,
+    help="Load the weights from Hugging Face, otherwise random weights are used",
+    type=click.BOOL,
+)
+def main(output_dir: str, export_formats, use_hf: bool):
+    """Export the CNN model, and check the exported models give the same predictions"""
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = Model()
+    if use_hf:
+        model = model.load_model(use_hf=True)
+    model = model.eval()
+
+    tensors = make_example_tensors()
+    with torch.no_grad():
+        predictions = model.forward_tensors(*tensors).numpy()
+
+    for export_format in export_formats:
+        if export_format == "torchscript":
+            filename = os.path.join(output_dir, TORCHSCRIPT_FILENAME)
+            export_torchscript(model=model, tensors=tensors, filename=filename)
+            backend = TorchScriptBackend(filename=filename)
+        else:
+            filename = os.path.join(output_dir, ONNX_FILENAME)
+            export_onnx(model=model, tensors=tensors, filename=filename)
+            backend = OnnxRuntimeBackend(filename=filename)
+
+        with torch.no_grad():
+            exported_predictions = backend.run_tensors(tensors).numpy()
+        max_difference = np.abs(exported_predictions - predictions).max()
+        logger.info(
+            f"Saved {filename}, the maximum difference to the eager model is {max_difference}"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -7,7 +7,7 @@ Default parameters are set from the trained model
 """
 
 import logging
-from typing import Optional, Union
+from typing import Dict, Optional, Tuple, Union
 
 import numpy as np
 import pytorch_lightning as pl
@@ -16,7 +16,9 @@ import torch.nn.functional as F
 from nowcasting_dataloader.batch import BatchML
 from torch import nn
 
+from nowcasting_forecast.models.cnn.nwp_cache import get_nwp_embedding_cache
 from nowcasting_forecast.models.hub import NowcastingModelHubMixin
+from nowcasting_forecast.models.store import get_hf_model_dir
 
 logging.basicConfig()
 _LOG = logging.getLogger(__name__)
@@ -103,6 +105,7 @@ class Model(pl.LightningModule, NowcastingModelHubMixin):
         self.live_satellite_images = live_satellite_images
         self.number_sat_channels = number_sat_channels
         self.image_size_pixels = image_size_pixels
+        self.nwp_image_size_pixels = nwp_image_size_pixels
         self.gsp_forecast_minutes = gsp_forecast_minutes
         self.gsp_history_minutes = gsp_history_minutes
         self.include_sun = include_sun
@@ -122,7 +125,6 @@ class Model(pl.LightningModule, NowcastingModelHubMixin):
         self.forecast_len_5 = self.forecast_minutes // 5
         self.number_of_pv_samples_per_batch = 128
         self.number_of_samples_per_batch = 32
-        self.batch_size = 32
 
         conv3d_channels = conv3d_channels
 
@@ -231,41 +233,79 @@ class Model(pl.LightningModule, NowcastingModelHubMixin):
         )
         self.save_hyperparameters()
 
+        # the NWP embeddings are cached between forecasts, if the cache is turned on,
+        # see 'nwp_cache.py'
+        self.nwp_embedding_cache = get_nwp_embedding_cache()
+
     def forward(self, batch: Union[BatchML, dict]):
         """
         Forward pass
+
+        The NWP embeddings are taken from the cache, if they are there.
+        """
+        if isinstance(batch, dict):
+            batch = BatchML(**batch)
+
+        tensors = self.batch_to_tensors(batch)
+
+        out_nwp = None
+        if self.include_nwp and (self.nwp_embedding_cache is not None):
+            out_nwp = self.nwp_embedding_cache.get_embeddings(
+                model=self, batch=batch, nwp_data=tensors[1], nwp_embedding=self.nwp_embedding
+            )
+
+        return self.forward_tensors(*tensors, out_nwp=out_nwp)
+
+    @staticmethod
+    def batch_to_tensors(batch: Union[BatchML, dict]) -> Tuple[torch.Tensor, ...]:
         """
+        Get the tensors that the model uses from the batch
 
+        These are in the order of the arguments of 'forward_tensors'.
+        """
         if isinstance(batch, dict):
             batch = BatchML(**batch)
 
-        sat_data = batch.satellite.data.float()
-        nwp_data = batch.nwp.data.float()
-        pv_data = batch.pv.pv_yield.float()
-        gsp_data = batch.gsp.gsp_yield.float()
+        return (
+            batch.satellite.data.float(),
+            batch.nwp.data.float(),
+            batch.pv.pv_yield.float(),
+            batch.gsp.gsp_yield.float(),
+            batch.gsp.gsp_id,
+            batch.sun.sun_azimuth_angle,
+            batch.sun.sun_elevation_angle,
+        )
+
+    def forward_tensors(
+        self,
+        sat_data: torch.Tensor,
+        nwp_data: torch.Tensor,
+        pv_data: torch.Tensor,
+        gsp_data: torch.Tensor,
+        gsp_id: torch.Tensor,
+        sun_azimuth_angle: torch.Tensor,
+        sun_elevation_angle: torch.Tensor,
+        out_nwp: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Forward pass, using just tensors
+
+        This has no python objects in it, so it can be traced to TorchScript or ONNX.
+        The NWP embeddings, from 'nwp_embedding', can be given as 'out_nwp',
+        then the NWP layers are not run.
+        """
 
         # ******************* Satellite imagery *************************
         # Shape: batch_size, channel, seq_length, height, width
         # sat_data = x.satellite.data.float()
         batch_size, n_chans, seq_len, height, width = sat_data.shape
 
-        if not self.include_future_satellite:
-            sat_data = sat_data[:, :, : self.history_len_5 + 1]
-
-        if self.live_satellite_images:
-            sat_data = sat_data[:, :, :-6]
+        # the first 'cnn_output_size_time' images, i.e. the history images, without the last
+        # 6 (30 minutes) for live images. This is the same if the batch only has these images
+        sat_data = sat_data[:, :, : self.cnn_output_size_time]
 
         # :) Pass data through the network :)
-        out = F.relu(self.sat_conv0(sat_data))
-        for i in range(0, self.number_of_conv3d_layers - 1):
-            layer = getattr(self, f"sat_conv{i + 1}")
-            out = F.relu(layer(out))
-
-        out = out.reshape(batch_size, self.cnn_output_size)
-
-        # Fully connected layers
-        out = F.relu(self.fc1(out))
-        out = F.relu(self.fc2(out))
+        out = self.satellite_embedding(sat_data)
         # which has shape (batch_size, 128)
 
         # add gsp yield
@@ -286,7 +326,9 @@ class Model(pl.LightningModule, NowcastingModelHubMixin):
         if self.include_pv_yield_history:
             # just take the first 128
             pv_yield_history = (
-                pv_data[:, : self.history_len_5 + 1, :128].nan_to_num(nan=0.0).float()
+                pv_data[:, : self.history_len_5 + 1, : self.number_of_pv_samples_per_batch]
+                .nan_to_num(nan=0.0)
+                .float()
             )
 
             pv_yield_history = pv_yield_history.reshape(
@@ -298,34 +340,24 @@ class Model(pl.LightningModule, NowcastingModelHubMixin):
 
         # *********************** NWP Data ************************************
         if self.include_nwp:
-            # shape: batch_size, n_chans, seq_len, height, width
-            # nwp_data = x.nwp.data.float()
-
-            print(nwp_data.shape)
-            out_nwp = F.relu(self.nwp_conv0(nwp_data))
-            for i in range(0, self.number_of_conv3d_layers - 1):
-                layer = getattr(self, f"nwp_conv{i + 1}")
-                out_nwp = F.relu(layer(out_nwp))
-
-            # fully connected layers
-            out_nwp = out_nwp.reshape(batch_size, self.nwp_cnn_output_size)
-            out_nwp = F.relu(self.nwp_fc1(out_nwp))
-            out_nwp = F.relu(self.nwp_fc2(out_nwp))
+            if out_nwp is None:
+                out_nwp = self.nwp_embedding(nwp_data)
 
             # join with other FC layer
             out = torch.cat((out, out_nwp), dim=1)
 
         # ********************** Embedding of PV system ID ********************
         if self.embedding_dem:
-            id = batch.gsp.gsp_id[0 : self.batch_size, 0]
+            # the first gsp id of each example, any number of examples can be used
+            id = gsp_id[:, 0]
 
-            id = id.type(torch.IntTensor)
+            id = id.long()
             id = id.to(out.device)
             id_embedding = self.pv_system_id_embedding(id)
             out = torch.cat((out, id_embedding), dim=1)
 
         if self.include_sun:
-            sun = torch.cat((batch.sun.sun_azimuth_angle, batch.sun.sun_elevation_angle), dim=1)
+            sun = torch.cat((sun_azimuth_angle, sun_elevation_angle), dim=1)
             out_sun = self.sun_fc1(sun)
             out = torch.cat((out, out_sun), dim=1)
 
@@ -337,6 +369,100 @@ class Model(pl.LightningModule, NowcastingModelHubMixin):
 
         return out
 
+    def satellite_embedding(self, sat_data: torch.Tensor) -> torch.Tensor:
+        """
+        Run the satellite layers, to get the satellite embedding of each example
+
+        Args:
+            sat_data: shape: batch_size, n_chans, seq_len, height, width.
+                These are the satellite images the model uses, see 'forward_tensors'
+
+        Returns: shape: batch_size, 128
+        """
+        out = F.relu(self.sat_conv0(sat_data))
+        for i in range(0, self.number_of_conv3d_layers - 1):
+            layer = getattr(self, f"sat_conv{i + 1}")
+            out = F.relu(layer(out))
+
+        out = out.reshape(sat_data.shape[0], self.cnn_output_size)
+
+        # Fully connected layers
+        out = F.relu(self.fc1(out))
+        out = F.relu(self.fc2(out))
+
+        return out
+
+    def nwp_embedding(self, nwp_data: torch.Tensor) -> torch.Tensor:
+        """
+        Run the NWP layers, to get the NWP embedding of each example
+
+        Args:
+            nwp_data: shape: batch_size, n_chans, seq_len, height, width
+
+        Returns: shape: batch_size, 128
+        """
+        out_nwp = F.relu(self.nwp_conv0(nwp_data))
+        for i in range(0, self.number_of_conv3d_layers - 1):
+            layer = getattr(self, f"nwp_conv{i + 1}")
+            out_nwp = F.relu(layer(out_nwp))
+
+        # fully connected layers
+        out_nwp = out_nwp.reshape(nwp_data.shape[0], self.nwp_cnn_output_size)
+        out_nwp = F.relu(self.nwp_fc1(out_nwp))
+        out_nwp = F.relu(self.nwp_fc2(out_nwp))
+
+        return out_nwp
+
+    def optimization_inputs(self) -> Dict[str, Tuple[torch.Tensor, ...]]:
+        """Example inputs of the methods that can be optimized, see 'optimize_model'"""
+        inputs = {
+            "satellite_embedding": (
+                torch.randn(
+                    2,
+                    self.number_sat_channels,
+                    self.cnn_output_size_time,
+                    self.image_size_pixels,
+                    self.image_size_pixels,
+                ),
+            )
+        }
+        if self.include_nwp:
+            inputs["nwp_embedding"] = (
+                torch.randn(
+                    2,
+                    self.number_nwp_channels,
+                    self.forecast_len_60 + self.history_len_60 + 1,
+                    self.nwp_image_size_pixels,
+                    self.nwp_image_size_pixels,
+                ),
+            )
+        return inputs
+
+    def input_slices(self) -> Dict[str, Dict[str, int]]:
+        """
+        The parts of each data source the model reads
+
+        For each data source, this is the number of time steps or systems, from the start of
+        each dimension, so the batches can be made with just these, see 'select_input_slices'.
+        """
+        return {
+            "satellite": {"time_index": self.cnn_output_size_time},
+            "pv": {
+                "time_index": self.history_len_5 + 1,
+                "id_index": self.number_of_pv_samples_per_batch,
+            },
+            "gsp": {
+                "time_index": self.gsp_history_length,
+                "id_index": self.number_of_samples_per_batch,
+            },
+        }
+
+    def close(self):
+        """Log how well the NWP embedding cache worked, and save it"""
+        if self.nwp_embedding_cache is not None:
+            self.nwp_embedding_cache.log_summary()
+            self.nwp_embedding_cache.save()
+
     def load_model(
         self,
         local_filename: Optional[str] = None,
@@ -344,13 +470,17 @@ class Model(pl.LightningModule, NowcastingModelHubMixin):
     ):
         """
         Load model weights
+
+        The Hugging Face model is kept in the local model store, so it is only downloaded
+        if it has changed, see 'nowcasting_forecast.models.store'.
         """
 
         if use_hf:
             # _LOG.debug('Loading mode from Hugging Face "openclimatefix/nowcasting_pvnet_v1" ')
             # model = Model.from_pretrained("openclimatefix/nowcasting_pvnet_v1")
             _LOG.debug('Loading mode from Hugging Face "openclimatefix/nowcasting_cnn_v5" ')
-            model = Model.from_pretrained("openclimatefix/nowcasting_cnn_v5")
+            model_dir = get_hf_model_dir(repo_id="openclimatefix/nowcasting_cnn_v5")
+            model = Model.from_pretrained(model_dir)
             _LOG.debug("Loading mode from Hugging Face: done")
             return model
         else:
@@ -0,0 +1,246 @@
+""" Cache of the NWP embeddings of the CNN model
+
+The NWP data only changes when a new NWP init time arrives, every few hours,
+but the forecasts are made every 30 minutes. So the NWP part of the CNN model, the 'nwp_conv'
+and 'nwp_fc' layers, is run on the same data for each gsp again and again.
+The output of these layers, the NWP embedding, is cached, keyed by
+(gsp id, NWP init time, first and last NWP target time, model version).
+
+- The cache is off, unless 'NWP_EMBEDDING_CACHE_SIZE' is set. It keeps at most this many
+  embeddings, the least recently used embeddings are dropped first.
+  Each embedding is 128 floats, i.e 512 bytes.
+- The model version is worked out again whenever the NWP weights change, e.g. when
+  'load_state_dict' is run, so embeddings from the old weights are not used.
+- If 'NWP_EMBEDDING_CACHE_FILE' is set, the cache is loaded from and saved to this file,
+  so it can be used by the next run of the app.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Hashable, List, Optional, Tuple
+
+import torch
+from nowcasting_dataloader.batch import BatchML
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10_000
+
+Key = Tuple[int, int, int, int, str]
+
+
+def get_model_version(model: nn.Module) -> str:
+    """
+    Get a version of the NWP part of the model, from its layers and weights
+
+    This changes if the weights change, or if the layers are quantized.
+    """
+    sha256 = hashlib.sha256()
+    for name, module in model.named_modules():
+        if name.startswith("nwp_"):
+            sha256.update(f"{name}:{type(module).__name__}".encode())
+            for parameter in module.parameters(recurse=False):
+                sha256.update(parameter.detach().cpu().numpy().tobytes())
+
+    return sha256.hexdigest()[:16]
+
+
+def get_weights_stamp(model: nn.Module) -> Hashable:
+    """
+    Get a quick stamp of the NWP layers and weights of the model
+
+    This changes if a layer or weight is replaced, or if a weight is changed in place,
+    e.g. by 'load_state_dict', as torch counts the in place changes of each tensor.
+    """
+    return tuple(
+        (name, type(module).__name__, id(parameter), parameter.data_ptr(), parameter._version)
+        for name, module in model.named_modules()
+        if name.startswith("nwp_")
+        for parameter in module.parameters(recurse=False)
+    )
+
+
+class NwpEmbeddingCache:
+    """
+    Least recently used cache of NWP embeddings
+
+    The hits, misses and an estimate of the time saved are recorded, see 'log_summary'.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, filename: Optional[str] = None):
+        """
+        NWP embedding cache
+
+        Args:
+            max_size: the largest number of embeddings to keep
+            filename: optional file to load the cache from, and save it to
+        """
+        self.max_size = max_size
+        self.filename = filename
+        self.embeddings: OrderedDict = OrderedDict()
+
+        self.n_hits = 0
+        self.n_misses = 0
+        self.miss_seconds = 0.0
+
+        # the weights stamp and version of each model, the version is only worked out again
+        # if the stamp changes
+        self.model_versions = weakref.WeakKeyDictionary()
+
+        if (filename is not None) and os.path.exists(filename):
+            self.load()
+
+    def __deepcopy__(self, memo):
+        """The cache is shared, e.g. with a quantized copy, as the keys have the model version"""
+        return self
+
+    def __getstate__(self) -> dict:
+        """The model versions are worked out again, after pickling"""
+        state = self.__dict__.copy()
+        del state["model_versions"]
+        return state
+
+    def __setstate__(self, state: dict):
+        """Unpickle the cache"""
+        self.__dict__.update(state)
+        self.model_versions = weakref.WeakKeyDictionary()
+
+    def __len__(self):
+        """The number of embeddings in the cache"""
+        return len(self.embeddings)
+
+    def make_keys(self, model: nn.Module, batch: BatchML) -> List[Key]:
+        """Make the key of each example in the batch"""
+        stamp = get_weights_stamp(model)
+        if self.model_versions.get(model, (None, None))[0] != stamp:
+            self.model_versions[model] = (stamp, get_model_version(model))
+        model_version = self.model_versions[model][1]
+
+        return [
+            (int(gsp_id), int(init_time), int(times[0]), int(times[-1]), model_version)
+            for gsp_id, init_time, times in zip(
+                batch.metadata.id, batch.nwp.init_time, batch.nwp.time
+            )
+        ]
+
+    def get_embeddings(
+        self,
+        model: nn.Module,
+        batch: BatchML,
+        nwp_data: torch.Tensor,
+        nwp_embedding: Callable[[torch.Tensor], torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Get the NWP embeddings of the batch, the ones that are not cached are worked out
+
+        Args:
+            model: the model, this is used for the model version
+            batch: the batch, used for the keys
+            nwp_data: the NWP data of the batch
+            nwp_embedding: function that makes the embeddings from the NWP data
+
+        Returns: the NWP embeddings, one for each example in the batch
+        """
+        keys = self.make_keys(model=model, batch=batch)
+
+        missing_index = [i for i, key in enumerate(keys) if key not in self.embeddings]
+        if len(missing_index) > 0:
+            start_time = time.perf_counter()
+            missing_embeddings = nwp_embedding(nwp_data[missing_index])
+            self.miss_seconds += time.perf_counter() - start_time
+
+            for i, embedding in zip(missing_index, missing_embeddings):
+                self.embeddings[keys[i]] = embedding.detach().clone()
+
+        self.n_misses += len(missing_index)
+        self.n_hits += len(keys) - len(missing_index)
+
+        embeddings = []
+        for key in keys:
+            self.embeddings.move_to_end(key)
+            embeddings.append(self.embeddings[key])
+
+        # drop the least recently used embeddings
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+        return torch.stack(embeddings)
+
+    def log_summary(self):
+        """Log the hit rate and an estimate of the time saved"""
+        n_lookups = self.n_hits + self.n_misses
+        if n_lookups == 0:
+            return
+
+        seconds_per_miss = self.miss_seconds / self.n_misses if self.n_misses > 0 else 0.0
+        logger.info(
+            f"NWP embedding cache: {self.n_hits} hits, {self.n_misses} misses "
+            f"({self.n_hits / n_lookups:.0%} hit rate), "
+            f"saved about {self.n_hits * seconds_per_miss:.3f} seconds, "
+            f"{len(self)} embeddings in the cache"
+        )
+
+    def load(self):
+        """Load the cache from the file"""
+        logger.debug(f"Loading NWP embedding cache from {self.filename}")
+        try:
+            saved = torch.load(self.filename, weights_only=True)
+            keys = [tuple(key) for key in saved["keys"]]
+            self.embeddings = OrderedDict(zip(keys, saved["embeddings"]))
+        except Exception as e:
+            logger.warning(f"Could not load NWP embedding cache {self.filename}: {e}")
+
+    def save(self):
+        """
+        Save the cache to the file
+
+        The embeddings already in the file are kept, as other processes may have added to it,
+        up to 'max_size' embeddings. The file is replaced in one go, so it is never half written.
+        """
+        if self.filename is None:
+            return
+
+        if os.path.exists(self.filename):
+            saved_embeddings = self.embeddings
+            self.load()
+            self.embeddings.update(saved_embeddings)
+            while len(self.embeddings) > self.max_size:
+                self.embeddings.popitem(last=False)
+
+        if len(self.embeddings) == 0:
+            return
+
+        logger.debug(f"Saving {len(self)} NWP embeddings to {self.filename}")
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+            torch.save(
+                {
+                    "keys": list(self.embeddings.keys()),
+                    "embeddings": torch.stack(list(self.embeddings.values())),
+                },
+                file,
+            )
+        os.replace(file.name, self.filename)
+
+
+@lru_cache()
+def get_nwp_embedding_cache() -> Optional[NwpEmbeddingCache]:
+    """
+    Get the NWP embedding cache of this process
+
+    The size and file are set by the 'NWP_EMBEDDING_CACHE_SIZE' and 'NWP_EMBEDDING_CACHE_FILE'
+    environment variables. The cache is off unless the size is set, e.g. to 'DEFAULT_CACHE_SIZE',
+    and then None is returned.
+    """
+    max_size = int(os.getenv("NWP_EMBEDDING_CACHE_SIZE", 0))
+    if max_size <= 0:
+        return None
+
+    return NwpEmbeddingCache(max_size=max_size, filename=os.getenv("NWP_EMBEDDING_CACHE_FILE"))
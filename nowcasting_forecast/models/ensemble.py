@@ -0,0 +1,383 @@
+""" Run several models on the same batches
+
+Each model has its own configuration, but the models mostly read the same data.
+Rather than making the batches once for each model, the batches are made once with the union
+of the configurations, and each model is given the data sources it reads from them.
+
+- The union configuration has each data source that any model reads. If two models read the
+  same data source with different history or forecast minutes, the longer ones are used,
+  and each model is given just the time steps of its own configuration.
+  In the same way, the most systems that any model reads are used, see 'get_input_slices'.
+  Any other difference, e.g. the channels, means the models can not share the batches.
+- The 'gsp' data source is always kept, as this gives the locations of the examples.
+- The forecasts of each model are saved under the model's own name, and they can be blended
+  into one more forecast, with a weight for each model, which is saved as 'blend'.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from nowcasting_datamodel.models import ForecastSQL
+from nowcasting_datamodel.read.read import get_model
+from nowcasting_dataset.config.model import Configuration
+from nowcasting_dataset.dataset.batch import Batch
+from sqlalchemy.orm import Session
+
+import nowcasting_forecast
+from nowcasting_forecast.batch import (
+    DATA_SOURCE_NAMES,
+    N_SYSTEMS_FIELDS,
+    InputSlices,
+    select_input_slices,
+)
+from nowcasting_forecast.models.batching import to_batch_object
+from nowcasting_forecast.models.registry import RegisteredModel
+from nowcasting_forecast.models.utils import convert_one_gsp_df_to_forecast_sql
+
+logger = logging.getLogger(__name__)
+
+BLEND_MODEL_NAME = "blend"
+
+# the data source settings that can be different between models, see 'merge_data_sources'
+TIME_WINDOW_FIELDS = ["history_minutes", "forecast_minutes"]
+
+
+def parse_model_names(model_name: str) -> List[str]:
+    """Get the model names from a comma separated list, e.g. 'cnn,nwp_simple_trained'"""
+    return [name.strip() for name in model_name.split(",") if name.strip() != ""]
+
+
+def parse_blend_weights(blend_weights: str) -> Dict[str, float]:
+    """
+    Get the blend weight of each model, from e.g. 'cnn:0.7,nwp_simple_trained:0.3'
+
+    The weights do not have to add up to 1, as they are normalised when blending.
+    """
+    weights = {}
+    for model_weight in blend_weights.split(","):
+        if model_weight.strip() == "":
+            continue
+        name, weight = model_weight.split(":")
+        weights[name.strip()] = float(weight)
+        if weights[name.strip()] <= 0:
+            raise ValueError(f"The blend weight of {name} must be more than 0, not {weight}")
+
+    return weights
+
+
+def make_union_configuration(
+    models: List[RegisteredModel], input_slices: Optional[Dict[str, InputSlices]] = None
+) -> Configuration:
+    """
+    Make the configuration for the batches of all the models
+
+    The rest of the configuration, e.g. the batch size, comes from the first model,
+    and this has to be the same for all the models.
+
+    Args:
+        models: the models
+        input_slices: optional parts of each data source each model reads, keyed by model name
+
+    Returns: configuration, with each data source that any of the models read
+    """
+    input_slices = input_slices or {}
+    configurations = [
+        model.get_configuration(input_slices=input_slices.get(model.name)) for model in models
+    ]
+    union = configurations[0].copy(deep=True)
+
+    for configuration, model in zip(configurations, models):
+        if configuration.process.batch_size != union.process.batch_size:
+            raise ValueError(
+                f"The batch size of {model.name} is {configuration.process.batch_size}, "
+                f"but the batch size of {models[0].name} is {union.process.batch_size}"
+            )
+
+    data_source_names = []
+    for data_source_name in DATA_SOURCE_NAMES:
+        data_sources = [
+            (model.name, getattr(configuration.input_data, data_source_name))
+            for configuration, model in zip(configurations, models)
+            if (data_source_name in model.data_sources)
+            and (getattr(configuration.input_data, data_source_name) is not None)
+        ]
+        if len(data_sources) > 0:
+            data_source = merge_data_sources(data_source_name, data_sources)
+        elif data_source_name == "gsp":
+            # the locations of the examples come from the gsp data source
+            data_source = union.input_data.gsp
+        else:
+            data_source = None
+        setattr(union.input_data, data_source_name, data_source)
+        if data_source is not None:
+            data_source_names.append(data_source_name)
+
+    logger.debug(
+        f"The batches of {[model.name for model in models]} need the data sources "
+        f"{data_source_names}"
+    )
+
+    return union
+
+
+def merge_data_sources(data_source_name: str, data_sources: List[tuple]):
+    """
+    Merge the configurations of one data source, from several models
+
+    Args:
+        data_source_name: the name of the data source, e.g. 'nwp'
+        data_sources: list of (model name, data source configuration)
+
+    Returns: the data source configuration, with the longest history and forecast minutes,
+        and the most systems
+    """
+    first_model_name, merged = data_sources[0]
+    merged = merged.copy(deep=True)
+
+    # the fields where the largest value of the models is used
+    max_fields = list(TIME_WINDOW_FIELDS)
+    if data_source_name in N_SYSTEMS_FIELDS:
+        max_fields.append(N_SYSTEMS_FIELDS[data_source_name])
+
+    for model_name, data_source in data_sources[1:]:
+        settings = data_source.dict(exclude=set(max_fields + ["log_level"]))
+        merged_settings = merged.dict(exclude=set(max_fields + ["log_level"]))
+        if settings != merged_settings:
+            different = [key for key in settings if settings[key] != merged_settings.get(key)]
+            raise ValueError(
+                f"{model_name} and {first_model_name} can not share batches, "
+                f"as their {data_source_name} data sources have different {different}"
+            )
+
+        for field in max_fields:
+            setattr(merged, field, max(getattr(merged, field), getattr(data_source, field)))
+
+    return merged
+
+
+def make_union_input_slices(
+    models: List[RegisteredModel],
+    input_slices: Dict[str, Optional[InputSlices]],
+    union_configuration: Configuration,
+) -> InputSlices:
+    """
+    Get the parts of each data source that the batches of all the models need
+
+    A data source is only sliced if every model that reads it has input slices for it,
+    and then the most of each dimension that any of these models reads is kept.
+    The time steps are only sliced if the models have the same time window as the union
+    configuration, otherwise the time steps of a model are not the first ones in the batch.
+
+    Args:
+        models: the models
+        input_slices: the parts of each data source each model reads, keyed by model name
+        union_configuration: the configuration the batches are made with
+
+    Returns: the input slices of the batches
+    """
+    union_input_slices = {}
+    for data_source_name in DATA_SOURCE_NAMES:
+        readers = [model for model in models if data_source_name in model.data_sources]
+        model_slices = [
+            (input_slices.get(model.name) or {}).get(data_source_name) for model in readers
+        ]
+        if (len(readers) == 0) or any(slices is None for slices in model_slices):
+            continue
+
+        dimensions = set.intersection(*[set(slices) for slices in model_slices])
+        slices = {
+            dimension: max(slices[dimension] for slices in model_slices)
+            for dimension in sorted(dimensions)
+        }
+
+        union_window = get_time_window(union_configuration, data_source_name)
+        if any(
+            get_time_window(model.get_configuration(), data_source_name) != union_window
+            for model in readers
+        ):
+            slices.pop("time_index", None)
+
+        if len(slices) > 0:
+            union_input_slices[data_source_name] = slices
+
+    return union_input_slices
+
+
+def select_model_inputs(
+    batch: Union[Batch, dict],
+    model: RegisteredModel,
+    configuration: Configuration,
+    union_configuration: Configuration,
+    input_slices: Optional[InputSlices] = None,
+) -> Batch:
+    """
+    Get the inputs of one model, from a batch made with the union configuration
+
+    Only the data sources the model reads are kept. Where the union configuration has longer
+    history or forecast minutes than the model's configuration, the time steps are cut down
+    to the model's. Then just the 'input_slices' of each data source are kept.
+
+    Args:
+        batch: batch made with the union configuration
+        model: the model
+        configuration: the model's configuration
+        union_configuration: the configuration the batch was made with
+        input_slices: optional parts of each data source the model reads
+
+    Returns: batch with just the model's inputs
+    """
+    batch = to_batch_object(batch)
+    t0s = np.array(
+        [location.t0_datetime_utc for location in batch.metadata.space_time_locations],
+        dtype="datetime64[ns]",
+    )
+
+    data_sources = {}
+    for data_source_name in model.data_sources:
+        data_source = getattr(batch, data_source_name)
+        if data_source is None:
+            continue
+
+        model_window = get_time_window(configuration, data_source_name)
+        if model_window != get_time_window(union_configuration, data_source_name):
+            data_source = select_time_steps(
+                data_source=data_source,
+                t0s=t0s,
+                history_minutes=model_window[0],
+                forecast_minutes=model_window[1],
+            )
+        if data_source_name in (input_slices or {}):
+            data_source = select_input_slices(
+                data_source=data_source, input_slices=input_slices[data_source_name]
+            )
+        data_sources[data_source_name] = data_source
+
+    return Batch(metadata=batch.metadata, **data_sources)
+
+
+def get_time_window(configuration: Configuration, data_source_name: str) -> tuple:
+    """Get the history and forecast minutes of a data source, or None if it is not configured"""
+    data_source = getattr(configuration.input_data, data_source_name)
+    if data_source is None:
+        return None
+    return tuple(getattr(data_source, field) for field in TIME_WINDOW_FIELDS)
+
+
+def select_time_steps(data_source, t0s: np.ndarray, history_minutes: int, forecast_minutes: int):
+    """
+    Select the time steps from 't0 - history_minutes' to 't0 + forecast_minutes'
+
+    Data sources round the start and end out to their own time steps, e.g. to the hour for NWP,
+    so a time step is kept if it is less than one time step outside of this window.
+
+    Args:
+        data_source: the data of one data source, with 'time' for each example and time index
+        t0s: the t0 of each example
+        history_minutes: the history of the model
+        forecast_minutes: the forecast of the model
+
+    Returns: the data source with only the time steps the model needs
+    """
+    times = data_source.time.values
+    if times.shape[1] < 2:
+        return data_source
+
+    time_step = np.min(np.diff(times[0]))
+    offsets = times - t0s[:, None]
+    in_window = (offsets > -np.timedelta64(history_minutes, "m") - time_step) & (
+        offsets < np.timedelta64(forecast_minutes, "m") + time_step
+    )
+    time_indexes = np.flatnonzero(in_window.all(axis=0))
+    if len(time_indexes) == times.shape[1]:
+        return data_source
+
+    data = data_source.isel(time_index=time_indexes)
+    data.__setitem__("time_index", range(0, len(time_indexes)))
+
+    return type(data_source)(data)
+
+
+def iterate_model_inputs(
+    batches: Iterable[Union[Batch, dict]],
+    model: RegisteredModel,
+    union_configuration: Configuration,
+    input_slices: Optional[InputSlices] = None,
+) -> Iterator[Batch]:
+    """Get the inputs of one model from each batch, see 'select_model_inputs'"""
+    configuration = model.get_configuration(input_slices=input_slices)
+    for batch in batches:
+        yield select_model_inputs(
+            batch=batch,
+            model=model,
+            configuration=configuration,
+            union_configuration=union_configuration,
+            input_slices=input_slices,
+        )
+
+
+def blend_forecasts(
+    forecasts: Dict[str, List[ForecastSQL]],
+    weights: Dict[str, float],
+    session: Session,
+    model_name: str = BLEND_MODEL_NAME,
+) -> List[ForecastSQL]:
+    """
+    Blend the forecasts of several models, with a weight for each model
+
+    For each gsp and target time, the weighted mean of the models with a forecast for that
+    time is used, so the weights are normalised over these models.
+
+    Args:
+        forecasts: the forecasts of each model, keyed by model name
+        weights: the weight of each model, keyed by model name
+        session: database session
+        model_name: the name the blended forecasts are saved under
+
+    Returns: the blended forecasts, one for each gsp, including the national forecast
+    """
+    missing_models = [name for name in weights if name not in forecasts]
+    if len(missing_models) > 0:
+        raise ValueError(f"There are blend weights for {missing_models}, but no forecasts")
+
+    logger.info(f"Blending the forecasts of {weights}")
+
+    locations, input_data_last_updated, rows = {}, None, []
+    for name, weight in weights.items():
+        for forecast in forecasts[name]:
+            gsp_id = forecast.location.gsp_id
+            locations.setdefault(gsp_id, forecast.location)
+            input_data_last_updated = forecast.input_data_last_updated
+            for forecast_value in forecast.forecast_values:
+                rows.append(
+                    (
+                        gsp_id,
+                        forecast_value.target_time,
+                        weight,
+                        weight * forecast_value.expected_power_generation_megawatts,
+                    )
+                )
+
+    results_df = pd.DataFrame(
+        rows, columns=["gsp_id", "target_datetime_utc", "weight", "weighted_mw"]
+    )
+    results_df = results_df.groupby(["gsp_id", "target_datetime_utc"], sort=False).sum()
+    results_df["forecast_gsp_pv_outturn_mw"] = results_df["weighted_mw"] / results_df["weight"]
+    results_df = results_df.reset_index()
+
+    model = get_model(name=model_name, version=nowcasting_forecast.__version__, session=session)
+    forecast_creation_time = datetime.now(tz=timezone.utc)
+
+    return [
+        convert_one_gsp_df_to_forecast_sql(
+            results_df_one_gsp=results_df_one_gsp,
+            gsp_id=gsp_id,
+            session=session,
+            input_data_last_updated=input_data_last_updated,
+            ml_model=model,
+            forecast_creation_time=forecast_creation_time,
+            location=locations[gsp_id],
+        )
+        for gsp_id, results_df_one_gsp in results_df.groupby("gsp_id", sort=False)
+    ]
@@ -3,15 +3,23 @@ Originally Taken from https://github.com/rwightman/
 
 https://github.com/rwightman/pytorch-image-models/
 blob/acd6c687fd1c0507128f0ce091829b233c8560b9/timm/models/hub.py
+
+The models are loaded without first making random weights, see '_from_pretrained'.
+'safetensors' files are used if 'safetensors' is installed and the model has one.
 """
 
 import json
 import logging
 import os
+import time
+from contextlib import contextmanager
 from functools import partial
+from itertools import chain
 
 import torch
 
+from nowcasting_forecast.profiling import get_peak_rss_mb, stage
+
 try:
     from huggingface_hub import cached_download, hf_hub_url
 
@@ -20,6 +28,13 @@ except ImportError:
     hf_hub_url = None
     cached_download = None
 
+try:
+    from safetensors.torch import load_file as load_safetensors_file
+    from safetensors.torch import save_file as save_safetensors_file
+except ImportError:
+    load_safetensors_file = None
+    save_safetensors_file = None
+
 from huggingface_hub import CONFIG_NAME, PYTORCH_WEIGHTS_NAME, ModelHubMixin, hf_hub_download
 
 MODEL_CARD_MARKDOWN = """---
@@ -73,9 +88,52 @@ Training data is EUMETSAT RSS imagery over the UK, on-the-ground PV data, and NW
 
 """
 
+SAFETENSORS_WEIGHTS_NAME = "model.safetensors"
+
 _logger = logging.getLogger(__name__)
 
 
+def load_state_dict(filename: str, map_location="cpu") -> dict:
+    """
+    Load a state dict, memory-mapping the file where possible
+
+    'safetensors' files, and pytorch files saved in the zip format (the default since torch 1.6),
+    are memory-mapped, so the file is not read into memory all at once.
+    Older pytorch files are read in the usual way.
+    """
+    if filename.endswith(".safetensors"):
+        return load_safetensors_file(filename, device=str(map_location))
+
+    try:
+        return torch.load(filename, map_location=map_location, mmap=True, weights_only=True)
+    except Exception as e:
+        _logger.debug(f"Could not memory-map {filename}, so loading it in the usual way: {e}")
+        return torch.load(filename, map_location=map_location)
+
+
+@contextmanager
+def no_weights():
+    """
+    Make modules on the 'meta' device, so no memory is used for their weights
+
+    The 'torch.nn.init' functions are skipped too, as there are no values to set,
+    and on the 'meta' device some of them are slow the first time they are used.
+    """
+    init_functions = {
+        name: getattr(torch.nn.init, name)
+        for name in dir(torch.nn.init)
+        if name.endswith("_") and not name.startswith("_")
+    }
+    try:
+        for name in init_functions:
+            setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        with torch.device("meta"):
+            yield
+    finally:
+        for name, function in init_functions.items():
+            setattr(torch.nn.init, name, function)
+
+
 class NowcastingModelHubMixin(ModelHubMixin):
     """
     HuggingFace ModelHubMixin containing specific adaptions for Nowcasting models
@@ -122,6 +180,10 @@ class NowcastingModelHubMixin(ModelHubMixin):
         path = os.path.join(save_directory, PYTORCH_WEIGHTS_NAME)
         model_to_save = self.module if hasattr(self, "module") else self
         torch.save(model_to_save.state_dict(), path)
+        if save_safetensors_file is not None:
+            path = os.path.join(save_directory, SAFETENSORS_WEIGHTS_NAME)
+            state_dict = {k: v.contiguous() for k, v in model_to_save.state_dict().items()}
+            save_safetensors_file(state_dict, path)
         # Save model config
         if save_config and model_to_save.hparams:
             self._save_config(model_to_save, save_directory)
@@ -141,17 +203,25 @@ class NowcastingModelHubMixin(ModelHubMixin):
         use_auth_token,
         map_location="cpu",
         strict=False,
+        low_memory=True,
         **model_kwargs,
     ):
+        """
+        Load the model from the hub, or a local directory
+
+        With 'low_memory', the model is made on the 'meta' device, so no memory is used for the
+        random weights, and then the loaded weights are used directly, without copying them.
+        Otherwise the model is made with random weights, which are then overwritten.
+        Both ways give the same model, the load time and peak memory are logged.
+        """
         map_location = torch.device(map_location)
+        start_time = time.perf_counter()
 
-        if os.path.isdir(model_id):
-            print("Loading weights from local directory")
-            model_file = os.path.join(model_id, PYTORCH_WEIGHTS_NAME)
-        else:
-            model_file = hf_hub_download(
-                repo_id=model_id,
-                filename=PYTORCH_WEIGHTS_NAME,
+        model_file = None
+        if low_memory and (load_safetensors_file is not None):
+            model_file = cls._get_model_file(
+                model_id,
+                SAFETENSORS_WEIGHTS_NAME,
                 revision=revision,
                 cache_dir=cache_dir,
                 force_download=force_download,
@@ -160,10 +230,91 @@ class NowcastingModelHubMixin(ModelHubMixin):
                 use_auth_token=use_auth_token,
                 local_files_only=local_files_only,
             )
-        model = cls(**model_kwargs["config"])
+        if model_file is None:
+            model_file = cls._get_model_file(
+                model_id,
+                PYTORCH_WEIGHTS_NAME,
+                revision=revision,
+                cache_dir=cache_dir,
+                force_download=force_download,
+                proxies=proxies,
+                resume_download=resume_download,
+                use_auth_token=use_auth_token,
+                local_files_only=local_files_only,
+                required=True,
+            )
+
+        with stage("load_weights"):
+            model = None
+            if low_memory:
+                model = cls._from_state_dict_low_memory(
+                    config=model_kwargs["config"],
+                    model_file=model_file,
+                    map_location=map_location,
+                    strict=strict,
+                )
+            if model is None:
+                model = cls(**model_kwargs["config"])
+                # this can be the safetensors file, so it is loaded in the same way
+                state_dict = load_state_dict(model_file, map_location=map_location)
+                model.load_state_dict(state_dict, strict=strict)
+            model.eval()
+
+        _logger.info(
+            f"Loaded {cls.__name__} weights from {os.path.basename(model_file)} "
+            f"in {time.perf_counter() - start_time:.2f} seconds "
+            f"({'low memory' if low_memory else 'random initialisation'}), "
+            f"peak memory {get_peak_rss_mb():.0f} MB"
+        )
+
+        return model
 
-        state_dict = torch.load(model_file, map_location=map_location)
-        model.load_state_dict(state_dict, strict=strict)
-        model.eval()
+    @staticmethod
+    def _get_model_file(model_id, filename, required=False, **hf_hub_download_kwargs):
+        """
+        Get the weights file from a local directory, or download it from the hub
+
+        If it is not 'required', None is returned when the file does not exist.
+        """
+        if os.path.isdir(model_id):
+            model_file = os.path.join(model_id, filename)
+            if (not required) and (not os.path.exists(model_file)):
+                return None
+            _logger.debug(f"Loading weights from local directory {model_file}")
+            return model_file
+
+        try:
+            return hf_hub_download(repo_id=model_id, filename=filename, **hf_hub_download_kwargs)
+        except Exception as e:
+            if required:
+                raise e
+            _logger.debug(f"Could not download {filename} from {model_id}: {e}")
+            return None
+
+    @classmethod
+    def _from_state_dict_low_memory(cls, config: dict, model_file: str, map_location, strict):
+        """
+        Make the model without random weights, and use the loaded weights directly
+
+        None is returned if some of the weights are not in the file, as these would be left
+        with no values, so the model has to be made with random weights instead.
+        """
+        with no_weights():
+            model = cls(**config)
+
+        state_dict = load_state_dict(model_file, map_location=map_location)
+        model.load_state_dict(state_dict, strict=strict, assign=True)
+
+        missing = [
+            name
+            for name, tensor in chain(model.named_parameters(), model.named_buffers())
+            if tensor.is_meta
+        ]
+        if len(missing) > 0:
+            _logger.warning(
+                f"{len(missing)} weights, e.g. {missing[0]}, are not in {model_file}, "
+                "so making the model with random weights"
+            )
+            return None
 
         return model
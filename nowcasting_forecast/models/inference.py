@@ -0,0 +1,255 @@
+""" Run pytorch models for inference
+
+The forward passes are run in inference mode, so no autograd graph is recorded
+and the activations of each layer are freed as soon as the next layer has used them.
+"""
+import logging
+import os
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+
+from nowcasting_forecast.models.quantization import (
+    DEFAULT_TOLERANCE_MW,
+    check_quantized_forecasts,
+    quantize_model,
+)
+from nowcasting_forecast.profiling import is_profiling, stage
+
+logger = logging.getLogger(__name__)
+
+
+def set_torch_threads(
+    intra_op_threads: Optional[int] = None, inter_op_threads: Optional[int] = None
+):
+    """
+    Set the number of threads torch uses
+
+    Args:
+        intra_op_threads: threads used inside one operation, e.g. a convolution.
+            Defaults to the 'TORCH_INTRA_OP_THREADS' environment variable, or torch's default.
+        inter_op_threads: threads used to run operations in parallel.
+            Defaults to the 'TORCH_INTER_OP_THREADS' environment variable, or torch's default.
+    """
+    if intra_op_threads is None:
+        intra_op_threads = os.getenv("TORCH_INTRA_OP_THREADS", None)
+    if inter_op_threads is None:
+        inter_op_threads = os.getenv("TORCH_INTER_OP_THREADS", None)
+
+    if (intra_op_threads is not None) and (int(intra_op_threads) != torch.get_num_threads()):
+        logger.debug(f"Setting torch intra op threads to {intra_op_threads}")
+        torch.set_num_threads(int(intra_op_threads))
+
+    if (inter_op_threads is not None) and (
+        int(inter_op_threads) != torch.get_num_interop_threads()
+    ):
+        # this can only be set once, before torch has run anything in parallel
+        try:
+            logger.debug(f"Setting torch inter op threads to {inter_op_threads}")
+            torch.set_num_interop_threads(int(inter_op_threads))
+        except RuntimeError as e:
+            logger.warning(f"Could not set torch inter op threads to {inter_op_threads}: {e}")
+
+
+class InferenceRunner:
+    """
+    Run a pytorch model for inference
+
+    This is called in the same way as the model, e.g. 'runner(batch)'.
+    The forward latency of each call is recorded.
+
+    The peak activation memory is only recorded with 'profile_memory', or when the run is
+    being profiled, as this needs a hook on every layer for each call.
+    It is estimated as the largest input plus output of any one layer,
+    as this is what has to be in memory at the same time in inference mode.
+
+    Input tensors can be made with 'input_tensor', which reuses the same buffer for each batch.
+    This is only needed for inputs that are changed before the model. The models in the app read
+    views of the batch, see 'xr_utils', so their inputs are not copied at all.
+    """
+
+    def __init__(
+        self,
+        model: Union[nn.Module, Callable],
+        intra_op_threads: Optional[int] = None,
+        inter_op_threads: Optional[int] = None,
+        profile_memory: bool = False,
+    ):
+        """
+        Inference runner
+
+        Args:
+            model: the pytorch model, or an exported model which is called in the same way
+            intra_op_threads: see 'set_torch_threads'
+            inter_op_threads: see 'set_torch_threads'
+            profile_memory: option to always record the peak activation memory
+        """
+        self.model = model.eval() if isinstance(model, nn.Module) else model
+        self.profile_memory = profile_memory
+        set_torch_threads(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+        self.buffers: Dict[str, torch.Tensor] = {}
+        self.forward_seconds: List[float] = []
+        self.peak_activation_mb: List[float] = []
+
+    def input_tensor(
+        self, name: str, data: np.ndarray, dtype: torch.dtype = torch.float32
+    ) -> torch.Tensor:
+        """
+        Copy data into the input buffer called 'name', and return the buffer
+
+        The buffer is made the first time, or if the shape changes, and is then reused.
+        Note the buffer is overwritten by the next batch.
+        """
+        data = torch.as_tensor(data)
+
+        buffer = self.buffers.get(name)
+        if (buffer is None) or (buffer.shape != data.shape) or (buffer.dtype != dtype):
+            logger.debug(f"Making input buffer {name} with shape {tuple(data.shape)}")
+            buffer = torch.empty(data.shape, dtype=dtype)
+            self.buffers[name] = buffer
+
+        return buffer.copy_(data)
+
+    def __call__(self, *args, **kwargs) -> torch.Tensor:
+        """Run the model forward, in inference mode"""
+
+        peak_activation_bytes = [0]
+
+        def record_activation(module, inputs, output):
+            outputs = output if isinstance(output, (tuple, list)) else (output,)
+            tensors = [t for t in (*inputs, *outputs) if isinstance(t, torch.Tensor)]
+            activation_bytes = sum(t.element_size() * t.nelement() for t in tensors)
+            peak_activation_bytes[0] = max(peak_activation_bytes[0], activation_bytes)
+
+        # only the layers with no children, so each activation is counted once.
+        # Exported models, e.g. onnx, have no layers we can see, so this is not recorded for them
+        profile_memory = self.profile_memory or is_profiling()
+        modules = (
+            self.model.modules() if (profile_memory and isinstance(self.model, nn.Module)) else []
+        )
+        hooks = [
+            module.register_forward_hook(record_activation)
+            for module in modules
+            if len(list(module.children())) == 0
+        ]
+
+        try:
+            with stage("forward"), torch.inference_mode():
+                start_time = time.perf_counter()
+                output = self.model(*args, **kwargs)
+                self.forward_seconds.append(time.perf_counter() - start_time)
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        self.peak_activation_mb.append(
+            peak_activation_bytes[0] / 1024**2 if len(hooks) > 0 else np.nan
+        )
+        message = (
+            f"Forward pass {len(self.forward_seconds)} took {self.forward_seconds[-1]:.3f} seconds"
+        )
+        if len(hooks) > 0:
+            message += f", with {self.peak_activation_mb[-1]:.1f} MB of activations"
+        logger.debug(message)
+
+        return output
+
+    def log_summary(self):
+        """Log the forward latency and peak activation memory over all the batches"""
+        if len(self.forward_seconds) == 0:
+            return
+
+        message = (
+            f"Ran {len(self.forward_seconds)} forward passes of {type(self.model).__name__}, "
+            f"mean {np.mean(self.forward_seconds):.3f} seconds, "
+            f"max {np.max(self.forward_seconds):.3f} seconds"
+        )
+        if not np.all(np.isnan(self.peak_activation_mb)):
+            message += f", peak activation memory {np.nanmax(self.peak_activation_mb):.1f} MB"
+
+        logger.info(message)
+
+    def close(self):
+        """Log the summary, and let the model tidy up, e.g. save its caches, if it can"""
+        self.log_summary()
+        if hasattr(self.model, "close"):
+            self.model.close()
+
+
+class BatchRunner:
+    """
+    Run the model on one batch at a time, in this process
+
+    The pytorch model, if there is one, is run with an 'InferenceRunner'.
+    With 'quantize', the first batch is also run with the quantized model,
+    and the quantized model is used for all the batches, including the first one, if its
+    forecasts are within 'quantize_tolerance_mw' of the float model,
+    see 'check_quantized_forecasts'. So the forecasts of one run are all from the same model.
+    """
+
+    def __init__(
+        self,
+        callable_function_for_on_batch: Callable,
+        model: Optional[Union[nn.Module, Callable]] = None,
+        quantize: bool = False,
+        quantize_tolerance_mw: float = DEFAULT_TOLERANCE_MW,
+    ):
+        """
+        Batch runner
+
+        Args:
+            callable_function_for_on_batch: function that makes the forecasts for one batch
+            model: optional pytorch model, this is passed to the function as 'pytorch_model'
+            quantize: option to use the quantized model, if it is accurate enough
+            quantize_tolerance_mw: see 'check_quantized_forecasts'
+        """
+        self.callable_function_for_on_batch = callable_function_for_on_batch
+        self.model = InferenceRunner(model=model) if model is not None else None
+        self.quantized_model = (
+            InferenceRunner(model=quantize_model(model))
+            if (quantize and (model is not None))
+            else None
+        )
+        self.quantize_tolerance_mw = quantize_tolerance_mw
+
+    def __call__(self, batch, n_examples: int) -> pd.DataFrame:
+        """Make the forecasts for one batch"""
+        callbacks_args = dict(batch=batch, n_examples=n_examples)
+        if self.model is not None:
+            callbacks_args["pytorch_model"] = self.model
+
+        with stage("run_batch"):
+            forecasts = self.callable_function_for_on_batch(**callbacks_args)
+
+        # check the quantized model on the first batch
+        if self.quantized_model is not None:
+            callbacks_args["pytorch_model"] = self.quantized_model
+            with stage("check_quantized_model"):
+                quantized_forecasts = self.callable_function_for_on_batch(**callbacks_args)
+            if check_quantized_forecasts(
+                float_forecasts=forecasts,
+                quantized_forecasts=quantized_forecasts,
+                tolerance_mw=self.quantize_tolerance_mw,
+            ):
+                self.model = self.quantized_model
+                forecasts = quantized_forecasts
+            self.quantized_model = None
+
+        return forecasts
+
+    def submit(self, batch, n_examples: int) -> Future:
+        """Make the forecasts for one batch, straight away. The future is already done"""
+        future = Future()
+        future.set_result(self(batch=batch, n_examples=n_examples))
+        return future
+
+    def close(self):
+        """Log the forward latency and memory of the model, and close it"""
+        if self.model is not None:
+            self.model.close()
@@ -7,24 +7,33 @@ Default parameters are set from the trained model
 
 
 import logging
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
-import fsspec
 import numpy as np
 import pytorch_lightning as pl
+import torch
 import torch.nn.functional as F
-from pathy import Pathy
 from torch import clip, nn
 
+from nowcasting_forecast.models.store import get_model_file
+
 logging.basicConfig()
 _LOG = logging.getLogger(__name__)
 
+# the normalization of the nwp data the model was trained with
+DSWRF_MEAN = 294.6696933986283
+DSWRF_STD = 233.1834250473355
+
 
 class Model(pl.LightningModule):
     """Simople cnn model for NWP data"""
 
     name = "conv3d_nwp"
 
+    # the normalization of the input of 'forward'. This is folded into 'nwp_conv0' when the model
+    # is loaded, see 'optimize_model', and is then None, as the model takes the data as it is
+    input_normalization: Optional[Tuple[float, float]] = (DSWRF_MEAN, DSWRF_STD)
+
     def __init__(
         self,
         forecast_minutes: int = 120,
@@ -75,6 +84,7 @@ class Model(pl.LightningModule):
         self.output_variable = output_variable
         self.number_nwp_channels = number_nwp_channels
         self.embedding_dem = embedding_dem
+        self.nwp_image_size_pixels = nwp_image_size_pixels
 
         self.history_len_60 = int(np.ceil(self.history_minutes / 60))
         self.forecast_len_60 = (
@@ -120,7 +130,8 @@ class Model(pl.LightningModule):
         self.fc3 = nn.Linear(in_features=fc3_in_features, out_features=self.fc3_output_features)
         self.fc4 = nn.Linear(in_features=self.fc3_output_features, out_features=self.forecast_len)
 
-        # not needed, but trained with these layers, so need to still init them
+        # not needed, but trained with these layers, so need to still init them.
+        # They are dropped when the model is optimized, see 'optimize_model'
         self.history_len_5 = int(np.ceil(self.history_minutes / 5))
         self.pv_fc1 = nn.Linear(
             in_features=128 * (6 + 1),
@@ -131,7 +142,7 @@ class Model(pl.LightningModule):
         )
 
     def forward(self, nwp_data):
-        """Pass data through model"""
+        """Pass data through model, the nwp data is normalized with 'DSWRF_MEAN' and 'DSWRF_STD'"""
         # shape: batch_size, n_chans, seq_len, height, width
         nwp_data = nwp_data.data.float()
         out_nwp = F.relu(self.nwp_conv0(nwp_data))
@@ -157,28 +168,29 @@ class Model(pl.LightningModule):
 
         return out
 
-    def load_model(
-        self, local_filename: Optional[str] = "./temp.ckpt", remote_filename: Optional[str] = None
-    ):
+    def optimization_inputs(self) -> Dict[str, Tuple[torch.Tensor, ...]]:
+        """Example inputs of the methods that can be optimized, see 'optimize_model'"""
+        nwp_data = torch.randn(
+            2,
+            self.number_nwp_channels,
+            self.forecast_len_60 + self.history_len_60 + 1,
+            self.nwp_image_size_pixels,
+            self.nwp_image_size_pixels,
+        )
+        return {"forward": (nwp_data,)}
+
+    def load_model(self, remote_filename: Optional[str] = None):
         """
         Load model weights
+
+        The weights are kept in the local model store, so they are only downloaded
+        if they have changed, see 'nowcasting_forecast.models.store'.
         """
         if remote_filename is None:
             remote_filename = "s3://nowcasting-ml-models-development/v1/predict_pv_yield_951.ckpt"
 
-        # download weights from s3
-        _LOG.debug(f"Downloading from {remote_filename} to {local_filename}")
-
-        remote_filename = Pathy(remote_filename)
-        filesystem = fsspec.open(remote_filename.parent).fs
-        try:
-            _LOG.debug(f"Copying file from {remote_filename} to {local_filename}")
-            filesystem.get_file(remote_filename, local_filename)
-        except FileNotFoundError as e:
-            _LOG.error(e)
-            message = f"Could not copy {remote_filename} to {local_filename}"
-            _LOG.error(message)
-            raise FileNotFoundError(message)
+        _LOG.debug(f"Getting model weights {remote_filename}")
+        local_filename = get_model_file(remote_filename=remote_filename)
 
         # load weights into model
         return self.load_from_checkpoint(checkpoint_path=local_filename)
@@ -8,16 +8,17 @@
 
 
 import logging
-import os
-from datetime import timedelta, timezone
 from typing import Optional, Union
 
+import numpy as np
 import pandas as pd
 import xarray as xr
 from nowcasting_dataset.dataset.batch import Batch
 
-import nowcasting_forecast
-from nowcasting_forecast.models.nwp_simple_trained.xr_utils import re_order_dims
+from nowcasting_forecast.capacity import get_capacity_store
+from nowcasting_forecast.models.inference import InferenceRunner
+from nowcasting_forecast.models.utils import make_results_df
+from nowcasting_forecast.models.xr_utils import NWP_DIMS, to_tensor
 
 logger = logging.getLogger(__name__)
 
@@ -41,33 +42,14 @@ def nwp_irradiance_simple_trained_run_one_batch(
     # run model
     predictions = nwp_irradiance_simple_trained(batch, model=pytorch_model)
 
-    forecasts = []
-    for i in range(batch.metadata.batch_size):
-        if i >= n_examples:
-            break
-
-        # get id from location
-        gsp_id = batch.metadata.space_time_locations[i].id
-
-        # t0 value value
-        t0_datetime_utc = batch.metadata.space_time_locations[i].t0_datetime_utc.replace(
-            tzinfo=timezone.utc
-        )
-
-        for t_index in range(len(predictions[0])):
-            # add timezone
-            target_time = t0_datetime_utc + timedelta(minutes=30) * (t_index + 1)
-
-            forecasts.append(
-                dict(
-                    t0_datetime_utc=t0_datetime_utc,
-                    target_datetime_utc=target_time,
-                    forecast_gsp_pv_outturn_mw=float(predictions[i, t_index]),
-                    gsp_id=gsp_id,
-                )
-            )
-
-    forecasts = pd.DataFrame(forecasts)
+    # the predictions start 30 minutes after t0
+    forecasts = make_results_df(
+        predictions=predictions,
+        gsp_ids=batch.metadata.ids,
+        t0_datetimes_utc=batch.metadata.t0_datetimes_utc,
+        horizon_minutes=30 * (np.arange(predictions.shape[1]) + 1),
+        n_examples=n_examples,
+    )
 
     return forecasts
 
@@ -80,33 +62,28 @@ def nwp_irradiance_simple_trained(batch: Batch, model) -> xr.DataArray:
     Returns a data array of nwp irradiance with dimensions for examples and time.
     """
 
-    nwp = batch.nwp
-
-    nwp = re_order_dims(nwp)
-
-    # move to torch
-    nwp_batch_ml = nwp.torch.to_tensor(["data", "time", "init_time", "x_osgb", "y_osgb"])
+    # run the model in inference mode
+    if not isinstance(model, InferenceRunner):
+        model = InferenceRunner(model=model)
 
-    nwp = nwp_batch_ml["data"]
+    # re-order dims to B,C,T,H,W, as a view of the batch
+    nwp = to_tensor(batch.nwp.data, dims=NWP_DIMS)
 
-    # normalize
-    dswrf_mean = 294.6696933986283
-    dswrf_std = 233.1834250473355
-    nwp = nwp - dswrf_mean
-    nwp = nwp / dswrf_std
+    # normalize, if this has not been folded into the model when it was loaded, see 'load_ml_model'
+    input_normalization = getattr(model.model, "input_normalization", None)
+    if input_normalization is not None:
+        mean, std = input_normalization
+        nwp = (nwp.float() - mean) / std
 
     # run model
     predictions = model(nwp)
 
-    # re-normalize
-    # load capacity
-    capacity = pd.read_csv(
-        os.path.join(os.path.dirname(nowcasting_forecast.__file__), "data", "gsp_capacity.csv"),
-        index_col=["gsp_id"],
+    # re-normalize, with the capacity of each gsp at its t0
+    capacity = get_capacity_store().get_capacity(
+        gsp_ids=batch.metadata.ids, t0s=batch.metadata.t0_datetimes_utc
     )
-    capacity = capacity.loc[batch.metadata.ids]
 
     # multiply predictions by capacities
-    predictions = capacity.values * predictions.detach().cpu().numpy()
+    predictions = capacity[:, None] * predictions.detach().cpu().numpy()
 
     return predictions
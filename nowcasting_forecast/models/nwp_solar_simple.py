@@ -1,12 +1,13 @@
 """ Simple model to take NWP irradence and make solar """
 import logging
-from datetime import timedelta, timezone
 from typing import Optional, Union
 
 import pandas as pd
 import xarray as xr
 from nowcasting_dataset.dataset.batch import Batch
 
+from nowcasting_forecast.models.utils import make_results_df
+
 logger = logging.getLogger(__name__)
 
 NAME = "nwp_simple"
@@ -28,32 +29,14 @@ def nwp_irradiance_simple_run_one_batch(
     # run model
     irradiance_mean = nwp_irradiance_simple(batch)
 
-    forecasts = []
-    for i in range(batch.metadata.batch_size):
-        if i >= n_examples:
-            break
-
-        # get id from location
-        gsp_id = batch.metadata.space_time_locations[i].id
-
-        # t0 value value
-        t0_datetime_utc = batch.metadata.space_time_locations[i].t0_datetime_utc.replace(
-            tzinfo=timezone.utc
-        )
-
-        for t_index in irradiance_mean.time_index:
-            target_time = t0_datetime_utc + timedelta(minutes=30) * t_index.values
-
-            forecasts.append(
-                dict(
-                    t0_datetime_utc=t0_datetime_utc,
-                    target_datetime_utc=target_time,
-                    forecast_gsp_pv_outturn_mw=float(irradiance_mean[i, t_index].values[0]),
-                    gsp_id=gsp_id,
-                )
-            )
-
-    forecasts = pd.DataFrame(forecasts)
+    # the first channel, for each example and time step
+    forecasts = make_results_df(
+        predictions=irradiance_mean.values[:, :, 0],
+        gsp_ids=batch.metadata.ids,
+        t0_datetimes_utc=batch.metadata.t0_datetimes_utc,
+        horizon_minutes=30 * irradiance_mean.time_index.values,
+        n_examples=n_examples,
+    )
 
     return forecasts
 
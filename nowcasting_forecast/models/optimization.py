@@ -0,0 +1,420 @@
+""" Optimize the pytorch models for inference, when they are loaded
+
+The methods of the model are traced with torch.fx, and their graphs are changed to do less work:
+- a constant normalization of the input, '(x - mean) / std', is folded into the weights and bias
+  of the Conv3d it goes into, so the input is not normalized first. This can be a normalization
+  in the model, or the normalization the model's input was trained with, 'input_normalization',
+  in which case the optimized 'forward' takes the input before it is normalized
+- each Conv3d followed by a relu is one layer, and the relu is done in place
+- if 'forward' is optimized, the layers it does not use are dropped, e.g. the layers the
+  nwp_simple_trained model was trained with, which are only kept to load the checkpoint
+
+The model says which methods can be optimized with 'optimization_inputs', which gives example
+inputs for each method. The optimized methods are checked against the model on these inputs,
+and the model is only optimized if their outputs are the same, to within floating point rounding.
+Note the changed layers should only be called from these methods.
+"""
+import copy
+import logging
+import operator
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.fx
+import torch.nn.functional as F
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+# the tolerances for the outputs of the optimized model, the folded normalization
+# changes the floating point rounding a little
+RTOL = 1e-4
+ATOL = 1e-5
+
+RELU_FUNCTIONS = [F.relu, torch.relu]
+
+
+class FusedConv3d(nn.Conv3d):
+    """
+    Conv3d, with the relu after it and the normalization of its input folded in
+
+    The normalized input was padded with zeros, which is the mean of the input before it is
+    normalized, so when the normalization is folded in, the input is padded with the mean.
+    """
+
+    def __init__(self, *args, relu: bool = False, **kwargs):
+        """Conv3d, with the option of doing the relu after it"""
+        super().__init__(*args, **kwargs)
+        self.relu = relu
+        self.input_mean: Optional[float] = None
+        self.input_padding: Tuple[int, ...] = ()
+
+    @classmethod
+    def from_conv(
+        cls,
+        conv: nn.Conv3d,
+        relu: bool = False,
+        mean: Optional[float] = None,
+        std: Optional[float] = None,
+    ) -> "FusedConv3d":
+        """
+        Make the fused layer from a Conv3d
+
+        Args:
+            conv: the Conv3d, this is not changed, and its weights are used if there is
+                no normalization to fold in
+            relu: option to do the relu after the convolution
+            mean: the mean the input is normalized with
+            std: the standard deviation the input is normalized with
+
+        Returns: fused layer
+        """
+        if (conv.padding_mode != "zeros") or isinstance(conv.padding, str):
+            raise NotImplementedError(
+                f"Only Conv3d layers with zero padding can be fused, not {conv.padding_mode}"
+            )
+
+        # the layers are small, so it does not matter that the weights are initialized first
+        fused = cls(
+            in_channels=conv.in_channels,
+            out_channels=conv.out_channels,
+            kernel_size=conv.kernel_size,
+            stride=conv.stride,
+            padding=conv.padding if mean is None else 0,
+            dilation=conv.dilation,
+            groups=conv.groups,
+            bias=(conv.bias is not None) or (mean is not None),
+            relu=relu,
+        )
+
+        if mean is None:
+            fused.weight = conv.weight
+            fused.bias = conv.bias
+            return fused
+
+        # conv((x - mean) / std) = conv(x) / std - mean * sum(weights) / std
+        with torch.no_grad():
+            weight = conv.weight / std
+            bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels)
+            bias = bias - mean * weight.sum(dim=(1, 2, 3, 4))
+
+        fused.weight = nn.Parameter(weight, requires_grad=False)
+        fused.bias = nn.Parameter(bias, requires_grad=False)
+        fused.input_mean = float(mean)
+        # F.pad takes the padding of the last dimension first
+        fused.input_padding = tuple(p for p in reversed(conv.padding) for _ in range(2))
+
+        return fused
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward pass"""
+        if self.input_mean is not None:
+            x = F.pad(x, self.input_padding, value=self.input_mean)
+
+        out = self._conv_forward(x, self.weight, self.bias)
+        return torch.relu_(out) if self.relu else out
+
+    def extra_repr(self) -> str:
+        """Show the fusions when the model is printed"""
+        return f"{super().extra_repr()}, relu={self.relu}, input_mean={self.input_mean}"
+
+
+class OptimizedMethod:
+    """
+    A method of the model, run from its optimized graph
+
+    The layers are looked up on the model when it is called, so this still works
+    when the model is copied or its layers are changed, e.g. when it is quantized.
+    """
+
+    def __init__(self, model: nn.Module, graph: torch.fx.Graph):
+        """
+        Optimized method
+
+        Args:
+            model: the model, this is 'self' in the method
+            graph: the optimized graph of the method
+        """
+        self.model = model
+        self.graph = graph
+        self.compile()
+
+    def compile(self):
+        """Make the python function from the graph"""
+        python_code = self.graph.python_code(root_module="self")
+        function_globals = dict(python_code.globals)
+        exec(python_code.src, function_globals)
+        self.function = function_globals["forward"]
+
+    def __getstate__(self) -> dict:
+        """The function can not be pickled, so it is made again from the graph"""
+        return {"model": self.model, "graph": self.graph}
+
+    def __setstate__(self, state: dict):
+        """Make the function again"""
+        self.__dict__.update(state)
+        self.compile()
+
+    def __call__(self, *args, **kwargs):
+        """Run the method"""
+        return self.function(self.model, *args, **kwargs)
+
+
+def trace_method(model: nn.Module, name: str) -> torch.fx.Graph:
+    """Trace one method of the model to a graph"""
+    tracer = torch.fx.Tracer()
+    tracer.traced_func_name = name
+    return tracer.trace(model)
+
+
+def is_relu(node: torch.fx.Node) -> bool:
+    """If the node is a relu, that is not in place"""
+    if node.op == "call_function" and node.target in RELU_FUNCTIONS:
+        return not node.kwargs.get("inplace", False)
+    return node.op == "call_method" and node.target == "relu"
+
+
+def get_normalization(node: torch.fx.Node) -> Optional[Tuple[torch.fx.Node, float, float]]:
+    """
+    Get the normalization '(x - mean) / std' that makes the node, if it is one
+
+    Returns: the input 'x', mean and std, or None
+    """
+    if not (
+        isinstance(node, torch.fx.Node)
+        and node.op == "call_function"
+        and node.target == operator.truediv
+        and isinstance(node.args[1], (int, float))
+        and len(node.users) == 1
+    ):
+        return None
+
+    sub = node.args[0]
+    if not (
+        isinstance(sub, torch.fx.Node)
+        and sub.op == "call_function"
+        and sub.target == operator.sub
+        and isinstance(sub.args[1], (int, float))
+        and len(sub.users) == 1
+    ):
+        return None
+
+    return sub.args[0], float(sub.args[1]), float(node.args[1])
+
+
+def is_shape(node: torch.fx.Node) -> bool:
+    """If the node is just the shape of its input, e.g. 'x.shape' or 'x.size()'"""
+    if node.op == "call_function" and node.target == getattr:
+        return node.args[1] == "shape"
+    return node.op == "call_method" and node.target == "size"
+
+
+def normalize_input(graph: torch.fx.Graph, mean: float, std: float) -> List[str]:
+    """
+    Normalize the first input of the graph, '(x - mean) / std', in the graph
+
+    The normalization is put after the input is changed to a float tensor, e.g. 'x.data.float()',
+    and is not used for the shape of the input, so it can be folded into the layer it goes into.
+
+    Args:
+        graph: the graph of 'forward', this is changed
+        mean: the mean the input is normalized with
+        std: the standard deviation the input is normalized with
+
+    Returns: a description of the change
+    """
+    x = [node for node in graph.nodes if node.op == "placeholder"][0]
+    while len(x.users) == 1:
+        user = next(iter(x.users))
+        if (user.op == "call_function" and user.target == getattr and user.args[1] == "data") or (
+            user.op == "call_method" and user.target in ["float", "contiguous"]
+        ):
+            x = user
+        else:
+            break
+
+    value_users = [user for user in x.users if not is_shape(user)]
+    with graph.inserting_after(x):
+        sub = graph.call_function(operator.sub, (x, float(mean)))
+    with graph.inserting_after(sub):
+        div = graph.call_function(operator.truediv, (sub, float(std)))
+    for user in value_users:
+        user.replace_input_with(x, div)
+
+    graph.lint()
+    return [f"normalized the input with mean {mean:.4g} and std {std:.4g}"]
+
+
+def fuse_graph(model: nn.Module, graph: torch.fx.Graph, n_calls: Dict[str, int]) -> List[str]:
+    """
+    Fold the normalizations and relus into the Conv3d layers they go with
+
+    The layers are changed on the model, and the graph is changed to match.
+    Only layers called once, in all the graphs, are changed.
+
+    Args:
+        model: the model, this is changed
+        graph: the graph of one method, this is changed
+        n_calls: the number of times each layer is called in all the graphs
+
+    Returns: a description of each change
+    """
+    changes = []
+    for node in list(graph.nodes):
+        if not (
+            node.op == "call_module"
+            and type(model.get_submodule(node.target)) == nn.Conv3d
+            and n_calls[node.target] == 1
+        ):
+            continue
+
+        relu_nodes = [user for user in node.users if is_relu(user)]
+        relu = (len(node.users) == 1) and (len(relu_nodes) == 1)
+        normalization = get_normalization(node.args[0]) if len(node.args) == 1 else None
+        if not (relu or normalization):
+            continue
+
+        mean, std = None, None
+        if normalization is not None:
+            x, mean, std = normalization
+            div = node.args[0]
+            sub = div.args[0]
+            node.args = (x,)
+            graph.erase_node(div)
+            graph.erase_node(sub)
+            changes.append(f"folded the input normalization into {node.target}")
+
+        if relu:
+            relu_nodes[0].replace_all_uses_with(node)
+            graph.erase_node(relu_nodes[0])
+            changes.append(f"fused {node.target} and relu")
+
+        parent_name, _, attribute = node.target.rpartition(".")
+        fused = FusedConv3d.from_conv(
+            conv=model.get_submodule(node.target), relu=relu, mean=mean, std=std
+        )
+        setattr(model.get_submodule(parent_name), attribute, fused)
+
+    graph.lint()
+    return changes
+
+
+def drop_unused_layers(model: nn.Module, graph: torch.fx.Graph) -> List[str]:
+    """Drop the layers of the model that the graph of 'forward' does not use"""
+    used = {
+        node.target.split(".")[0] for node in graph.nodes if node.op in ["call_module", "get_attr"]
+    }
+
+    unused = [name for name, _ in model.named_children() if name not in used]
+    for name in unused:
+        delattr(model, name)
+
+    return [f"dropped {name}" for name in unused]
+
+
+def check_optimized_model(
+    model: nn.Module,
+    optimized_model: nn.Module,
+    inputs: Dict[str, Tuple[torch.Tensor, ...]],
+    input_normalization: Optional[Tuple[float, float]] = None,
+) -> bool:
+    """
+    Check the optimized methods give the same outputs as the model
+
+    Args:
+        model: the model
+        optimized_model: the optimized model
+        inputs: example inputs for each optimized method
+        input_normalization: optional mean and std of the first input of 'forward'.
+            The optimized 'forward' is given this input before it is normalized.
+
+    Returns: True if the outputs are the same, to within 'RTOL' and 'ATOL'
+    """
+    for name, method_inputs in inputs.items():
+        optimized_inputs = method_inputs
+        if (name == "forward") and (input_normalization is not None):
+            mean, std = input_normalization
+            optimized_inputs = (method_inputs[0] * std + mean, *method_inputs[1:])
+
+        with torch.inference_mode():
+            expected = getattr(model, name)(*method_inputs)
+            output = getattr(optimized_model, name)(*optimized_inputs)
+
+        if not torch.allclose(output, expected, rtol=RTOL, atol=ATOL):
+            error = (output - expected).abs().max()
+            logger.warning(
+                f"The optimized {name} of {type(model).__name__} is {error:.3g} from the model, "
+                f"which is more than the tolerance, so the model will not be optimized"
+            )
+            return False
+
+    return True
+
+
+def optimize_model(
+    model: nn.Module, input_normalization: Optional[Tuple[float, float]] = None
+) -> nn.Module:
+    """
+    Make a copy of the model, with the methods from 'model.optimization_inputs' optimized
+
+    The weights of the layers that are not changed are shared with the model.
+    If the model has no 'optimization_inputs', or the optimized model does not give the
+    same outputs, the model is returned.
+
+    With 'input_normalization', the mean and std the first input of 'forward' is normalized with,
+    this normalization is folded into the model. The optimized 'forward' then takes the input
+    before it is normalized, and the 'input_normalization' of the optimized model is None.
+    """
+    if not hasattr(model, "optimization_inputs"):
+        logger.debug(f"{type(model).__name__} has no methods to optimize")
+        return model
+
+    inputs = model.optimization_inputs()
+    if (input_normalization is not None) and ("forward" not in inputs):
+        logger.warning(f"The input normalization of {type(model).__name__} can not be folded in")
+        return model
+
+    try:
+        graphs = {name: trace_method(model=model, name=name) for name in inputs}
+    except Exception as e:
+        logger.warning(f"Could not trace {type(model).__name__}, so it will not be optimized: {e}")
+        return model
+
+    # a copy of the model, sharing the parameters and buffers
+    memo = {id(tensor): tensor for tensor in [*model.parameters(), *model.buffers()]}
+    optimized_model = copy.deepcopy(model, memo).eval()
+
+    n_calls = {}
+    for graph in graphs.values():
+        for node in graph.nodes:
+            if node.op == "call_module":
+                n_calls[node.target] = n_calls.get(node.target, 0) + 1
+
+    changes = []
+    if input_normalization is not None:
+        mean, std = input_normalization
+        changes += normalize_input(graph=graphs["forward"], mean=mean, std=std)
+
+    for name, graph in graphs.items():
+        changes += fuse_graph(model=optimized_model, graph=graph, n_calls=n_calls)
+        if name == "forward":
+            changes += drop_unused_layers(model=optimized_model, graph=graph)
+        setattr(optimized_model, name, OptimizedMethod(model=optimized_model, graph=graph))
+
+    if not check_optimized_model(
+        model=model,
+        optimized_model=optimized_model,
+        inputs=inputs,
+        input_normalization=input_normalization,
+    ):
+        return model
+
+    if input_normalization is not None:
+        optimized_model.input_normalization = None
+
+    logger.info(
+        f"Optimized {', '.join(inputs)} of {type(model).__name__}, with {len(changes)} changes"
+    )
+    logger.debug(f"The changes are: {', '.join(changes)}")
+
+    return optimized_model
@@ -0,0 +1,192 @@
+""" Run the batches in a pool of worker processes
+
+Each worker has its own copy of the model, and runs one batch at a time with a 'BatchRunner'.
+The CPU cores are shared between the workers, so each worker's torch only uses its share of
+the threads, rather than every worker trying to use every core.
+
+- Starting the workers, and copying the model to them, is slow. So the pool is kept,
+  and used again by the next forecast with the same model, e.g. when serving forecasts.
+  It is only stopped if the model changes, or with 'shutdown_worker_pool'.
+- With 'quantize', the quantized model is checked once, in this process, on the first batch.
+  Then all the workers are given the same model, so the forecasts of one run do not mix
+  quantized and float models.
+"""
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import pickle
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Optional
+
+import pandas as pd
+
+from nowcasting_forecast.models.inference import BatchRunner, set_torch_threads
+from nowcasting_forecast.models.quantization import DEFAULT_TOLERANCE_MW
+
+logger = logging.getLogger(__name__)
+
+# the batch runner of this worker process, this is made by '_initialize_worker'
+_batch_runner: Optional[BatchRunner] = None
+
+# the pool of worker processes, and what its workers were started with, see 'get_worker_pool'
+_worker_pool = {}
+
+
+def get_threads_per_worker(n_workers: int) -> int:
+    """Share the CPU cores between the workers, each worker gets at least one thread"""
+    return max(1, (os.cpu_count() or 1) // n_workers)
+
+
+def _initialize_worker(n_threads: int, callable_function_for_on_batch: Callable, model: bytes):
+    """Set the threads and make the batch runner, this is run once in each worker"""
+    global _batch_runner
+
+    # the 'InferenceRunner' reads these, so they are set to this worker's share too
+    os.environ["TORCH_INTRA_OP_THREADS"] = str(n_threads)
+    os.environ["TORCH_INTER_OP_THREADS"] = "1"
+    set_torch_threads(intra_op_threads=n_threads, inter_op_threads=1)
+
+    _batch_runner = BatchRunner(
+        callable_function_for_on_batch=callable_function_for_on_batch, model=pickle.loads(model)
+    )
+
+    # close the batch runner when the worker stops, this logs the summary and saves any caches
+    multiprocessing.util.Finalize(None, _batch_runner.close, exitpriority=10)
+
+
+def _run_batch(batch, n_examples: int) -> pd.DataFrame:
+    """Make the forecasts for one batch, this is run in a worker"""
+    return _batch_runner(batch=batch, n_examples=n_examples)
+
+
+def get_worker_pool(
+    n_workers: int, callable_function_for_on_batch: Callable, model=None
+) -> ProcessPoolExecutor:
+    """
+    Get the pool of worker processes, each with a batch runner of the model
+
+    The pool is made the first time, and then kept for the next calls with the same
+    function, model and number of workers. The model is the same object between forecasts,
+    as the models are only loaded once per process, see 'load_ml_model'.
+
+    Args:
+        n_workers: the number of worker processes
+        callable_function_for_on_batch: function that makes the forecasts for one batch
+        model: optional pytorch model, this is copied to each worker when it starts
+
+    Returns: the pool
+    """
+    pool = _worker_pool.get("pool")
+    if (
+        (pool is not None)
+        and (not getattr(pool, "_broken", False))
+        and (_worker_pool["n_workers"] == n_workers)
+        and (_worker_pool["callable_function_for_on_batch"] == callable_function_for_on_batch)
+        and (_worker_pool["model"] is model)
+    ):
+        logger.debug(f"Using the pool of {n_workers} workers again")
+        return pool
+
+    shutdown_worker_pool()
+
+    n_threads = get_threads_per_worker(n_workers=n_workers)
+    logger.info(f"Starting {n_workers} workers, each with {n_threads} torch threads")
+
+    # 'spawn' is used, as forking a process that has already used torch threads can hang
+    pool = ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initialize_worker,
+        # the model is pickled here, as torch would otherwise share its tensors with the workers
+        # through file descriptors, which does not work for the packed weights of quantized models
+        initargs=(n_threads, callable_function_for_on_batch, pickle.dumps(model)),
+    )
+    _worker_pool.update(
+        pool=pool,
+        n_workers=n_workers,
+        callable_function_for_on_batch=callable_function_for_on_batch,
+        model=model,
+    )
+
+    return pool
+
+
+def shutdown_worker_pool():
+    """Stop the workers of the pool, if there is one, this closes their batch runners"""
+    pool = _worker_pool.pop("pool", None)
+    _worker_pool.clear()
+    if pool is not None:
+        logger.debug("Stopping the pool of workers")
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class ParallelBatchRunner:
+    """
+    Run the model on the batches in a pool of worker processes
+
+    This is used in the same way as 'BatchRunner.submit', and the futures are
+    returned in the order the batches are submitted, so the forecasts keep the same order.
+    The workers are kept after 'close', for the next forecast, see 'get_worker_pool'.
+    """
+
+    def __init__(
+        self,
+        n_workers: int,
+        callable_function_for_on_batch: Callable,
+        model=None,
+        quantize: bool = False,
+        quantize_tolerance_mw: float = DEFAULT_TOLERANCE_MW,
+    ):
+        """
+        Parallel batch runner
+
+        Args:
+            n_workers: the number of worker processes
+            callable_function_for_on_batch: function that makes the forecasts for one batch
+            model: optional pytorch model, this is copied to each worker when it starts
+            quantize: option to use the quantized model, if it is accurate enough.
+                This is checked on the first batch, in this process, see 'BatchRunner'
+            quantize_tolerance_mw: see 'check_quantized_forecasts'
+        """
+        self.n_workers = n_workers
+        self.callable_function_for_on_batch = callable_function_for_on_batch
+        self.model = model
+        self.pool = None
+
+        # the batch runner that checks the quantized model, on the first batch
+        self.reference_runner = (
+            BatchRunner(
+                callable_function_for_on_batch=callable_function_for_on_batch,
+                model=model,
+                quantize=True,
+                quantize_tolerance_mw=quantize_tolerance_mw,
+            )
+            if (quantize and (model is not None))
+            else None
+        )
+
+    def submit(self, batch, n_examples: int) -> Future:
+        """Send one batch to the workers, the first batch is run here if checking quantization"""
+        if self.reference_runner is not None:
+            future = self.reference_runner.submit(batch=batch, n_examples=n_examples)
+
+            # the model that was chosen, quantized or float
+            self.model = self.reference_runner.model.model
+            self.reference_runner.close()
+            self.reference_runner = None
+            return future
+
+        if self.pool is None:
+            self.pool = get_worker_pool(
+                n_workers=self.n_workers,
+                callable_function_for_on_batch=self.callable_function_for_on_batch,
+                model=self.model,
+            )
+
+        return self.pool.submit(_run_batch, batch, n_examples)
+
+    def close(self):
+        """Finish with the workers, they are kept for the next forecast"""
+        if self.reference_runner is not None:
+            self.reference_runner.close()
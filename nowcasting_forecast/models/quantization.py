@@ -0,0 +1,78 @@
+""" Dynamic int8 quantization of the pytorch models
+
+The Linear layers are changed to int8, which makes their weights about 4 times smaller
+and is usually quicker on the CPU. The activations are quantized on the fly, for each batch.
+As this changes the predictions a little, the quantized model is only used if its forecasts
+are close to the float model's forecasts, see 'check_quantized_forecasts'.
+"""
+import copy
+import logging
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+# the largest difference, in MW, between the quantized and float forecasts of any gsp
+DEFAULT_TOLERANCE_MW = 1.0
+
+
+@lru_cache()
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Make a copy of the model, with the Linear layers quantized to int8
+
+    The quantized model is only made once per process, for each model.
+    """
+    if not isinstance(model, nn.Module):
+        raise NotImplementedError(
+            f"Only pytorch models can be quantized, not {type(model).__name__}"
+        )
+
+    quantized_model = torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8
+    )
+
+    n_layers = sum(isinstance(module, nn.Linear) for module in model.modules())
+    logger.info(f"Quantized {n_layers} Linear layers of {type(model).__name__} to int8")
+
+    return quantized_model
+
+
+def check_quantized_forecasts(
+    float_forecasts: pd.DataFrame,
+    quantized_forecasts: pd.DataFrame,
+    tolerance_mw: float = DEFAULT_TOLERANCE_MW,
+) -> bool:
+    """
+    Check the forecasts of the quantized model are close enough to the float model
+
+    Args:
+        float_forecasts: forecasts from the float model for one batch, in MW
+        quantized_forecasts: forecasts from the quantized model for the same batch, in MW
+        tolerance_mw: the largest difference allowed for any gsp and target time
+
+    Returns: True if the quantized model can be used
+    """
+    error_mw = np.max(
+        np.abs(
+            float_forecasts["forecast_gsp_pv_outturn_mw"].values
+            - quantized_forecasts["forecast_gsp_pv_outturn_mw"].values
+        )
+    )
+
+    if error_mw > tolerance_mw:
+        logger.warning(
+            f"The quantized model is {error_mw:.3f} MW from the float model, "
+            f"which is more than the tolerance of {tolerance_mw} MW, so it will not be used"
+        )
+        return False
+
+    logger.info(
+        f"The quantized model is {error_mw:.3f} MW from the float model, "
+        f"which is within the tolerance of {tolerance_mw} MW, so it will be used"
+    )
+    return True
@@ -0,0 +1,191 @@
+""" The models the app can run
+
+Each model is registered with the configuration its batches are made with, the data sources
+it reads from the batches, and how to run it on one batch. The app looks the models up by name,
+so several models can be run on the same batches, see 'nowcasting_forecast.models.ensemble'.
+
+The batches of a model are made with just the data sources it reads, see 'get_configuration',
+and the channels and time windows of each data source come from the model's configuration file.
+A pytorch model can also say which time steps and systems of each data source it reads,
+with 'input_slices', and the batches are made with just these, see 'get_input_slices'.
+"""
+import logging
+from typing import Callable, Dict, Iterable, List, Optional
+
+from nowcasting_dataset.config.model import Configuration
+from nowcasting_dataset.dataset.batch import Batch
+
+from nowcasting_forecast.batch import DATA_SOURCE_NAMES, InputSlices, push_down_input_slices
+from nowcasting_forecast.models import nwp_solar_simple
+from nowcasting_forecast.models.cnn import cnn
+from nowcasting_forecast.models.cnn.dataloader import get_cnn_data_loader
+from nowcasting_forecast.models.cnn.model import Model as CNN_Model
+from nowcasting_forecast.models.nwp_simple_trained import nwp_simple_trained
+from nowcasting_forecast.models.nwp_simple_trained.model import Model
+from nowcasting_forecast.models.utils import load_ml_model
+from nowcasting_forecast.utils import load_configuration
+
+logger = logging.getLogger(__name__)
+
+
+class RegisteredModel:
+    """A model the app can run, and what it needs to run it"""
+
+    def __init__(
+        self,
+        name: str,
+        configuration_file: str,
+        data_sources: List[str],
+        callable_function_for_on_batch: Callable,
+        ml_model: Optional = None,
+        use_hf: bool = False,
+        run_configuration_file: Optional[str] = None,
+        make_dataloader: Optional[Callable] = None,
+        uses_backend: bool = False,
+    ):
+        """
+        Registered model
+
+        Args:
+            name: the name of the model, this is also the name its forecasts are saved under
+            configuration_file: the configuration the batches are made with
+            data_sources: the data sources the model reads from the batches
+            callable_function_for_on_batch: function that makes the forecasts for one batch
+            ml_model: optional pytorch model class, which is loaded with 'load_ml_model'
+            use_hf: option to load the weights of 'ml_model' from Hugging Face
+            run_configuration_file: optional configuration used when running the model,
+                see 'general_forecast_run_all_batches'
+            make_dataloader: optional function that makes the dataloader from the batches,
+                called with 'temporary_dir', 'batch_save_dir', 'batches' and
+                'configuration_file', the configuration the batches were made with
+            uses_backend: if the model can be run with a different backend, e.g. 'onnxruntime'
+        """
+        self.name = name
+        self.configuration_file = configuration_file
+        self.data_sources = data_sources
+        self.callable_function_for_on_batch = callable_function_for_on_batch
+        self.ml_model = ml_model
+        self.use_hf = use_hf
+        self.run_configuration_file = run_configuration_file
+        self.make_dataloader = make_dataloader
+        self.uses_backend = uses_backend
+
+    def get_configuration(self, input_slices: Optional[InputSlices] = None) -> Configuration:
+        """
+        Get the configuration the batches of this model are made with
+
+        This is the configuration file, with just the data sources the model reads,
+        so the others are not opened or loaded when the batches are made.
+        The 'gsp' data source is always kept, as this gives the locations of the examples.
+        With 'input_slices', just the systems the model reads are loaded,
+        see 'push_down_input_slices'.
+        """
+        configuration = load_configuration(filename=self.configuration_file)
+
+        for data_source_name in DATA_SOURCE_NAMES:
+            if (data_source_name != "gsp") and (data_source_name not in self.data_sources):
+                setattr(configuration.input_data, data_source_name, None)
+
+        return push_down_input_slices(configuration=configuration, input_slices=input_slices)
+
+    def load_pytorch_model(self, backend: str = "eager"):
+        """
+        Load the pytorch model, see 'load_ml_model', or None if this model does not have one
+
+        This is loaded once per process, so it is the same model that is run on the batches.
+        """
+        if self.ml_model is None:
+            return None
+
+        return load_ml_model(
+            ml_model=self.ml_model,
+            use_hf=self.use_hf,
+            backend=backend if self.uses_backend else "eager",
+        )
+
+
+def get_input_slices(pytorch_model) -> Optional[InputSlices]:
+    """
+    Get the parts of each data source the pytorch model reads, see e.g. 'Model.input_slices'
+
+    Args:
+        pytorch_model: the loaded model, this can be wrapped in a backend
+
+    Returns: the input slices, or None if the model reads all of each data source
+    """
+    while (pytorch_model is not None) and not hasattr(pytorch_model, "input_slices"):
+        pytorch_model = getattr(pytorch_model, "model", None)
+
+    if pytorch_model is None:
+        return None
+
+    input_slices = pytorch_model.input_slices()
+    logger.debug(f"The batches will have the input slices {input_slices}")
+    return input_slices
+
+
+def make_cnn_dataloader(
+    temporary_dir: str,
+    batch_save_dir: Optional[str],
+    batches: Optional[Iterable[Batch]],
+    configuration_file: Optional[str] = None,
+):
+    """Make the dataloader of the CNN model, which changes the batches to ML batches"""
+    return get_cnn_data_loader(
+        configuration_file=configuration_file,
+        src_path=f"{temporary_dir}/live",
+        tmp_path=f"{temporary_dir}/live",
+        batch_save_dir=batch_save_dir,
+        batches=batches,
+    )
+
+
+MODELS: Dict[str, RegisteredModel] = {}
+
+
+def register_model(model: RegisteredModel):
+    """Add a model to the registry, so it can be run by name"""
+    logger.debug(f"Registering model {model.name}")
+    MODELS[model.name] = model
+
+
+def get_registered_model(name: str) -> RegisteredModel:
+    """Get a registered model by name"""
+    if name not in MODELS:
+        # note pvnet has a config (pvnet_v1.yaml) but no model to run yet
+        raise NotImplementedError(f"Model {name} has not be implemented")
+    return MODELS[name]
+
+
+register_model(
+    RegisteredModel(
+        name=nwp_solar_simple.NAME,
+        configuration_file="nowcasting_forecast/config/mvp_v0.yaml",
+        data_sources=["nwp"],
+        callable_function_for_on_batch=nwp_solar_simple.nwp_irradiance_simple_run_one_batch,
+    )
+)
+register_model(
+    RegisteredModel(
+        name=nwp_simple_trained.NAME,
+        configuration_file="nowcasting_forecast/config/mvp_v1.yaml",
+        data_sources=["nwp"],
+        callable_function_for_on_batch=(
+            nwp_simple_trained.nwp_irradiance_simple_trained_run_one_batch
+        ),
+        ml_model=Model,
+    )
+)
+register_model(
+    RegisteredModel(
+        name=cnn.NAME,
+        configuration_file="nowcasting_forecast/config/mvp_v2.yaml",
+        data_sources=["gsp", "nwp", "pv", "satellite", "sun"],
+        callable_function_for_on_batch=cnn.cnn_run_one_batch,
+        ml_model=CNN_Model,
+        use_hf=True,
+        run_configuration_file="nowcasting_forecast/config/pvnet_v1.yaml",
+        make_dataloader=make_cnn_dataloader,
+        uses_backend=True,
+    )
+)
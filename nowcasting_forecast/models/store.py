@@ -0,0 +1,347 @@
+""" Local store of the model weights
+
+The model weights used to be downloaded on every run, from s3 or Hugging Face.
+Now they are kept in a local store, so the network and the download time are not on the
+critical path of the forecast.
+
+- Each model has its own directory in the store, 'MODEL_STORE_DIR', with a 'manifest.json' of
+  where the model came from, its revision, and the SHA-256 of each file.
+- The files are checked against their SHA-256 each time they are used. If 'MODEL_SHA256' is set,
+  the weights must have this SHA-256 too, otherwise they are not used.
+- If the revision is pinned with 'MODEL_REVISION', and the store has this revision,
+  the network is not used at all. Otherwise the remote revision, i.e. the ETag of the file or
+  the Hugging Face commit, is checked, and the files are only downloaded if it has changed.
+- With 'MODEL_STORE_OFFLINE', only the store is used. The store is also used if the remote
+  revision can not be checked, e.g. the network is down, as long as the store has the model.
+
+The remote files can be on any fsspec file system, e.g. s3, or a local 'file://' stand-in.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Sequence
+
+import fsspec
+from huggingface_hub import CONFIG_NAME, PYTORCH_WEIGHTS_NAME, HfApi, hf_hub_download
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nowcasting_forecast", "models")
+MANIFEST_NAME = "manifest.json"
+
+
+def get_model_file(
+    remote_filename: str,
+    revision: Optional[str] = None,
+    sha256: Optional[str] = None,
+    store_dir: Optional[str] = None,
+    offline: Optional[bool] = None,
+) -> str:
+    """
+    Get the local copy of a weights file, downloading it only if it has changed
+
+    Args:
+        remote_filename: the weights file, on any fsspec file system
+        revision: optional pinned revision, the ETag of the file.
+            Defaults to the 'MODEL_REVISION' environment variable
+        sha256: optional SHA-256 the file must have, defaults to 'MODEL_SHA256'
+        store_dir: the model store, defaults to 'MODEL_STORE_DIR',
+            or '~/.cache/nowcasting_forecast/models'
+        offline: option to only use the store, defaults to 'MODEL_STORE_OFFLINE'
+
+    Returns: the local filename
+    """
+    filesystem, path = fsspec.core.url_to_fs(remote_filename)
+    filename = os.path.basename(path)
+
+    def get_remote_revision(pinned_revision: Optional[str]) -> str:
+        remote_revision = get_file_revision(filesystem.info(path))
+        if (pinned_revision is not None) and (remote_revision != pinned_revision):
+            raise ValueError(
+                f"{remote_filename} is at revision {remote_revision}, "
+                f"not the pinned revision {pinned_revision}"
+            )
+        return remote_revision
+
+    def download(remote_revision: str, directory: str):
+        logger.info(f"Downloading {remote_filename} to the model store")
+        filesystem.get_file(path, os.path.join(directory, filename))
+
+    model_dir = get_model(
+        source=remote_filename,
+        filenames=[filename],
+        weights_filename=filename,
+        get_remote_revision=get_remote_revision,
+        download=download,
+        revision=revision,
+        sha256=sha256,
+        store_dir=store_dir,
+        offline=offline,
+    )
+
+    return os.path.join(model_dir, filename)
+
+
+def get_hf_model_dir(
+    repo_id: str,
+    filenames: Sequence[str] = (CONFIG_NAME, PYTORCH_WEIGHTS_NAME),
+    revision: Optional[str] = None,
+    sha256: Optional[str] = None,
+    store_dir: Optional[str] = None,
+    offline: Optional[bool] = None,
+) -> str:
+    """
+    Get the local copy of a Hugging Face model, downloading it only if it has changed
+
+    The directory can be loaded with 'from_pretrained', without using the network.
+
+    Args:
+        repo_id: the Hugging Face model, e.g. 'openclimatefix/nowcasting_cnn_v5'
+        filenames: the files of the model to get
+        revision: optional pinned revision, a commit, branch or tag.
+            Defaults to the 'MODEL_REVISION' environment variable
+        sha256: optional SHA-256 the weights file must have, defaults to 'MODEL_SHA256'
+        store_dir: see 'get_model_file'
+        offline: see 'get_model_file'
+
+    Returns: the local directory of the model
+    """
+
+    def get_remote_revision(pinned_revision: Optional[str]) -> str:
+        return HfApi().model_info(repo_id=repo_id, revision=pinned_revision).sha
+
+    def download(remote_revision: str, directory: str):
+        logger.info(f"Downloading {repo_id} at revision {remote_revision} to the model store")
+        with tempfile.TemporaryDirectory(dir=directory) as cache_dir:
+            for filename in filenames:
+                cached_filename = hf_hub_download(
+                    repo_id=repo_id,
+                    filename=filename,
+                    revision=remote_revision,
+                    cache_dir=cache_dir,
+                )
+                shutil.move(cached_filename, os.path.join(directory, filename))
+
+    return get_model(
+        source=f"hf://{repo_id}",
+        filenames=list(filenames),
+        weights_filename=PYTORCH_WEIGHTS_NAME,
+        get_remote_revision=get_remote_revision,
+        download=download,
+        revision=revision,
+        sha256=sha256,
+        store_dir=store_dir,
+        offline=offline,
+    )
+
+
+def get_model(
+    source: str,
+    filenames: List[str],
+    weights_filename: str,
+    get_remote_revision: Callable[[Optional[str]], str],
+    download: Callable[[str, str], None],
+    revision: Optional[str] = None,
+    sha256: Optional[str] = None,
+    store_dir: Optional[str] = None,
+    offline: Optional[bool] = None,
+) -> str:
+    """
+    Get the directory of a model in the store, downloading it if needed
+
+    Args:
+        source: where the model comes from, this is used to name its directory in the store
+        filenames: the files of the model
+        weights_filename: the file 'sha256' is checked against
+        get_remote_revision: function that gets the remote revision, from the pinned revision.
+            This should raise an error if the pinned revision is not available.
+        download: function that downloads the files at a revision to a directory
+        revision: see 'get_model_file'
+        sha256: see 'get_model_file'
+        store_dir: see 'get_model_file'
+        offline: see 'get_model_file'
+
+    Returns: the directory with the model files
+    """
+    if revision is None:
+        revision = os.getenv("MODEL_REVISION")
+    if sha256 is None:
+        sha256 = os.getenv("MODEL_SHA256")
+    if store_dir is None:
+        store_dir = os.getenv("MODEL_STORE_DIR", DEFAULT_STORE_DIR)
+    if offline is None:
+        offline = os.getenv("MODEL_STORE_OFFLINE", "false").lower() in ["true", "1", "yes"]
+
+    store_model_dir = os.path.join(store_dir, re.sub(r"[^A-Za-z0-9_.-]+", "_", source))
+
+    manifest = load_manifest(store_model_dir)
+    if (manifest is not None) and (
+        not check_manifest(store_model_dir, manifest, filenames, weights_filename, sha256)
+    ):
+        manifest = None
+
+    has_revision = (
+        (revision is not None)
+        and (manifest is not None)
+        and (revision in [manifest["revision"], manifest["pinned_revision"]])
+    )
+
+    if offline:
+        if (manifest is None) or ((revision is not None) and not has_revision):
+            message = f"{source} at revision {revision} is not in the model store {store_dir}"
+            logger.error(message)
+            raise FileNotFoundError(message)
+        logger.debug(f"Using {source} from the model store, offline")
+        return os.path.join(store_model_dir, manifest["directory"])
+
+    if has_revision:
+        logger.debug(f"Using {source} at pinned revision {revision} from the model store")
+        return os.path.join(store_model_dir, manifest["directory"])
+
+    try:
+        remote_revision = get_remote_revision(revision)
+    except Exception as e:
+        if (manifest is None) or (revision is not None):
+            raise e
+        logger.warning(
+            f"Could not check the revision of {source} ({e}), "
+            f"so using revision {manifest['revision']} from the model store"
+        )
+        return os.path.join(store_model_dir, manifest["directory"])
+
+    if (manifest is not None) and (remote_revision == manifest["revision"]):
+        logger.debug(f"{source} has not changed, so using it from the model store")
+        return os.path.join(store_model_dir, manifest["directory"])
+
+    return add_model(
+        store_model_dir=store_model_dir,
+        source=source,
+        filenames=filenames,
+        weights_filename=weights_filename,
+        download=download,
+        remote_revision=remote_revision,
+        pinned_revision=revision,
+        sha256=sha256,
+    )
+
+
+def add_model(
+    store_model_dir: str,
+    source: str,
+    filenames: List[str],
+    weights_filename: str,
+    download: Callable[[str, str], None],
+    remote_revision: str,
+    pinned_revision: Optional[str],
+    sha256: Optional[str],
+) -> str:
+    """
+    Download a revision of the model into the store
+
+    The files are downloaded to a new directory, and then the manifest is replaced in one go,
+    so a partly downloaded model is never used. Older revisions are then removed.
+    """
+    os.makedirs(store_model_dir, exist_ok=True)
+    directory = tempfile.mkdtemp(dir=store_model_dir, prefix="revision_")
+    try:
+        download(remote_revision, directory)
+        files = {filename: get_sha256(os.path.join(directory, filename)) for filename in filenames}
+        if (sha256 is not None) and (files[weights_filename] != sha256.lower()):
+            raise ValueError(
+                f"{weights_filename} of {source} has SHA-256 {files[weights_filename]}, "
+                f"not {sha256}"
+            )
+    except Exception as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise e
+
+    manifest = dict(
+        source=source,
+        revision=remote_revision,
+        pinned_revision=pinned_revision,
+        directory=os.path.basename(directory),
+        files=files,
+        downloaded_utc=datetime.now(timezone.utc).isoformat(),
+    )
+    save_manifest(store_model_dir, manifest)
+
+    for name in os.listdir(store_model_dir):
+        if name.startswith("revision_") and (name != manifest["directory"]):
+            shutil.rmtree(os.path.join(store_model_dir, name), ignore_errors=True)
+
+    return directory
+
+
+def get_file_revision(info: Dict) -> str:
+    """
+    Get the revision of a file from its fsspec info
+
+    This is the ETag if there is one, e.g. on s3, otherwise the size and modified time.
+    """
+    for key in ["ETag", "etag"]:
+        if info.get(key):
+            return str(info[key]).strip('"')
+    return f"{info['size']}-{info.get('mtime', info.get('LastModified', ''))}"
+
+
+def get_sha256(filename: str) -> str:
+    """Get the SHA-256 of a file"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def check_manifest(
+    store_model_dir: str,
+    manifest: Dict,
+    filenames: List[str],
+    weights_filename: str,
+    sha256: Optional[str],
+) -> bool:
+    """Check the store has all the files of the model, and they have the right SHA-256"""
+    files = manifest["files"]
+    if any(filename not in files for filename in filenames):
+        logger.debug(f"The model store {store_model_dir} does not have all of {filenames}")
+        return False
+
+    if (sha256 is not None) and (files[weights_filename] != sha256.lower()):
+        logger.debug(f"The model store {store_model_dir} has weights with a different SHA-256")
+        return False
+
+    for filename in filenames:
+        local_filename = os.path.join(store_model_dir, manifest["directory"], filename)
+        if (not os.path.exists(local_filename)) or (get_sha256(local_filename) != files[filename]):
+            logger.warning(f"{local_filename} in the model store is missing or has changed")
+            return False
+
+    return True
+
+
+def load_manifest(store_model_dir: str) -> Optional[Dict]:
+    """Load the manifest of a model in the store, None is returned if there is no manifest"""
+    filename = os.path.join(store_model_dir, MANIFEST_NAME)
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"Could not load the model store manifest {filename}: {e}")
+        return None
+
+
+def save_manifest(store_model_dir: str, manifest: Dict):
+    """Save the manifest, the file is replaced at once so a partial file is never read"""
+    filename = os.path.join(store_model_dir, MANIFEST_NAME)
+    temporary_file = f"{filename}.tmp"
+    with open(temporary_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporary_file, filename)
@@ -3,12 +3,14 @@ import logging
 from datetime import datetime, timezone
 from typing import List
 
+import numpy as np
 from nowcasting_datamodel.models import ForecastSQL, StatusSQL
 from nowcasting_datamodel.read.read import get_latest_status
-from nowcasting_dataset.data_sources.gsp.eso import get_gsp_metadata_from_eso
 from nowcasting_dataset.geospatial import calculate_azimuth_and_elevation_angle
 from sqlalchemy.orm.session import Session
 
+from nowcasting_forecast.gsp_metadata import get_gsp_metadata
+
 ELEVATION_LIMIT = 0
 DROP_ELEVATION_LIMIT = 5
 logger = logging.getLogger(__name__)
@@ -23,6 +25,9 @@ def filter_forecasts_on_sun_elevation(forecasts: List[ForecastSQL]) -> List[Fore
     """
     Filters predictions if the sun elevation is more than X degrees below the horizon
 
+    The sun elevation is calculated for all the gsps and target times at once,
+    and then the forecast values where the sun is below the horizon are set to zero.
+
     Args:
         forecasts: The forecast output
 
@@ -32,33 +37,38 @@ def filter_forecasts_on_sun_elevation(forecasts: List[ForecastSQL]) -> List[Fore
 
     logger.info("Filtering forecasts on sun elevation")
 
-    metadata = get_gsp_metadata_from_eso()
+    if len(forecasts) == 0:
+        return forecasts
 
-    for forecast in forecasts:
-        gsp_id = forecast.location.gsp_id
-        gsp_metadata = metadata[metadata.gsp_id == gsp_id].iloc[0]
-        lat = gsp_metadata.centroid_lat
-        lon = gsp_metadata.centroid_lon
-        target_times = [forecast_value.target_time for forecast_value in forecast.forecast_values]
-
-        # get a pandas dataframe of of elevation and azimuth positions
-        sun_df = calculate_azimuth_and_elevation_angle(
-            latitude=lat, longitude=lon, datestamps=target_times
-        )
-
-        # check that any elevations are < 'ELEVATION_LIMIT'
-        if (sun_df["elevation"] < ELEVATION_LIMIT).sum() > 0:
-            logger.debug(f"Got sun angle for {lat} {lon} {target_times}, and some are below zero")
-
-            # loop through target times
-            for i in range(len(target_times)):
-                sun_for_target_time = sun_df.iloc[i]
-                if sun_for_target_time.elevation < ELEVATION_LIMIT:
-                    # note sql objects are connected, so we can edit in place
-                    forecast.forecast_values[i].expected_power_generation_megawatts = 0
+    # centroid of each gsp
+    metadata = get_gsp_metadata()
 
-        else:
-            logger.debug("No elevations below zero, so need to filter")
+    # one row for each forecast value
+    gsp_ids, target_times, forecast_values = [], [], []
+    for forecast in forecasts:
+        for forecast_value in forecast.forecast_values:
+            gsp_ids.append(forecast.location.gsp_id)
+            target_times.append(forecast_value.target_time)
+            forecast_values.append(forecast_value)
+
+    if len(forecast_values) == 0:
+        return forecasts
+
+    centroids = metadata.loc[gsp_ids]
+
+    # get a pandas dataframe of of elevation and azimuth positions, for all values at once
+    sun_df = calculate_azimuth_and_elevation_angle(
+        latitude=centroids["centroid_lat"].values,
+        longitude=centroids["centroid_lon"].values,
+        datestamps=target_times,
+    )
+
+    # zero the forecast values where the sun is below 'ELEVATION_LIMIT'
+    below_limit = np.flatnonzero(sun_df["elevation"].values < ELEVATION_LIMIT)
+    logger.debug(f"{len(below_limit)} of {len(forecast_values)} forecast values are set to zero")
+    for i in below_limit:
+        # note sql objects are connected, so we can edit in place
+        forecast_values[i].expected_power_generation_megawatts = 0
 
     logger.info("Done sun filtering")
 
@@ -4,24 +4,34 @@ Pydantic models:
  - MLResult and MLResults
 
 functions:
+ - make_results_df: make the results dataframe of one batch, from the predictions
  - check_results_df: to check dataframe can be changed to ML Results
- - convert_to_forecast_sql: convert MLResults to ForecastSQL
+ - validate_results_df: validate and clean the results dataframe, like MLResult but vectorised
+ - get_locations: get the locations for lots of gsps at once
+ - convert_to_forecast_sql: convert the results dataframe to ForecastSQL
+ - convert_one_gsp_df_to_forecast_sql: convert the validated results of one gsp to ForecastSQL
+ - convert_one_gsp_id_to_forecast_sql: convert MLResults of one gsp to ForecastSQL
+ - load_ml_model: load a ml model and its weights, once per process
+ - prepare_ml_model: optimize a loaded ml model, and run it with the backend
 """
 
 import logging
 import os
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Sequence
 
 import numpy as np
 import pandas as pd
 from nowcasting_datamodel.models import (
     Forecast,
     ForecastSQL,
-    ForecastValue,
+    ForecastValueSQL,
     InputDataLastUpdatedSQL,
+    LocationSQL,
     MLModelSQL,
+    national_gb_label,
 )
 from nowcasting_datamodel.national import make_national_forecast
 from nowcasting_datamodel.read.read import (
@@ -30,15 +40,23 @@ from nowcasting_datamodel.read.read import (
     get_model,
 )
 from nowcasting_datamodel.utils import datetime_must_have_timezone
-from nowcasting_dataset.config.load import load_yaml_configuration
+from nowcasting_dataset.dataset.batch import Batch
 from pydantic import BaseModel, Field, validator
 from sqlalchemy.orm.session import Session
 
 import nowcasting_forecast
 from nowcasting_forecast import N_GSP
+from nowcasting_forecast.batch import BatchProducer
 from nowcasting_forecast.dataloader import BatchDataLoader
+from nowcasting_forecast.models.batching import rechunk_batches
+from nowcasting_forecast.models.cnn.export import make_backend
+from nowcasting_forecast.models.inference import BatchRunner
+from nowcasting_forecast.models.optimization import optimize_model
+from nowcasting_forecast.models.parallel import ParallelBatchRunner
+from nowcasting_forecast.models.quantization import DEFAULT_TOLERANCE_MW
 from nowcasting_forecast.models.sun import filter_forecasts_on_sun_elevation
-from nowcasting_forecast.utils import floor_minutes_dt
+from nowcasting_forecast.profiling import stage
+from nowcasting_forecast.utils import floor_minutes_dt, load_configuration
 
 logger = logging.getLogger(__name__)
 
@@ -87,6 +105,50 @@ class MLResults(BaseModel):
     )
 
 
+def make_results_df(
+    predictions: np.ndarray,
+    gsp_ids: Sequence[int],
+    t0_datetimes_utc: Sequence,
+    horizon_minutes: Sequence[int],
+    n_examples: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Make the results dataframe of one batch, with one row for each example and horizon
+
+    The rows are in example order, and then horizon order.
+
+    Args:
+        predictions: the forecast in MW, for each example and horizon
+        gsp_ids: the gsp id of each example
+        t0_datetimes_utc: the t0 of each example, naive datetimes are taken as UTC
+        horizon_minutes: the target time of each horizon, in minutes after t0
+        n_examples: optional number of examples to use, the rest are padding
+
+    Returns: results dataframe, see 'check_results_df'
+    """
+    if n_examples is None:
+        n_examples = len(gsp_ids)
+    n_examples = min(n_examples, len(gsp_ids))
+    horizon_minutes = np.asarray(horizon_minutes, dtype=np.int64)
+    n_horizons = len(horizon_minutes)
+
+    t0s = pd.to_datetime(np.asarray(t0_datetimes_utc)[:n_examples], utc=True)
+    t0s = t0s.tz_convert(None).values.astype("datetime64[ns]")
+    t0s = np.repeat(t0s, n_horizons)
+    target_times = t0s + np.tile(horizon_minutes.astype("timedelta64[m]"), n_examples)
+
+    return pd.DataFrame(
+        {
+            "t0_datetime_utc": pd.DatetimeIndex(t0s).tz_localize(timezone.utc),
+            "target_datetime_utc": pd.DatetimeIndex(target_times).tz_localize(timezone.utc),
+            "forecast_gsp_pv_outturn_mw": np.asarray(predictions, dtype=np.float64)[
+                :n_examples, :n_horizons
+            ].ravel(),
+            "gsp_id": np.repeat(np.asarray(gsp_ids, dtype=np.int64)[:n_examples], n_horizons),
+        }
+    )
+
+
 def check_results_df(results_df: pd.DataFrame):
     """
     Check the dataframe has the correct columns
@@ -103,6 +165,84 @@ def check_results_df(results_df: pd.DataFrame):
     assert "gsp_id" in results_df.keys()
 
 
+def validate_results_df(results_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Validate the results dataframe, for all the rows at once
+
+    This applies the same rules as 'MLResult', but on the whole columns:
+    - negative forecast values are changed to 0
+    - the gsp ids must be in the valid range
+    - the datetimes are made timezone aware, in UTC. Naive datetimes are assumed to be UTC.
+
+    Args:
+        results_df: results dataframe
+
+    Returns: validated copy of the results dataframe
+    """
+
+    check_results_df(results_df)
+
+    # validate gsp id >=0 <= 317
+    gsp_ids = results_df["gsp_id"].astype(int)
+    invalid = (gsp_ids < 0) | (gsp_ids > 317)
+    if invalid.any():
+        raise Exception(f"gsp_id ({gsp_ids[invalid].unique()}) is not in valid range")
+
+    # validate forecast value >0
+    forecast_mw = results_df["forecast_gsp_pv_outturn_mw"].astype(float)
+    negative = forecast_mw < 0
+    if negative.any():
+        logger.debug(f"Changing {negative.sum()} negative forecast_gsp_pv_outturn_mw values to 0")
+
+    return pd.DataFrame(
+        {
+            "t0_datetime_utc": pd.to_datetime(results_df["t0_datetime_utc"], utc=True),
+            "target_datetime_utc": pd.to_datetime(results_df["target_datetime_utc"], utc=True),
+            "forecast_gsp_pv_outturn_mw": forecast_mw.clip(lower=0),
+            "gsp_id": gsp_ids,
+        }
+    )
+
+
+def get_locations(session: Session, gsp_ids: Iterable[int]) -> Dict[int, LocationSQL]:
+    """
+    Get the locations for the gsp ids, in one query
+
+    Any locations that do not exist are added, like 'get_location' does for one gsp.
+
+    Args:
+        session: database session
+        gsp_ids: the gsp ids
+
+    Returns: dictionary of locations, keyed by gsp id
+    """
+
+    gsp_ids = sorted({int(gsp_id) for gsp_id in gsp_ids})
+
+    query = session.query(LocationSQL)
+    query = query.filter(LocationSQL.gsp_id.in_(gsp_ids))
+    query = query.order_by(LocationSQL.gsp_id, LocationSQL.id)
+
+    # if there are several locations for one gsp, take the first one
+    locations = {}
+    for location in query.all():
+        locations.setdefault(location.gsp_id, location)
+
+    missing_gsp_ids = [gsp_id for gsp_id in gsp_ids if gsp_id not in locations]
+    if len(missing_gsp_ids) > 0:
+        logger.debug(f"Locations for gsp ids {missing_gsp_ids} do not exist so going to add them")
+        new_locations = [
+            LocationSQL(gsp_id=gsp_id, label=national_gb_label if gsp_id == 0 else f"GSP_{gsp_id}")
+            for gsp_id in missing_gsp_ids
+        ]
+        session.add_all(new_locations)
+        session.commit()
+
+        locations.update({location.gsp_id: location for location in new_locations})
+
+    return locations
+
+
 def convert_to_forecast_sql(
     results_df: pd.DataFrame,
     session: Session,
@@ -110,16 +250,14 @@ def convert_to_forecast_sql(
 ) -> List[ForecastSQL]:
     """
     Convert dataframe to forecast sql object
+
+    The dataframe is validated all at once, and then split by gsp id, in the order they appear.
     """
 
     logger.debug("Converting dataframe to ForecastSQLs")
     logger.debug(f"Result dataframe has {len(results_df)} values")
 
-    check_results_df(results_df)
-
-    # get gsp ids
-    gsps_ids = results_df["gsp_id"].unique()
-    logger.debug(f"There are {len(gsps_ids)} gsps ids")
+    results_df = validate_results_df(results_df)
 
     # get last input data
     input_data_last_updated = get_latest_input_data_last_updated(session=session)
@@ -127,25 +265,33 @@ def convert_to_forecast_sql(
     # get model name
     model = get_model(name=model_name, version=nowcasting_forecast.__version__, session=session)
 
-    forecasts = []
-    # loop over gsp ids
-    for gsp_id in gsps_ids:
-        results_df_one_gsp = results_df[results_df["gsp_id"] == gsp_id]
+    # get all the locations at once
+    locations = get_locations(session=session, gsp_ids=results_df["gsp_id"].unique())
 
-        # convert to 'MLResults'
-        results = MLResults(forecasts=results_df_one_gsp.to_dict(orient="records"))
+    forecast_creation_time = datetime.now(tz=timezone.utc)
 
+    forecasts = []
+    for gsp_id, results_df_one_gsp in results_df.groupby("gsp_id", sort=False):
         forecasts.append(
-            convert_one_gsp_id_to_forecast_sql(
-                results_for_one_gsp_id=results,
+            convert_one_gsp_df_to_forecast_sql(
+                results_df_one_gsp=results_df_one_gsp,
+                gsp_id=gsp_id,
                 session=session,
                 input_data_last_updated=input_data_last_updated,
                 ml_model=model,
+                forecast_creation_time=forecast_creation_time,
+                location=locations[gsp_id],
             )
         )
 
         if len(forecasts) > N_GSP:
             break
+    logger.debug(f"There are {len(forecasts)} gsps ids")
+
+    # validate. The values of every forecast have already been checked, for all the rows at once,
+    # by 'validate_results_df', and the model and input data are the same objects in every
+    # forecast. So only the first forecast is checked with pydantic, as this is slow for them all
+    _ = Forecast.from_orm(forecasts[0])
 
     logger.debug(f"Made {len(forecasts)} forecasts")
 
@@ -162,28 +308,73 @@ def convert_one_gsp_id_to_forecast_sql(
 
     - gsp location is collected from database,
     - model is collected from database
+
+    This is for results that are already 'MLResults',
+    'convert_one_gsp_df_to_forecast_sql' is quicker for a results dataframe.
     """
 
-    # set up forecasts fields
-    forecast_creation_time = datetime.now(tz=timezone.utc)
+    results_df_one_gsp = validate_results_df(
+        pd.DataFrame([forecast.dict() for forecast in results_for_one_gsp_id.forecasts])
+    )
 
     # assert only one gsp_id
-    gsps_ids = np.unique([forecast.gsp_id for forecast in results_for_one_gsp_id.forecasts])
+    gsps_ids = results_df_one_gsp["gsp_id"].unique()
     assert len(gsps_ids) == 1
 
-    gsp_id = results_for_one_gsp_id.forecasts[0].gsp_id
-    location = get_location(gsp_id=gsp_id, session=session)
+    forecast = convert_one_gsp_df_to_forecast_sql(
+        results_df_one_gsp=results_df_one_gsp,
+        gsp_id=gsps_ids[0],
+        session=session,
+        input_data_last_updated=input_data_last_updated,
+        ml_model=ml_model,
+    )
+
+    # validate
+    _ = Forecast.from_orm(forecast)
+
+    return forecast
+
+
+def convert_one_gsp_df_to_forecast_sql(
+    results_df_one_gsp: pd.DataFrame,
+    gsp_id: int,
+    session: Session,
+    input_data_last_updated: InputDataLastUpdatedSQL,
+    ml_model: MLModelSQL,
+    forecast_creation_time: Optional[datetime] = None,
+    location: Optional[LocationSQL] = None,
+) -> ForecastSQL:
+    """Function to convert results to forecast sql
+
+    - gsp location is collected from database, if it is not given
+    - model is collected from database
 
-    forecast_values = []
-    for forecast in results_for_one_gsp_id.forecasts:
-        # add timezone
-        target_time = forecast.target_datetime_utc.replace(tzinfo=timezone.utc)
-        f = ForecastValue(
+    Args:
+        results_df_one_gsp: validated results for one gsp, see 'validate_results_df'
+        gsp_id: the gsp id
+        session: database session
+        input_data_last_updated: the input data last updated object
+        ml_model: the ml model object
+        forecast_creation_time: when the forecast is made, defaults to now
+        location: the location of the gsp
+    """
+
+    if forecast_creation_time is None:
+        forecast_creation_time = datetime.now(tz=timezone.utc)
+
+    if location is None:
+        location = get_location(gsp_id=int(gsp_id), session=session)
+
+    target_times = pd.DatetimeIndex(results_df_one_gsp["target_datetime_utc"]).to_pydatetime()
+    values = results_df_one_gsp["forecast_gsp_pv_outturn_mw"].tolist()
+    forecast_values = [
+        ForecastValueSQL(
             target_time=target_time,
-            expected_power_generation_megawatts=forecast.forecast_gsp_pv_outturn_mw,
-        ).to_orm()
-        f.adjust_mw = 0.0
-        forecast_values.append(f)
+            expected_power_generation_megawatts=value,
+            adjust_mw=0.0,
+        )
+        for target_time, value in zip(target_times, values)
+    ]
 
     forecast = ForecastSQL(
         model=ml_model,
@@ -194,12 +385,63 @@ def convert_one_gsp_id_to_forecast_sql(
         historic=False,
     )
 
-    # validate
-    _ = Forecast.from_orm(forecast)
-
     return forecast
 
 
+@lru_cache()
+def load_ml_model(
+    ml_model, use_hf: bool = False, weights_file: Optional[str] = None, backend: str = "eager"
+):
+    """
+    Load a ml model and its weights, ready for making predictions
+
+    The model is only loaded once per process,
+    so when the app is kept running, the weights are not downloaded again for each forecast.
+    The model is then made ready for inference, see 'prepare_ml_model'.
+
+    Args:
+        ml_model: the model class
+        use_hf: option to load the weights from Hugging Face
+        weights_file: the remote weights file, used when not loading from Hugging Face
+        backend: one of 'eager', 'torchscript' or 'onnxruntime'. For the exported backends,
+            the model is exported on the first batch.
+
+    Returns: model, in eval mode
+    """
+    logger.info(f"Loading model {ml_model.__name__}")
+
+    with stage("load_model"):
+        model = ml_model()
+        if use_hf:
+            model = model.load_model(use_hf=use_hf)
+        else:
+            model = model.load_model(remote_filename=weights_file)
+
+    return prepare_ml_model(model=model, backend=backend)
+
+
+def prepare_ml_model(model, backend: str = "eager"):
+    """
+    Get a model, with its weights loaded, ready for making predictions
+
+    The model is optimized for inference, see 'optimize_model'. If the model has an
+    'input_normalization', this is folded into the model, so it takes the data before it is
+    normalized.
+
+    Args:
+        model: the pytorch model
+        backend: one of 'eager', 'torchscript' or 'onnxruntime', see 'make_backend'
+
+    Returns: model, in eval mode
+    """
+    with stage("optimize_model"):
+        model = optimize_model(
+            model.eval(), input_normalization=getattr(model, "input_normalization", None)
+        )
+
+    return make_backend(model=model, backend=backend)
+
+
 def general_forecast_run_all_batches(
     session: Session,
     callable_function_for_on_batch,
@@ -209,11 +451,39 @@ def general_forecast_run_all_batches(
     n_gsps: int = N_GSP,
     batches_dir: Optional[str] = None,
     ml_model: Optional = None,
+    pytorch_model: Optional = None,
     weights_file: Optional[str] = None,
     dataloader: Optional = None,
     use_hf: bool = False,
+    batches: Optional[Iterable[Batch]] = None,
+    batch_producer: Optional[BatchProducer] = None,
+    backend: str = "eager",
+    quantize: bool = False,
+    quantize_tolerance_mw: float = DEFAULT_TOLERANCE_MW,
+    n_workers: int = 1,
+    inference_batch_size: Optional[int] = None,
 ) -> List[ForecastSQL]:
-    """Run model for all batches"""
+    """Run model for all batches
+
+    If 'batches' are given, these are used instead of loading the batches from 'batches_dir'.
+    If 'batch_producer' is given, the batches are being made in the background,
+    and each batch is passed to the model as soon as it is ready.
+    The producer is stopped at the end, even if the model fails.
+    The pytorch model can be run with a different 'backend', see 'load_ml_model'.
+
+    With 'quantize', the Linear layers of the pytorch model are quantized to int8.
+    The first batch is run with both models, and the quantized model is only used, for all the
+    batches, if its forecasts are within 'quantize_tolerance_mw' of the float model.
+
+    With 'n_workers' more than 1, the batches are run in a pool of worker processes,
+    each with its own copy of the model. The forecasts are in the same order as the batches.
+    The pool is kept for the next run of the same model, see 'get_worker_pool'.
+    'pytorch_model' can be used to give a model that is already loaded, instead of 'ml_model'.
+
+    The examples are re-chunked into batches of 'inference_batch_size' for the model,
+    which defaults to the batch size in the configuration. The padding in the last batch is not
+    run through the model, see 'rechunk_batches'.
+    """
 
     logger.info(f"Running {model_name} model")
 
@@ -227,64 +497,96 @@ def general_forecast_run_all_batches(
             os.path.dirname(nowcasting_forecast.__file__), "config", "mvp_v0.yaml"
         )
     logger.debug(f"Loading configuration {configuration_file}")
-    configuration = load_yaml_configuration(filename=configuration_file)
+    configuration = load_configuration(filename=configuration_file)
     batch_size = configuration.process.batch_size
 
     n_batches = int(np.ceil(n_gsps / batch_size))
+    if inference_batch_size is None:
+        inference_batch_size = batch_size
+    n_inference_batches = int(np.ceil(n_gsps / inference_batch_size))
+    logger.debug(
+        f"Running {n_inference_batches} batches of {inference_batch_size} examples, "
+        f"from {n_batches} batches of {batch_size} examples"
+    )
 
     if batches_dir is not None:
         configuration.output_data.filepath = Path(batches_dir)
 
+    if batch_producer is not None:
+        batches = batch_producer
+
     # make dataloader
     if dataloader is None:
-        dataloader = iter(BatchDataLoader(n_batches=n_batches, configuration=configuration))
+        dataloader = iter(
+            BatchDataLoader(n_batches=n_batches, configuration=configuration, batches=batches)
+        )
 
-    # make pytorch model
-    if ml_model is not None:
-        if use_hf:
-            model = ml_model()
-            model = model.load_model(use_hf=use_hf).eval()
-        else:
-            model = ml_model()
-            model = model.load_model(remote_filename=weights_file).eval()
+    # make pytorch model, this is run in inference mode
+    if (pytorch_model is None) and (ml_model is not None):
+        pytorch_model = load_ml_model(
+            ml_model=ml_model, use_hf=use_hf, weights_file=weights_file, backend=backend
+        )
+
+    # run the batches in this process, or in a pool of workers
+    batch_runner_kwargs = dict(
+        callable_function_for_on_batch=callable_function_for_on_batch,
+        model=pytorch_model,
+        quantize=quantize,
+        quantize_tolerance_mw=quantize_tolerance_mw,
+    )
+    n_workers = min(n_workers, n_inference_batches)
+    if n_workers > 1:
+        batch_runner = ParallelBatchRunner(n_workers=n_workers, **batch_runner_kwargs)
     else:
-        model = None
+        batch_runner = BatchRunner(**batch_runner_kwargs)
 
     # loop over batch
     forecasts = []
-    for i in range(n_batches):
-        logger.debug(f"Running batch {i} into model")
-
-        # calculate how many examples are needed
-        n_examples = np.min([n_gsps - i * batch_size, batch_size])
-        batch = next(dataloader)
-
-        callbacks_args = dict(batch=batch, n_examples=n_examples)
-
-        if ml_model is not None:
-            callbacks_args["pytorch_model"] = model
-
-        forecast_one_batch = callable_function_for_on_batch(**callbacks_args)
-
-        if i == 0:
-            logger.debug(
-                f"First forecasts are "
-                f'{forecast_one_batch[["target_datetime_utc","forecast_gsp_pv_outturn_mw"]]} '
-                f"{forecast_one_batch}"
-            )
+    inference_batches = rechunk_batches(
+        dataloader=dataloader,
+        n_batches=n_batches,
+        n_gsps=n_gsps,
+        inference_batch_size=inference_batch_size,
+    )
+    try:
+        while True:
+            with stage("get_batch"):
+                batch_and_n_examples = next(inference_batches, None)
+            if batch_and_n_examples is None:
+                break
+
+            logger.debug(f"Running batch {len(forecasts)} into model")
+            batch, n_examples = batch_and_n_examples
+            forecasts.append(batch_runner.submit(batch=batch, n_examples=n_examples))
+
+        with stage("wait_for_batches"):
+            forecasts = [forecast.result() for forecast in forecasts]
+    finally:
+        batch_runner.close()
+        if batch_producer is not None:
+            batch_producer.stop()
+
+    logger.debug(
+        f"First forecasts are "
+        f'{forecasts[0][["target_datetime_utc","forecast_gsp_pv_outturn_mw"]]} '
+        f"{forecasts[0]}"
+    )
 
-        forecasts.append(forecast_one_batch)
+    if batch_producer is not None:
+        batch_producer.log_overlap()
 
     # make into one big dataframe
     forecasts = pd.concat(forecasts)
 
     # convert dataframe to ForecastSQL
-    forecast_sql = convert_to_forecast_sql(
-        results_df=forecasts, session=session, model_name=model_name
-    )
+    with stage("convert_to_forecast_sql"):
+        forecast_sql = convert_to_forecast_sql(
+            results_df=forecasts, session=session, model_name=model_name
+        )
 
     # filter forecast for sun
-    forecast_sql = filter_forecasts_on_sun_elevation(forecasts=forecast_sql)
+    with stage("sun_filter"):
+        forecast_sql = filter_forecasts_on_sun_elevation(forecasts=forecast_sql)
 
     # select first 317 forecast
     if len(forecast_sql) > n_gsps:
@@ -299,9 +601,11 @@ def general_forecast_run_all_batches(
     if add_national_forecast:
         # add national forecast
         try:
-            forecast_sql.append(
-                make_national_forecast(forecasts=forecast_sql, n_gsps=n_gsps, session=session)
-            )
+            with stage("national_forecast"):
+                national_forecast = make_national_forecast(
+                    forecasts=forecast_sql, n_gsps=n_gsps, session=session
+                )
+            forecast_sql.append(national_forecast)
         except Exception as e:
             logger.error(e)
             # TODO remove this
@@ -0,0 +1,123 @@
+""" Useful functions for xarray objects
+
+1. xr array and xr dataset --> to torch functions
+
+The tensors share memory with the numpy arrays of the xarray objects where they can,
+i.e. when the dtype is already right. Re-ordering the dims is done as a strided view,
+so this does not copy the data either. The tensors must not be changed in place,
+as this would change the batch too.
+
+The 'torch' accessor is also used by 'nowcasting_dataloader', e.g. in 'BatchML.from_batch',
+so this replaces any accessor that has already been registered.
+"""
+from typing import List, Optional, Sequence
+
+import numpy as np
+import torch
+import xarray as xr
+
+NWP_DIMS = ("example", "channels_index", "time_index", "y_osgb_index", "x_osgb_index")
+
+
+def to_tensor(
+    data_array: xr.DataArray,
+    dtype: torch.dtype = torch.float32,
+    dims: Optional[Sequence[str]] = None,
+) -> torch.Tensor:
+    """
+    Get a tensor of a DataArray, without copying the data if possible
+
+    The data is only copied if it has to be changed to 'dtype'.
+    Datetimes are changed to integer nanoseconds, as a view, before this.
+
+    Args:
+        data_array: the data array
+        dtype: the dtype of the tensor
+        dims: optional order of the dims of the tensor
+
+    Returns: tensor
+    """
+    if (dims is not None) and (tuple(data_array.dims) != tuple(dims)):
+        data_array = data_array.transpose(*dims)
+
+    data = np.asarray(data_array.data)
+    if np.issubdtype(data.dtype, np.datetime64):
+        data = data.view(np.int64)
+
+    if (not data.flags.writeable) or any(stride < 0 for stride in data.strides):
+        # torch can not share memory with read only or reversed arrays
+        return torch.tensor(data, dtype=dtype)
+
+    return torch.from_numpy(data).to(dtype)
+
+
+def register_xr_data_array_to_tensor():
+    """Add torch object to data array"""
+    if getattr(xr.DataArray, "torch", None) is DataArrayTorchAccessor:
+        return
+    if hasattr(xr.DataArray, "torch"):
+        del xr.DataArray.torch
+    xr.register_dataarray_accessor("torch")(DataArrayTorchAccessor)
+
+
+def register_xr_data_set_to_tensor():
+    """Add torch object to dataset"""
+    if getattr(xr.Dataset, "torch", None) is DatasetTorchAccessor:
+        return
+    if hasattr(xr.Dataset, "torch"):
+        del xr.Dataset.torch
+    xr.register_dataset_accessor("torch")(DatasetTorchAccessor)
+
+
+class DataArrayTorchAccessor:
+    """Torch accessor of a DataArray"""
+
+    def __init__(self, xarray_obj: xr.DataArray):
+        """Accessor of the DataArray"""
+        self._obj = xarray_obj
+
+    def to_tensor(self) -> torch.Tensor:
+        """Convert this DataArray to a torch.Tensor"""
+        return to_tensor(self._obj)
+
+
+class DatasetTorchAccessor:
+    """Torch accessor of a Dataset"""
+
+    def __init__(self, xdataset_obj: xr.Dataset):
+        """Accessor of the Dataset"""
+        self._obj = xdataset_obj
+
+    def to_tensor(self, data_vars: List[str]) -> dict:
+        """Convert this Dataset to dictionary of torch tensors"""
+        torch_dict = {}
+
+        for data_var in data_vars:
+            v = getattr(self._obj, data_var)
+
+            if data_var.find("time") != -1:
+                torch_dict[data_var] = to_tensor(v, dtype=torch.float64)
+            else:
+                torch_dict[data_var] = to_tensor(v)
+
+        return torch_dict
+
+
+register_xr_data_array_to_tensor()
+register_xr_data_set_to_tensor()
+
+
+def re_order_dims(xr_dataset: xr.Dataset, expected_dims_order: Optional = None):
+    """
+    Re order dims to B,C,T,H,W
+
+    Note this changes the dataset. Use 'to_tensor' with 'dims' to get the data in this order,
+    without changing the dataset.
+    """
+    if expected_dims_order is None:
+        expected_dims_order = NWP_DIMS
+
+    if xr_dataset.data.dims != expected_dims_order:
+        xr_dataset.__setitem__("data", xr_dataset.data.transpose(*expected_dims_order))
+
+    return xr_dataset
@@ -0,0 +1,171 @@
+""" Time each stage of a forecast run
+
+Stages are timed with 'stage', either as a context manager or a decorator:
+
+    with stage("make_batches"):
+        ...
+
+    @stage("save")
+    def save(...):
+        ...
+
+Nothing is recorded unless profiling has been started with 'profile_run',
+so the stages cost almost nothing when profiling is off.
+At the end of 'profile_run' a json report is saved, with the wall time, cpu time and
+peak memory of each stage. Optionally a cProfile of the whole run is saved too.
+"""
+import cProfile
+import json
+import logging
+import os
+import resource
+import tempfile
+import threading
+import time
+from contextlib import ContextDecorator, contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+import fsspec
+
+logger = logging.getLogger(__name__)
+
+# the report of the run being profiled, this is None when profiling is off
+_report: Optional["ProfilingReport"] = None
+
+
+def get_peak_rss_mb() -> float:
+    """Get the peak memory (resident set size) of this process so far, in MB"""
+    # note this is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ProfilingReport:
+    """The timings of each stage of one run"""
+
+    def __init__(self):
+        """Start the report, with no stages"""
+        self.start_time_utc = datetime.now(timezone.utc)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, wall_seconds: float, cpu_seconds: float):
+        """Add one timing of a stage, stages that run several times are added together"""
+        with self.lock:
+            timings = self.stages.setdefault(
+                name, dict(wall_seconds=0.0, cpu_seconds=0.0, peak_rss_mb=0.0, count=0)
+            )
+            timings["wall_seconds"] += wall_seconds
+            timings["cpu_seconds"] += cpu_seconds
+            timings["peak_rss_mb"] = get_peak_rss_mb()
+            timings["count"] += 1
+
+    def to_dict(self) -> dict:
+        """Make the report into a dictionary, which can be saved as json"""
+        return dict(
+            start_time_utc=self.start_time_utc.isoformat(),
+            total=dict(
+                wall_seconds=time.perf_counter() - self.start_wall,
+                cpu_seconds=time.process_time() - self.start_cpu,
+                peak_rss_mb=get_peak_rss_mb(),
+            ),
+            stages=self.stages,
+        )
+
+
+def is_profiling() -> bool:
+    """Is a run being profiled, see 'profile_run'"""
+    return _report is not None
+
+
+class stage(ContextDecorator):
+    """
+    Time a stage of the run, if profiling is on
+
+    The cpu time is for the whole process, so it includes other threads,
+    and the peak memory is the peak of the process up to the end of the stage.
+    """
+
+    def __init__(self, name: str):
+        """Name of the stage in the report"""
+        self.name = name
+
+    def _recreate_cm(self):
+        """When used as a decorator, use a new timer for each call, so calls can overlap"""
+        return stage(self.name)
+
+    def __enter__(self):
+        """Start timing"""
+        self.report = _report
+        if self.report is not None:
+            self.start_wall = time.perf_counter()
+            self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        """Stop timing, and add it to the report"""
+        if self.report is not None:
+            self.report.add(
+                name=self.name,
+                wall_seconds=time.perf_counter() - self.start_wall,
+                cpu_seconds=time.process_time() - self.start_cpu,
+            )
+        return False
+
+
+@contextmanager
+def profile_run(
+    report_filename: Optional[str] = None, use_cprofile: bool = False
+) -> Iterator[Optional[ProfilingReport]]:
+    """
+    Profile a run, and save the report at the end
+
+    Args:
+        report_filename: where to save the json report. If None, profiling is off.
+        use_cprofile: option to also save a cProfile of the run, to '<report_filename>.prof'.
+            Note this only profiles the thread that the run was started from.
+
+    Returns: the report, or None if profiling is off
+    """
+    global _report
+
+    if report_filename is None:
+        yield None
+        return
+
+    _report = ProfilingReport()
+    profiler = cProfile.Profile() if use_cprofile else None
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield _report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+        report, _report = _report, None
+        save_report(report=report, report_filename=report_filename)
+        if profiler is not None:
+            with tempfile.TemporaryDirectory() as temporary_dir:
+                local_filename = os.path.join(temporary_dir, "profile.prof")
+                profiler.dump_stats(local_filename)
+                fs = fsspec.open(report_filename).fs
+                fs.put(local_filename, f"{report_filename}.prof")
+
+
+def save_report(report: ProfilingReport, report_filename: str):
+    """Save the report as json, and log the time of each stage"""
+    report_dict = report.to_dict()
+
+    for name, timings in report_dict["stages"].items():
+        logger.info(
+            f"Stage {name} took {timings['wall_seconds']:.2f} seconds "
+            f"({timings['cpu_seconds']:.2f} cpu seconds, run {timings['count']} times)"
+        )
+    logger.info(f"Saving profiling report to {report_filename}")
+
+    with fsspec.open(report_filename, "w") as file:
+        json.dump(report_dict, file, indent=4)
@@ -0,0 +1,344 @@
+""" Save forecasts to the database, in bulk
+
+'nowcasting_datamodel.save.save' adds the forecasts through the sqlalchemy ORM,
+which makes one INSERT for each forecast value, and one upsert for each gsp in the latest table.
+Here the same tables are written, but with multi-row inserts and set based upserts,
+in chunks of 'chunk_size' rows.
+
+1. Add the adjuster to the national forecast
+2. Insert the forecasts and the forecast values
+3. Upsert the forecast values into the latest table
+4. Insert the forecast values into the last seven days table
+"""
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+from nowcasting_datamodel.models import (
+    ForecastSQL,
+    ForecastValueLatestSQL,
+    ForecastValueSevenDaysSQL,
+    ForecastValueSQL,
+    LocationSQL,
+    MLModelSQL,
+)
+from nowcasting_datamodel.save.adjust import add_adjust_to_forecasts
+from nowcasting_datamodel.save.save import save
+from nowcasting_datamodel.save.update import get_gsp_ids
+from sqlalchemy import delete, insert, update
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
+from sqlalchemy.orm.session import Session
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def save_forecasts(
+    forecasts: List[ForecastSQL],
+    session: Session,
+    update_national: Optional[bool] = True,
+    update_gsp: Optional[bool] = True,
+    apply_adjuster: Optional[bool] = True,
+    bulk: bool = False,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    """
+    Save forecasts to the database
+
+    Args:
+        forecasts: list of sql forecasts
+        session: database session
+        update_national: option to update the national forecast in the latest table
+        update_gsp: option to update all the gsp forecasts in the latest table
+        apply_adjuster: option to apply the adjuster,
+            this can be overwritten by the "USE_ADJUSTER" env var
+        bulk: option to save in bulk, otherwise forecasts are saved through the ORM
+        chunk_size: the number of rows in each insert, when saving in bulk
+    """
+
+    if not bulk:
+        save(
+            forecasts=forecasts,
+            session=session,
+            update_national=update_national,
+            update_gsp=update_gsp,
+            apply_adjuster=apply_adjuster,
+        )
+        return
+
+    # Make sure the ORM does not try to add the forecasts as well.
+    # Everything is committed at the end, so the objects are not reloaded in between.
+    with session.no_autoflush:
+        use_adjuster_env_var = bool(os.getenv("USE_ADJUSTER", "True").lower() in ["true", "1"])
+        if apply_adjuster and use_adjuster_env_var:
+            logger.debug("Add Adjust to forecasts")
+            add_adjust_to_forecasts(session=session, forecasts_sql=forecasts)
+
+        logger.debug("Saving forecasts")
+        insert_forecasts(session=session, forecasts=forecasts, chunk_size=chunk_size)
+
+        logger.debug("Updating to latest")
+        upsert_forecast_values_latest(
+            session=session,
+            forecasts=forecasts,
+            update_national=update_national,
+            update_gsp=update_gsp,
+            chunk_size=chunk_size,
+        )
+
+        logger.debug("Saving to last seven days table")
+        insert_forecast_values_last_seven_days(
+            session=session, forecasts=forecasts, chunk_size=chunk_size
+        )
+
+    session.commit()
+
+
+def chunks(rows: List, chunk_size: int) -> Iterator[List]:
+    """Split rows into chunks of 'chunk_size'"""
+    for i in range(0, len(rows), chunk_size):
+        yield rows[i : i + chunk_size]
+
+
+def insert_forecasts(session: Session, forecasts: List[ForecastSQL], chunk_size: int):
+    """
+    Insert the forecasts, and their forecast values
+
+    The forecast ids and the forecast value uuids are set on the objects,
+    but the objects are not added to the session. Nothing is committed.
+    Forecasts which are already in the database are not inserted again.
+
+    Args:
+        session: database session
+        forecasts: list of sql forecasts
+        chunk_size: the number of rows in each insert
+    """
+
+    new_forecasts = [forecast for forecast in forecasts if forecast.id is None]
+
+    # these could have been added to the session, e.g. through the location backref
+    for forecast in new_forecasts:
+        for forecast_value in forecast.forecast_values:
+            if forecast_value in session:
+                session.expunge(forecast_value)
+        if forecast in session:
+            session.expunge(forecast)
+
+    forecast_rows = [
+        dict(
+            forecast_creation_time=forecast.forecast_creation_time,
+            historic=forecast.historic,
+            model_id=forecast.model.id,
+            location_id=forecast.location.id,
+            input_data_last_updated_id=forecast.input_data_last_updated.id,
+            created_utc=datetime.now(tz=timezone.utc),
+        )
+        for forecast in new_forecasts
+    ]
+    forecast_ids = insert_and_return_ids(
+        session=session, table=ForecastSQL.__table__, rows=forecast_rows, chunk_size=chunk_size
+    )
+    for forecast, forecast_id in zip(new_forecasts, forecast_ids):
+        forecast.id = forecast_id
+
+    forecast_value_rows = []
+    for forecast in new_forecasts:
+        for forecast_value in forecast.forecast_values:
+            # the same uuid is used in the last seven days table
+            forecast_value.uuid = str(uuid.uuid4())
+            forecast_value.forecast_id = forecast.id
+            forecast_value.created_utc = datetime.now(tz=timezone.utc)
+            forecast_value_rows.append(forecast_value_to_dict(forecast_value))
+
+    for rows in chunks(forecast_value_rows, chunk_size):
+        session.execute(insert(ForecastValueSQL.__table__), rows)
+
+    logger.debug(f"Inserted {len(forecast_rows)} forecasts and {len(forecast_value_rows)} values")
+
+
+def insert_and_return_ids(session: Session, table, rows: List[dict], chunk_size: int) -> List[int]:
+    """Insert rows, with one multi-row insert for each chunk, and return the new ids in order"""
+    ids = []
+    for rows_chunk in chunks(rows, chunk_size):
+        # The location is returned as well, so the ids do not rely on the order of RETURNING.
+        # Postgres does return them in order, so we use that if there are duplicate locations.
+        statement = insert(table).values(rows_chunk).returning(table.c.id, table.c.location_id)
+        results = session.execute(statement).all()
+        ids_by_location = {location_id: id for id, location_id in results}
+
+        if len(ids_by_location) == len(rows_chunk):
+            ids += [ids_by_location[row["location_id"]] for row in rows_chunk]
+        else:
+            ids += [id for id, _ in results]
+
+    return ids
+
+
+def forecast_value_to_dict(forecast_value: ForecastValueSQL) -> dict:
+    """Get the columns of a forecast value, which are shared with the last seven days table"""
+    return dict(
+        uuid=forecast_value.uuid,
+        target_time=forecast_value.target_time,
+        expected_power_generation_megawatts=forecast_value.expected_power_generation_megawatts,
+        adjust_mw=forecast_value.adjust_mw if forecast_value.adjust_mw is not None else 0.0,
+        properties=forecast_value.properties,
+        forecast_id=forecast_value.forecast_id,
+        created_utc=forecast_value.created_utc,
+    )
+
+
+def get_historic_forecast_ids(session: Session, forecasts: List[ForecastSQL]) -> Dict[int, int]:
+    """
+    Get the ids of the historic forecasts, for the gsps in 'forecasts', in one query
+
+    Historic forecasts are made for any gsps that do not have one yet.
+
+    Args:
+        session: database session
+        forecasts: list of sql forecasts, all from the same model
+
+    Returns: dictionary of historic forecast ids, keyed by gsp id
+    """
+
+    gsp_ids = [forecast.location.gsp_id for forecast in forecasts]
+    model_name = forecasts[0].model.name
+
+    query = session.query(LocationSQL.gsp_id, ForecastSQL.id)
+    query = query.join(ForecastSQL.location)
+    query = query.join(ForecastSQL.model)
+    query = query.filter(ForecastSQL.historic == True)  # noqa: E712
+    query = query.filter(MLModelSQL.name == model_name)
+    query = query.filter(LocationSQL.gsp_id.in_(gsp_ids))
+    query = query.distinct(LocationSQL.gsp_id)
+    query = query.order_by(LocationSQL.gsp_id, ForecastSQL.created_utc.desc())
+    historic_ids = {gsp_id: forecast_id for gsp_id, forecast_id in query.all()}
+
+    missing_forecasts = [f for f in forecasts if f.location.gsp_id not in historic_ids]
+    if len(missing_forecasts) > 0:
+        logger.debug(f"Could not find {len(missing_forecasts)} historic forecasts, so making them")
+        rows = [
+            dict(
+                historic=True,
+                forecast_creation_time=datetime.now(tz=timezone.utc),
+                model_id=forecast.model.id,
+                location_id=forecast.location.id,
+                input_data_last_updated_id=forecast.input_data_last_updated.id,
+                created_utc=datetime.now(tz=timezone.utc),
+            )
+            for forecast in missing_forecasts
+        ]
+        ids = insert_and_return_ids(
+            session=session, table=ForecastSQL.__table__, rows=rows, chunk_size=len(rows)
+        )
+        for forecast, forecast_id in zip(missing_forecasts, ids):
+            historic_ids[forecast.location.gsp_id] = forecast_id
+
+    return historic_ids
+
+
+def upsert_forecast_values_latest(
+    session: Session,
+    forecasts: List[ForecastSQL],
+    update_national: Optional[bool] = True,
+    update_gsp: Optional[bool] = True,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    """
+    Upsert the forecast values into the latest table, with one statement for each chunk
+
+    This does the same as 'nowcasting_datamodel.save.update.update_all_forecast_latest'.
+
+    Args:
+        session: database session
+        forecasts: list of sql forecasts
+        update_national: option to update the national forecast
+        update_gsp: option to update all the gsp forecasts
+        chunk_size: the number of rows in each upsert
+    """
+
+    gsp_ids = get_gsp_ids(include_national=update_national, include_gsps=update_gsp)
+    forecasts = [forecast for forecast in forecasts if forecast.location.gsp_id in gsp_ids]
+    if len(forecasts) == 0:
+        logger.warning(f"Will not be updating any GSPs as {update_national=} and {update_gsp=}")
+        return
+
+    historic_ids = get_historic_forecast_ids(session=session, forecasts=forecasts)
+
+    # one row for each primary key, the last one is used if there are duplicates
+    rows = {}
+    for forecast in forecasts:
+        gsp_id = forecast.location.gsp_id
+        for forecast_value in forecast.forecast_values:
+            key = (forecast_value.target_time, gsp_id, forecast.model.id)
+            rows[key] = dict(
+                target_time=forecast_value.target_time,
+                expected_power_generation_megawatts=(
+                    forecast_value.expected_power_generation_megawatts
+                ),
+                adjust_mw=forecast_value.adjust_mw if forecast_value.adjust_mw is not None else 0.0,
+                properties=forecast_value.properties,
+                gsp_id=gsp_id,
+                model_id=forecast.model.id,
+                forecast_id=historic_ids[gsp_id],
+                is_primary=True,
+                created_utc=datetime.now(tz=timezone.utc),
+            )
+    rows = list(rows.values())
+
+    table = ForecastValueLatestSQL.__table__
+    for rows_chunk in chunks(rows, chunk_size):
+        statement = postgres_insert(table).values(rows_chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=[key.name for key in table.primary_key],
+            set_={c.name: c for c in statement.excluded if not c.primary_key},
+        )
+        session.execute(statement)
+
+    # update forecast creation time
+    session.execute(
+        update(ForecastSQL)
+        .where(ForecastSQL.id.in_(list(historic_ids.values())))
+        .values(forecast_creation_time=datetime.now(tz=timezone.utc))
+    )
+
+    # Delete forecasts older than 3 days from the forecast_latest table
+    session.execute(
+        delete(ForecastValueLatestSQL).where(
+            ForecastValueLatestSQL.target_time < datetime.now(timezone.utc) - timedelta(days=3)
+        )
+    )
+
+    logger.debug(f"Upserted {len(rows)} latest forecast values for {len(historic_ids)} gsps")
+
+
+def insert_forecast_values_last_seven_days(
+    session: Session, forecasts: List[ForecastSQL], chunk_size: int = DEFAULT_CHUNK_SIZE
+):
+    """
+    Insert the forecast values into the last seven days table, and remove old values
+
+    Args:
+        session: database session
+        forecasts: list of sql forecasts, which have been inserted already
+        chunk_size: the number of rows in each insert
+    """
+
+    rows = [
+        forecast_value_to_dict(forecast_value)
+        for forecast in forecasts
+        for forecast_value in forecast.forecast_values
+    ]
+    for rows_chunk in chunks(rows, chunk_size):
+        session.execute(insert(ForecastValueSevenDaysSQL.__table__), rows_chunk)
+
+    # remove old data
+    now_minus_7_days = datetime.now(tz=timezone.utc) - timedelta(days=7)
+    logger.debug(f"Removing data before {now_minus_7_days}")
+    session.execute(
+        delete(ForecastValueSevenDaysSQL).where(
+            ForecastValueSevenDaysSQL.target_time < now_minus_7_days
+        )
+    )
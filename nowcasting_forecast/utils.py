@@ -1,8 +1,15 @@
 """ Utils functions """
+import os
+from contextlib import contextmanager
 from datetime import timedelta
-from typing import Optional
+from functools import lru_cache
+from typing import Iterator, Optional
 
 import numpy as np
+from nowcasting_dataset.config.load import load_yaml_configuration
+from nowcasting_dataset.config.model import Configuration
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 
 def floor_minutes_dt(dt, minutes: Optional[int] = 30):
@@ -23,3 +30,63 @@ def floor_minutes_dt(dt, minutes: Optional[int] = 30):
     dt += timedelta(minutes=approx)
 
     return dt
+
+
+@lru_cache()
+def _load_configuration(filename: str, modified_time: Optional[float] = None) -> Configuration:
+    """Load and validate a configuration file, this is only done once per file and version"""
+    return load_yaml_configuration(filename=filename)
+
+
+def load_configuration(filename: str) -> Configuration:
+    """
+    Load a configuration file
+
+    The file is only read again if it has changed,
+    so this is cheap when the app makes lots of forecasts.
+    A copy is returned, so the configuration can be changed by the caller.
+
+    Args:
+        filename: the yaml configuration file
+
+    Returns: configuration
+    """
+    filename = str(filename)
+    modified_time = os.path.getmtime(filename) if os.path.exists(filename) else None
+
+    return _load_configuration(filename=filename, modified_time=modified_time).copy(deep=True)
+
+
+class DatabaseQueryCounter:
+    """Count the number of queries sent to the database"""
+
+    def __init__(self):
+        """Start counting from zero"""
+        self.n_queries = 0
+
+    def __call__(self, *args, **kwargs):
+        """Called by sqlalchemy before each query"""
+        self.n_queries += 1
+
+
+@contextmanager
+def count_database_queries(engine: Engine) -> Iterator[DatabaseQueryCounter]:
+    """
+    Count the number of queries, i.e. round trips, made to the database
+
+    For example:
+    with count_database_queries(engine=connection.engine) as counter:
+        ...
+    logger.info(f"Made {counter.n_queries} database queries")
+
+    Args:
+        engine: the database engine
+
+    Returns: counter, with the number of queries in 'n_queries'
+    """
+    counter = DatabaseQueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
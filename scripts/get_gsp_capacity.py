@@ -3,14 +3,44 @@ get the GSP installed solar cpaiacty from pv live
 
 pip install git+https://github.com/SheffieldSolar/PV_Live-API
 
-This script can take ~30 secdson to run
-"""
+This script can take ~30 secdson to run, for each date.
 
-from datetime import datetime
+With one date, the capacity of each gsp is saved. With several dates, e.g.
+    python scripts/get_gsp_capacity.py --start 2022-01-01 --start 2022-07-01
+the capacity of each gsp at each date is saved, with a 'datetime_gmt' column,
+and the app uses the capacity at or before each t0 (see nowcasting_forecast/capacity.py)
+"""
 
+import click
+import pandas as pd
 import pytz
 from nowcasting_dataset.data_sources.gsp.pvlive import get_installed_capacity
 
-c = get_installed_capacity(start=datetime(2022, 2, 14, tzinfo=pytz.utc))
 
-c.to_csv("./nowcasting_forecast/data/gsp_capacity.csv")
+@click.command()
+@click.option(
+    "--start",
+    default=["2022-02-14"],
+    multiple=True,
+    help="The date(s) to get the installed capacity at",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+)
+@click.option("--output", default="./nowcasting_forecast/data/gsp_capacity.csv")
+def run(start, output: str):
+    """Get the installed capacity at each date, and save it"""
+    if len(start) == 1:
+        c = get_installed_capacity(start=start[0].replace(tzinfo=pytz.utc))
+        c.to_csv(output)
+        return
+
+    capacities = []
+    for date in start:
+        c = get_installed_capacity(start=date.replace(tzinfo=pytz.utc)).reset_index()
+        c.insert(0, "datetime_gmt", date.replace(tzinfo=pytz.utc).isoformat())
+        capacities.append(c)
+
+    pd.concat(capacities).to_csv(output, index=False)
+
+
+if __name__ == "__main__":
+    run()
@@ -30,6 +30,10 @@ setup(
         "forecast",
     ],
     install_requires=install_requires,
+    extras_require={
+        # for the onnxruntime backend, see nowcasting_forecast/models/cnn/export.py
+        "onnx": ["onnx", "onnxruntime"],
+    },
     long_description=long_description,
     long_description_content_type="text/markdown",
 )
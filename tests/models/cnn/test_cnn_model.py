@@ -5,9 +5,13 @@ import pytest
 import torch
 from nowcasting_dataloader.batch import BatchML
 from nowcasting_dataset.config.load import load_yaml_configuration
+from nowcasting_dataset.dataset.batch import Batch
 
 import nowcasting_forecast
+from nowcasting_forecast.batch import select_input_slices
+from nowcasting_forecast.models.cnn.dataloader import iterate_batch_ml
 from nowcasting_forecast.models.cnn.model import Model
+from nowcasting_forecast.models.cnn.nwp_cache import NwpEmbeddingCache
 
 
 def test_model_init():
@@ -56,3 +60,68 @@ def test_forward():
 
     model = Model()
     model.forward(batch)
+
+
+def test_forward_any_batch_size():
+    model = Model().eval()
+    batch_size = 40
+    tensors = (
+        torch.rand(batch_size, 11, 13, 24, 24),
+        torch.rand(batch_size, 1, 4, 64, 64),
+        torch.rand(batch_size, 7, 128),
+        torch.rand(batch_size, 21, 32),
+        torch.randint(1, 317, (batch_size, 32)),
+        torch.rand(batch_size, 31),
+        torch.rand(batch_size, 31),
+    )
+
+    with torch.no_grad():
+        predictions = model.forward_tensors(*tensors)
+        first_predictions = model.forward_tensors(*[tensor[:3] for tensor in tensors])
+
+    assert predictions.shape == (batch_size, model.gsp_forecast_length)
+    torch.testing.assert_close(first_predictions, predictions[:3], rtol=1e-4, atol=1e-5)
+
+
+def test_forward_nwp_embedding_cache():
+    configuration_file = os.path.join(
+        os.path.dirname(nowcasting_forecast.__file__), "config", "mvp_v2.yaml"
+    )
+    configuration = load_yaml_configuration(filename=configuration_file)
+    batch = BatchML.fake(configuration=configuration)
+
+    model = Model().eval()
+    model.nwp_embedding_cache = NwpEmbeddingCache()
+
+    with torch.no_grad():
+        predictions = model.forward_tensors(*model.batch_to_tensors(batch))
+        first_predictions = model(batch)
+        cached_predictions = model(batch)
+
+    torch.testing.assert_close(first_predictions, predictions)
+    torch.testing.assert_close(cached_predictions, predictions)
+    assert model.nwp_embedding_cache.n_hits == batch.metadata.batch_size
+
+
+def test_forward_input_slices():
+    configuration_file = os.path.join(
+        os.path.dirname(nowcasting_forecast.__file__), "config", "mvp_v2.yaml"
+    )
+    configuration = load_yaml_configuration(filename=configuration_file)
+    batch = Batch.fake(configuration=configuration, temporally_align_examples=True)
+
+    model = Model().eval()
+    input_slices = model.input_slices()
+    sliced_batch = batch.copy(
+        update={
+            name: select_input_slices(data_source=getattr(batch, name), input_slices=slices)
+            for name, slices in input_slices.items()
+        }
+    )
+    assert sliced_batch.satellite.sizes["time_index"] == model.cnn_output_size_time
+    assert sliced_batch.pv.sizes["id_index"] < batch.pv.sizes["id_index"]
+
+    # the batch with just the input slices gives the same predictions
+    with torch.no_grad():
+        predictions = [model(batch_ml) for batch_ml in iterate_batch_ml([batch, sliced_batch])]
+    torch.testing.assert_close(predictions[1], predictions[0], rtol=0, atol=0)
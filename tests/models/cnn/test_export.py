@@ -0,0 +1,100 @@
+import os
+import tempfile
+
+import pytest
+import torch
+from nowcasting_dataloader.batch import BatchML
+from nowcasting_dataset.config.load import load_yaml_configuration
+
+import nowcasting_forecast
+from nowcasting_forecast.models.cnn.export import (
+    OnnxRuntimeBackend,
+    TorchScriptBackend,
+    export_onnx,
+    export_torchscript,
+    make_backend,
+)
+from nowcasting_forecast.models.cnn.model import Model
+
+
+@pytest.fixture()
+def model():
+    torch.manual_seed(0)
+    return Model().eval()
+
+
+@pytest.fixture()
+def batch():
+    configuration_file = os.path.join(
+        os.path.dirname(nowcasting_forecast.__file__), "config", "mvp_v2.yaml"
+    )
+    configuration = load_yaml_configuration(filename=configuration_file)
+
+    return BatchML.fake(configuration=configuration)
+
+
+@pytest.fixture()
+def tensors(batch):
+    return Model.batch_to_tensors(batch)
+
+
+def test_backends_same_as_eager(model, batch):
+    with torch.no_grad():
+        predictions = model(batch)
+
+    for backend_name in ["torchscript", "onnxruntime"]:
+        if backend_name == "onnxruntime":
+            pytest.importorskip("onnxruntime")
+
+        backend = make_backend(model=model, backend=backend_name)
+        torch.testing.assert_close(backend(batch), predictions, atol=1e-4, rtol=1e-4)
+
+
+def test_torchscript(model, tensors):
+    with torch.no_grad():
+        predictions = model.forward_tensors(*tensors)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, "model.pt")
+        export_torchscript(model=model, tensors=tensors, filename=filename)
+
+        backend = TorchScriptBackend(filename=filename)
+        torch.testing.assert_close(backend.run_tensors(tensors), predictions)
+
+    # traced on the first batch
+    backend = make_backend(model=model, backend="torchscript")
+    torch.testing.assert_close(backend.run_tensors(tensors), predictions)
+
+
+def test_onnxruntime(model, tensors):
+    pytest.importorskip("onnxruntime")
+
+    with torch.no_grad():
+        predictions = model.forward_tensors(*tensors)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, "model.onnx")
+        export_onnx(model=model, tensors=tensors, filename=filename)
+
+        backend = OnnxRuntimeBackend(filename=filename)
+        torch.testing.assert_close(backend.run_tensors(tensors), predictions, atol=1e-4, rtol=1e-4)
+
+    # exported on the first batch
+    backend = make_backend(model=model, backend="onnxruntime")
+    torch.testing.assert_close(backend.run_tensors(tensors), predictions, atol=1e-4, rtol=1e-4)
+
+    # the batch size is dynamic
+    small_tensors = [tensor[:4] for tensor in tensors]
+    with torch.no_grad():
+        small_predictions = model.forward_tensors(*small_tensors)
+    torch.testing.assert_close(
+        backend.run_tensors(small_tensors), small_predictions, atol=1e-4, rtol=1e-4
+    )
+
+
+def test_make_backend_error(model):
+    with pytest.raises(NotImplementedError):
+        make_backend(model=model, backend="tensorrt")
+
+    with pytest.raises(NotImplementedError):
+        make_backend(model=torch.nn.Linear(2, 2), backend="torchscript")
@@ -0,0 +1,122 @@
+import os
+import tempfile
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from nowcasting_forecast.models.cnn.nwp_cache import (
+    NwpEmbeddingCache,
+    get_model_version,
+    get_nwp_embedding_cache,
+)
+
+
+class NwpModel(nn.Module):
+    """Toy model with just NWP layers"""
+
+    def __init__(self):
+        super().__init__()
+        self.nwp_fc1 = nn.Linear(4, 3)
+
+    def nwp_embedding(self, nwp_data):
+        self.n_examples_run = getattr(self, "n_examples_run", 0) + len(nwp_data)
+        return self.nwp_fc1(nwp_data)
+
+
+def make_batch(gsp_ids, init_time=1000):
+    n_examples = len(gsp_ids)
+    return SimpleNamespace(
+        metadata=SimpleNamespace(id=gsp_ids),
+        nwp=SimpleNamespace(
+            init_time=torch.full((n_examples,), init_time, dtype=torch.float64),
+            time=torch.arange(4, dtype=torch.float64).repeat(n_examples, 1) + init_time,
+        ),
+    )
+
+
+def get_embeddings(cache, model, batch, nwp_data):
+    return cache.get_embeddings(
+        model=model, batch=batch, nwp_data=nwp_data, nwp_embedding=model.nwp_embedding
+    )
+
+
+def test_nwp_embedding_cache():
+    model = NwpModel()
+    cache = NwpEmbeddingCache(max_size=3)
+    nwp_data = torch.rand(2, 4)
+
+    with torch.no_grad():
+        embeddings = get_embeddings(cache, model, make_batch([1, 2]), nwp_data)
+        cached_embeddings = get_embeddings(cache, model, make_batch([1, 2]), nwp_data)
+
+        torch.testing.assert_close(embeddings, model.nwp_fc1(nwp_data))
+        torch.testing.assert_close(cached_embeddings, embeddings)
+        assert model.n_examples_run == 2
+        assert (cache.n_hits, cache.n_misses) == (2, 2)
+
+        # a new nwp init time is a miss
+        _ = get_embeddings(cache, model, make_batch([1, 2], init_time=2000), nwp_data)
+        assert model.n_examples_run == 4
+
+    # the least recently used embedding is dropped
+    assert len(cache) == 3
+    assert all(key[0] != 1 or key[1] != 1000 for key in cache.embeddings.keys())
+
+
+def test_nwp_embedding_cache_save_load():
+    model = NwpModel()
+    nwp_data = torch.rand(2, 4)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "nwp_cache.pt")
+
+        cache = NwpEmbeddingCache(filename=filename)
+        with torch.no_grad():
+            embeddings = get_embeddings(cache, model, make_batch([1, 2]), nwp_data)
+        cache.save()
+
+        loaded_cache = NwpEmbeddingCache(filename=filename)
+        assert len(loaded_cache) == 2
+        with torch.no_grad():
+            loaded_embeddings = get_embeddings(loaded_cache, model, make_batch([1, 2]), nwp_data)
+        torch.testing.assert_close(loaded_embeddings, embeddings)
+        assert loaded_cache.n_hits == 2
+
+
+def test_get_model_version():
+    model = NwpModel()
+    version = get_model_version(model)
+    assert get_model_version(model) == version
+
+    with torch.no_grad():
+        model.nwp_fc1.weight.add_(1)
+    assert get_model_version(model) != version
+
+
+def test_nwp_embedding_cache_load_state_dict():
+    model = NwpModel()
+    cache = NwpEmbeddingCache()
+    nwp_data = torch.rand(2, 4)
+
+    with torch.no_grad():
+        _ = get_embeddings(cache, model, make_batch([1, 2]), nwp_data)
+
+        # new weights are loaded into the same model, so the embeddings are worked out again
+        model.load_state_dict(NwpModel().state_dict())
+        embeddings = get_embeddings(cache, model, make_batch([1, 2]), nwp_data)
+
+    torch.testing.assert_close(embeddings, model.nwp_fc1(nwp_data))
+    assert model.n_examples_run == 4
+
+
+def test_get_nwp_embedding_cache(monkeypatch):
+    get_nwp_embedding_cache.cache_clear()
+    monkeypatch.delenv("NWP_EMBEDDING_CACHE_SIZE", raising=False)
+    assert get_nwp_embedding_cache() is None
+
+    get_nwp_embedding_cache.cache_clear()
+    monkeypatch.setenv("NWP_EMBEDDING_CACHE_SIZE", "10")
+    assert get_nwp_embedding_cache().max_size == 10
+
+    get_nwp_embedding_cache.cache_clear()
@@ -1,5 +1,6 @@
 import os
 
+import numpy as np
 import torch
 from nowcasting_datamodel.models import InputDataLastUpdatedSQL, LocationSQL
 
@@ -8,6 +9,7 @@ from nowcasting_forecast.models.nwp_simple_trained.nwp_simple_trained import (
     nwp_irradiance_simple_trained,
     nwp_irradiance_simple_trained_run_one_batch,
 )
+from nowcasting_forecast.models.optimization import optimize_model
 from nowcasting_forecast.models.utils import check_results_df
 
 
@@ -24,6 +26,19 @@ def test_nwp_irradiance_simple(batch_nwp):
     _ = nwp_irradiance_simple_trained(batch=batch_nwp, model=model)
 
 
+def test_nwp_irradiance_simple_optimized(batch_nwp):
+    model = Model().eval()
+    optimized_model = optimize_model(model, input_normalization=model.input_normalization)
+
+    # the optimized model takes the nwp data as it is, the same as the model on normalized data
+    np.testing.assert_allclose(
+        nwp_irradiance_simple_trained(batch=batch_nwp, model=optimized_model),
+        nwp_irradiance_simple_trained(batch=batch_nwp, model=model),
+        rtol=1e-3,
+        atol=1e-3,
+    )
+
+
 def test_nwp_irradiance_simple_run_one_batch(batch_nwp, db_session):
     model = Model()
     f = nwp_irradiance_simple_trained_run_one_batch(batch=batch_nwp, pytorch_model=model)
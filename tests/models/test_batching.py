@@ -0,0 +1,77 @@
+import copy
+
+import numpy as np
+import torch
+from nowcasting_dataloader.batch import BatchML
+
+from nowcasting_forecast.models.batching import concatenate_batches, rechunk_batches
+
+
+def make_batches(batch, n_batches: int) -> list:
+    """Copies of the batch, with the gsp ids 1, 2, 3, ... over all the batches"""
+    batches = []
+    for batch_idx in range(n_batches):
+        batch_copy = copy.deepcopy(batch)
+        for i, location in enumerate(batch_copy.metadata.space_time_locations):
+            location.id = batch_idx * batch.metadata.batch_size + i + 1
+        batches.append(batch_copy)
+    return batches
+
+
+def test_rechunk_batches_default(batch):
+    batches = make_batches(batch, n_batches=2)
+
+    inference_batches = list(rechunk_batches(dataloader=iter(batches), n_batches=2, n_gsps=6))
+
+    # the first batch is used as it is, the padding is removed from the last batch
+    assert [n_examples for _, n_examples in inference_batches] == [4, 2]
+    assert inference_batches[0][0] is batches[0]
+    assert inference_batches[1][0].metadata.batch_size == 2
+    assert inference_batches[1][0].metadata.ids == [5, 6]
+
+
+def test_rechunk_batches_larger(batch):
+    batches = make_batches(batch, n_batches=2)
+
+    inference_batches = list(
+        rechunk_batches(dataloader=iter(batches), n_batches=2, n_gsps=6, inference_batch_size=8)
+    )
+
+    assert [n_examples for _, n_examples in inference_batches] == [6]
+    inference_batch = inference_batches[0][0]
+    assert inference_batch.metadata.ids == [1, 2, 3, 4, 5, 6]
+    np.testing.assert_array_equal(
+        inference_batch.nwp.data.values,
+        np.concatenate([batches[0].nwp.data.values, batches[1].nwp.data.values[:2]]),
+    )
+
+
+def test_rechunk_batches_smaller(batch):
+    batches = make_batches(batch, n_batches=2)
+
+    inference_batches = list(
+        rechunk_batches(
+            dataloader=iter([batch.dict() for batch in batches]),
+            n_batches=2,
+            n_gsps=8,
+            inference_batch_size=3,
+        )
+    )
+
+    assert [n_examples for _, n_examples in inference_batches] == [3, 3, 2]
+    ids = [gsp_id for batch, _ in inference_batches for gsp_id in batch.metadata.ids]
+    assert ids == list(range(1, 9))
+
+
+def test_concatenate_batch_mls(batch):
+    batch_mls = [BatchML.from_batch(batch=batch) for batch in make_batches(batch, n_batches=2)]
+
+    batch_ml = concatenate_batches([(batch_mls[0], 1, 4), (batch_mls[1], 0, 2)])
+
+    assert batch_ml.metadata.batch_size == 5
+    assert list(batch_ml.metadata.id) == [2, 3, 4, 5, 6]
+    torch.testing.assert_close(
+        batch_ml.satellite.data,
+        torch.cat([batch_mls[0].satellite.data[1:4], batch_mls[1].satellite.data[0:2]]),
+    )
+    assert batch_ml.satellite.data.shape[0] == 5
@@ -0,0 +1,173 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+from nowcasting_datamodel.fake import make_fake_forecasts
+from nowcasting_dataset.dataset.batch import Batch
+
+from nowcasting_forecast.models.cnn.model import Model as CNN_Model
+from nowcasting_forecast.models.ensemble import (
+    DATA_SOURCE_NAMES,
+    blend_forecasts,
+    make_union_configuration,
+    make_union_input_slices,
+    merge_data_sources,
+    parse_blend_weights,
+    parse_model_names,
+    select_model_inputs,
+)
+from nowcasting_forecast.models.registry import get_registered_model
+from nowcasting_forecast.utils import load_configuration
+
+
+def test_parse_model_names():
+    assert parse_model_names("cnn") == ["cnn"]
+    assert parse_model_names("cnn, nwp_simple_trained") == ["cnn", "nwp_simple_trained"]
+
+
+def test_parse_blend_weights():
+    assert parse_blend_weights("cnn:0.7,nwp_simple_trained:0.3") == {
+        "cnn": 0.7,
+        "nwp_simple_trained": 0.3,
+    }
+
+    with pytest.raises(ValueError):
+        parse_blend_weights("cnn:0")
+
+
+def test_make_union_configuration():
+    cnn = get_registered_model("cnn")
+    nwp_simple_trained = get_registered_model("nwp_simple_trained")
+
+    union = make_union_configuration([nwp_simple_trained, cnn])
+
+    other_union = make_union_configuration([cnn, nwp_simple_trained])
+    for data_source_name in DATA_SOURCE_NAMES:
+        assert getattr(union.input_data, data_source_name) == getattr(
+            other_union.input_data, data_source_name
+        )
+    assert union.input_data.nwp == load_configuration(cnn.configuration_file).input_data.nwp
+    assert union.input_data.gsp.is_live
+    assert union.input_data.satellite is not None
+    assert union.input_data.opticalflow is None
+
+
+def test_make_union_configuration_input_slices():
+    cnn = get_registered_model("cnn")
+    input_slices = {cnn.name: {"pv": {"id_index": 128}}}
+
+    union = make_union_configuration([cnn], input_slices=input_slices)
+    assert union.input_data.pv.n_pv_systems_per_example == 128
+
+    # the most systems that either model reads
+    pv = union.input_data.pv.copy(deep=True)
+    pv.n_pv_systems_per_example = 256
+    merged = merge_data_sources("pv", [(cnn.name, union.input_data.pv), ("other", pv)])
+    assert merged.n_pv_systems_per_example == 256
+
+
+def test_make_union_input_slices():
+    cnn = get_registered_model("cnn")
+    nwp_simple_trained = get_registered_model("nwp_simple_trained")
+    models = [cnn, nwp_simple_trained]
+    cnn_slices = CNN_Model().input_slices()
+
+    input_slices = {cnn.name: cnn_slices, nwp_simple_trained.name: None}
+    union = make_union_configuration(models, input_slices=input_slices)
+    union_slices = make_union_input_slices(
+        models=models, input_slices=input_slices, union_configuration=union
+    )
+    # only the cnn reads these data sources
+    assert union_slices == cnn_slices
+
+    # both models read the nwp data, so the most time steps are kept
+    input_slices = {
+        cnn.name: {**cnn_slices, "nwp": {"time_index": 2}},
+        nwp_simple_trained.name: {"nwp": {"time_index": 3}},
+    }
+    union_slices = make_union_input_slices(
+        models=models, input_slices=input_slices, union_configuration=union
+    )
+    assert union_slices["nwp"] == {"time_index": 3}
+
+    # nwp_simple_trained reads all of the nwp data
+    input_slices[nwp_simple_trained.name] = None
+    union_slices = make_union_input_slices(
+        models=models, input_slices=input_slices, union_configuration=union
+    )
+    assert "nwp" not in union_slices
+
+    # the time window of the union is longer than the cnn's, so the time steps are not sliced
+    union.input_data.gsp.history_minutes += 60
+    union_slices = make_union_input_slices(
+        models=models, input_slices=input_slices, union_configuration=union
+    )
+    assert union_slices["gsp"] == {"id_index": cnn_slices["gsp"]["id_index"]}
+
+
+def test_make_union_configuration_conflict():
+    # the nwp data sources have different zarr paths, so the batches can not be shared
+    with pytest.raises(ValueError):
+        make_union_configuration([get_registered_model("nwp_simple"), get_registered_model("cnn")])
+
+
+def test_select_model_inputs(configuration):
+    configuration.input_data.nwp.history_minutes = 120
+    configuration.input_data.nwp.forecast_minutes = 120
+    batch = Batch.fake(configuration=configuration, temporally_align_examples=True)
+
+    model = get_registered_model("nwp_simple_trained")
+    model_configuration = configuration.copy(deep=True)
+    model_configuration.input_data.nwp.history_minutes = 0
+
+    inputs = select_model_inputs(
+        batch=batch,
+        model=model,
+        configuration=model_configuration,
+        union_configuration=configuration,
+    )
+
+    assert inputs.satellite is None
+    assert inputs.metadata == batch.metadata
+    t0s = np.array(
+        [location.t0_datetime_utc for location in batch.metadata.space_time_locations],
+        dtype="datetime64[ns]",
+    )
+    offsets = inputs.nwp.time.values - t0s[:, None]
+    assert inputs.nwp.time.shape[1] < batch.nwp.time.shape[1]
+    assert (offsets > -np.timedelta64(60, "m")).all()
+    assert (inputs.nwp.time_index.values == np.arange(inputs.nwp.time.shape[1])).all()
+
+    # the same window, so the data is not changed
+    inputs = select_model_inputs(
+        batch=batch, model=model, configuration=configuration, union_configuration=configuration
+    )
+    assert inputs.nwp is batch.nwp
+
+
+def test_blend_forecasts(db_session):
+    t0_datetime_utc = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    forecasts = {
+        name: make_fake_forecasts(
+            gsp_ids=[1, 2], t0_datetime_utc=t0_datetime_utc, session=db_session
+        )
+        for name in ["cnn", "nwp_simple_trained"]
+    }
+
+    blend = blend_forecasts(
+        forecasts=forecasts, weights={"cnn": 3, "nwp_simple_trained": 1}, session=db_session
+    )
+
+    assert len(blend) == 2
+    assert blend[0].model.name == "blend"
+    cnn_values = {
+        value.target_time: value.expected_power_generation_megawatts
+        for value in forecasts["cnn"][0].forecast_values
+    }
+    other_values = {
+        value.target_time: value.expected_power_generation_megawatts
+        for value in forecasts["nwp_simple_trained"][0].forecast_values
+    }
+    for value in blend[0].forecast_values:
+        expected = 0.75 * cnn_values[value.target_time] + 0.25 * other_values[value.target_time]
+        assert value.expected_power_generation_megawatts == pytest.approx(expected, abs=1e-3)
@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+import pytest
+import pytorch_lightning as pl
+import torch
+from torch import nn
+
+from nowcasting_forecast.models.hub import NowcastingModelHubMixin, load_state_dict
+
+
+class ToyModel(pl.LightningModule, NowcastingModelHubMixin):
+    def __init__(self, n_features: int = 16):
+        super().__init__()
+        self.save_hyperparameters()
+        self.fc = nn.Linear(n_features, 8)
+        self.norm = nn.BatchNorm1d(8)
+
+    def forward(self, x):
+        return self.norm(self.fc(x))
+
+
+def test_load_state_dict():
+    model = ToyModel()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "weights.bin")
+        torch.save(model.state_dict(), filename)
+        state_dict = load_state_dict(filename)
+
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(state_dict[name], tensor)
+
+
+def test_from_pretrained_low_memory():
+    model = ToyModel(n_features=4)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        model.save_pretrained(tempdir)
+        low_memory_model = ToyModel.from_pretrained(tempdir)
+        random_init_model = ToyModel.from_pretrained(tempdir, low_memory=False)
+
+    assert not low_memory_model.training
+    for name, tensor in model.state_dict().items():
+        assert not low_memory_model.state_dict()[name].is_meta
+        assert torch.equal(low_memory_model.state_dict()[name], tensor)
+        assert torch.equal(random_init_model.state_dict()[name], tensor)
+
+    x = torch.rand(3, 4)
+    with torch.no_grad():
+        torch.testing.assert_close(low_memory_model(x), random_init_model(x))
+
+
+def test_from_pretrained_low_memory_missing_weights():
+    model = ToyModel()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        model.save_pretrained(tempdir)
+
+        # remove one of the weights, this is then randomly initialised
+        state_dict = model.state_dict()
+        state_dict.pop("fc.bias")
+        torch.save(state_dict, os.path.join(tempdir, "pytorch_model.bin"))
+
+        loaded_model = ToyModel.from_pretrained(tempdir)
+
+    assert not loaded_model.fc.bias.is_meta
+    assert torch.equal(loaded_model.fc.weight, model.fc.weight)
+
+
+def test_from_pretrained_low_memory_missing_weights_safetensors(monkeypatch):
+    safetensors_torch = pytest.importorskip("safetensors.torch")
+    model = ToyModel()
+
+    # most versions of torch can not load safetensors files, so make sure this is not used
+    torch_load = torch.load
+
+    def load(filename, *args, **kwargs):
+        assert not str(filename).endswith(".safetensors")
+        return torch_load(filename, *args, **kwargs)
+
+    monkeypatch.setattr(torch, "load", load)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        model.save_pretrained(tempdir)
+
+        # remove one of the weights from the safetensors file, which is used first
+        state_dict = {name: tensor.contiguous() for name, tensor in model.state_dict().items()}
+        state_dict.pop("fc.bias")
+        safetensors_torch.save_file(state_dict, os.path.join(tempdir, "model.safetensors"))
+
+        loaded_model = ToyModel.from_pretrained(tempdir)
+
+    assert not loaded_model.fc.bias.is_meta
+    assert torch.equal(loaded_model.fc.weight, model.fc.weight)
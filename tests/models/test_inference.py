@@ -0,0 +1,79 @@
+import numpy as np
+import torch
+from torch import nn
+
+from nowcasting_forecast.models.inference import InferenceRunner, set_torch_threads
+from nowcasting_forecast.profiling import profile_run
+
+
+def make_model():
+    return nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 2))
+
+
+def test_inference_runner():
+    model = make_model()
+    runner = InferenceRunner(model=model, profile_memory=True)
+
+    x = torch.rand(4, 8)
+    output = runner(x)
+
+    with torch.no_grad():
+        expected_output = model(x)
+
+    torch.testing.assert_close(output, expected_output)
+    assert not output.requires_grad
+    assert len(runner.forward_seconds) == 1
+    # the largest layer is the relu, with 4 x 16 in and 4 x 16 out, of float32
+    assert runner.peak_activation_mb[0] == (4 * 16 + 4 * 16) * 4 / 1024**2
+
+    # the hooks are removed after each forward pass
+    runner(x)
+    assert len(runner.peak_activation_mb) == 2
+    assert all(len(module._forward_hooks) == 0 for module in model.modules())
+
+    runner.log_summary()
+
+
+def test_inference_runner_profile_memory(tmp_path):
+    model = make_model()
+    runner = InferenceRunner(model=model)
+    x = torch.rand(4, 8)
+
+    # the activation memory is not recorded by default
+    runner(x)
+    assert np.isnan(runner.peak_activation_mb[0])
+
+    # but it is when the run is being profiled
+    with profile_run(report_filename=str(tmp_path / "report.json")):
+        runner(x)
+    assert runner.peak_activation_mb[1] == (4 * 16 + 4 * 16) * 4 / 1024**2
+
+
+def test_inference_runner_input_tensor():
+    runner = InferenceRunner(model=make_model())
+
+    data = np.random.uniform(size=(4, 8))
+    tensor = runner.input_tensor(name="x", data=data)
+    assert tensor.dtype == torch.float32
+    np.testing.assert_allclose(tensor.numpy(), data, rtol=1e-6)
+
+    # same buffer is used for the next batch
+    data_2 = np.random.uniform(size=(4, 8))
+    tensor_2 = runner.input_tensor(name="x", data=data_2)
+    assert tensor_2.data_ptr() == tensor.data_ptr()
+    np.testing.assert_allclose(tensor_2.numpy(), data_2, rtol=1e-6)
+
+    # new buffer if the shape changes
+    tensor_3 = runner.input_tensor(name="x", data=np.random.uniform(size=(2, 8)))
+    assert tensor_3.shape == (2, 8)
+
+
+def test_set_torch_threads(monkeypatch):
+    n_threads = torch.get_num_threads()
+
+    monkeypatch.setenv("TORCH_INTRA_OP_THREADS", "1")
+    set_torch_threads()
+    assert torch.get_num_threads() == 1
+
+    set_torch_threads(intra_op_threads=n_threads)
+    assert torch.get_num_threads() == n_threads
@@ -0,0 +1,87 @@
+import pickle
+
+import torch
+from torch import nn
+
+from nowcasting_forecast.models.cnn.model import Model as CNN_Model
+from nowcasting_forecast.models.nwp_simple_trained.model import DSWRF_MEAN, DSWRF_STD, Model
+from nowcasting_forecast.models.optimization import FusedConv3d, optimize_model
+from nowcasting_forecast.models.quantization import quantize_model
+
+
+def test_fused_conv3d():
+    conv = nn.Conv3d(in_channels=2, out_channels=4, kernel_size=(3, 3, 3), padding=(1, 1, 0))
+    x = 100 + 20 * torch.randn(2, 2, 4, 8, 8)
+
+    fused = FusedConv3d.from_conv(conv=conv, relu=True, mean=100, std=20)
+
+    with torch.inference_mode():
+        # including the padded edges
+        torch.testing.assert_close(fused(x), torch.relu(conv((x - 100) / 20)))
+    # the conv is not changed
+    assert conv.padding == (1, 1, 0)
+
+
+def test_optimize_nwp_simple_trained():
+    model = Model().eval()
+    optimized_model = optimize_model(model, input_normalization=model.input_normalization)
+
+    # the normalization is folded into the first layer, and the layers not used are dropped
+    assert optimized_model.nwp_conv0.input_mean == DSWRF_MEAN
+    assert optimized_model.input_normalization is None
+    assert model.input_normalization == (DSWRF_MEAN, DSWRF_STD)
+    assert all(
+        isinstance(getattr(optimized_model, f"nwp_conv{i}"), FusedConv3d)
+        and getattr(optimized_model, f"nwp_conv{i}").relu
+        for i in range(6)
+    )
+    assert not hasattr(optimized_model, "pv_fc1")
+    assert not hasattr(optimized_model, "pv_system_id_embedding")
+
+    # the model is not changed, and the weights are shared
+    assert type(model.nwp_conv1) == nn.Conv3d
+    assert hasattr(model, "pv_fc1")
+    assert optimized_model.nwp_fc1.weight is model.nwp_fc1.weight
+
+    # the optimized model takes the data before it is normalized
+    nwp_data = DSWRF_MEAN + DSWRF_STD * torch.randn(3, 1, 4, 64, 64)
+    with torch.inference_mode():
+        expected = model((nwp_data - DSWRF_MEAN) / DSWRF_STD)
+        torch.testing.assert_close(optimized_model(nwp_data), expected, rtol=1e-4, atol=1e-4)
+
+        # the optimized model can be sent to another process, and quantized
+        copied_model = pickle.loads(pickle.dumps(optimized_model))
+        torch.testing.assert_close(copied_model(nwp_data), expected, rtol=1e-4, atol=1e-4)
+        quantized_model = quantize_model(optimized_model)
+        assert isinstance(quantized_model.nwp_fc1, torch.ao.nn.quantized.dynamic.Linear)
+        torch.testing.assert_close(quantized_model(nwp_data), expected, atol=0.01, rtol=0.01)
+
+
+def test_optimize_without_input_normalization():
+    model = Model().eval()
+    optimized_model = optimize_model(model)
+
+    # the model still takes normalized data
+    assert optimized_model.nwp_conv0.input_mean is None
+    nwp_data = torch.randn(3, 1, 4, 64, 64)
+    with torch.inference_mode():
+        torch.testing.assert_close(optimized_model(nwp_data), model(nwp_data))
+
+
+def test_optimize_cnn():
+    model = CNN_Model(include_nwp=False).eval()
+    optimized_model = optimize_model(model)
+
+    assert all(isinstance(getattr(optimized_model, f"sat_conv{i}"), FusedConv3d) for i in range(6))
+
+    inputs = model.optimization_inputs()
+    with torch.inference_mode():
+        torch.testing.assert_close(
+            optimized_model.satellite_embedding(*inputs["satellite_embedding"]),
+            model.satellite_embedding(*inputs["satellite_embedding"]),
+        )
+
+
+def test_optimize_model_without_inputs():
+    model = nn.Sequential(nn.Conv3d(1, 2, 3), nn.ReLU())
+    assert optimize_model(model) is model
@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+
+from nowcasting_forecast.models.inference import BatchRunner
+from nowcasting_forecast.models.parallel import (
+    ParallelBatchRunner,
+    get_threads_per_worker,
+    get_worker_pool,
+    shutdown_worker_pool,
+)
+
+
+def run_one_batch(batch, n_examples, pytorch_model) -> pd.DataFrame:
+    """Toy function for one batch, this has to be importable by the workers"""
+    predictions = pytorch_model(torch.as_tensor(batch))
+    return pd.DataFrame(
+        {"forecast_gsp_pv_outturn_mw": predictions[:n_examples, 0].numpy().astype(np.float64)}
+    )
+
+
+def make_model() -> nn.Module:
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(16, 8), nn.ReLU(), nn.Linear(8, 1)).eval()
+
+
+def test_get_threads_per_worker():
+    assert get_threads_per_worker(n_workers=1) >= 1
+    assert get_threads_per_worker(n_workers=10_000) == 1
+
+
+def test_batch_runner():
+    model = make_model()
+    batch_runner = BatchRunner(callable_function_for_on_batch=run_one_batch, model=model)
+
+    batch = torch.rand(4, 16)
+    forecasts = batch_runner.submit(batch=batch, n_examples=3).result()
+    batch_runner.close()
+
+    assert len(forecasts) == 3
+    with torch.no_grad():
+        expected = model(batch)[:3, 0].numpy()
+    np.testing.assert_allclose(forecasts["forecast_gsp_pv_outturn_mw"], expected, rtol=1e-6)
+
+
+def test_batch_runner_quantize():
+    model = make_model()
+
+    # the quantized model is used if it is close enough
+    batch_runner = BatchRunner(
+        callable_function_for_on_batch=run_one_batch,
+        model=model,
+        quantize=True,
+        quantize_tolerance_mw=1e6,
+    )
+    batch = torch.rand(4, 16)
+    forecasts = batch_runner(batch=batch, n_examples=4)
+    assert batch_runner.model.model is not model
+    assert batch_runner.quantized_model is None
+
+    # the forecasts of the first batch are from the quantized model too
+    quantized_forecasts = run_one_batch(
+        batch=batch, n_examples=4, pytorch_model=batch_runner.model.model
+    )
+    pd.testing.assert_frame_equal(forecasts, quantized_forecasts)
+
+    # otherwise the float model is kept
+    batch_runner = BatchRunner(
+        callable_function_for_on_batch=run_one_batch,
+        model=model,
+        quantize=True,
+        quantize_tolerance_mw=-1,
+    )
+    batch_runner(batch=torch.rand(4, 16), n_examples=4)
+    assert batch_runner.model.model is model
+
+
+def test_parallel_batch_runner():
+    model = make_model()
+    batches = [torch.rand(4, 16) for _ in range(5)]
+
+    batch_runner = BatchRunner(callable_function_for_on_batch=run_one_batch, model=model)
+    forecasts = [batch_runner(batch=batch, n_examples=4) for batch in batches]
+
+    parallel_batch_runner = ParallelBatchRunner(
+        n_workers=2, callable_function_for_on_batch=run_one_batch, model=model
+    )
+    futures = [parallel_batch_runner.submit(batch=batch, n_examples=4) for batch in batches]
+    parallel_forecasts = [future.result() for future in futures]
+    parallel_batch_runner.close()
+
+    # the same forecasts, in the same order
+    assert len(parallel_forecasts) == len(forecasts)
+    for parallel_forecast, forecast in zip(parallel_forecasts, forecasts):
+        pd.testing.assert_frame_equal(parallel_forecast, forecast)
+
+
+def test_parallel_batch_runner_reuses_pool():
+    model = make_model()
+    batch = torch.rand(4, 16)
+
+    # the workers are kept for the next run of the same model
+    parallel_batch_runner = ParallelBatchRunner(
+        n_workers=2, callable_function_for_on_batch=run_one_batch, model=model
+    )
+    parallel_batch_runner.submit(batch=batch, n_examples=4).result()
+    parallel_batch_runner.close()
+    pool = parallel_batch_runner.pool
+
+    parallel_batch_runner = ParallelBatchRunner(
+        n_workers=2, callable_function_for_on_batch=run_one_batch, model=model
+    )
+    parallel_batch_runner.submit(batch=batch, n_examples=4).result()
+    parallel_batch_runner.close()
+    assert parallel_batch_runner.pool is pool
+
+    # but not for a different model
+    parallel_batch_runner = ParallelBatchRunner(
+        n_workers=2, callable_function_for_on_batch=run_one_batch, model=make_model()
+    )
+    parallel_batch_runner.submit(batch=batch, n_examples=4).result()
+    parallel_batch_runner.close()
+    assert parallel_batch_runner.pool is not pool
+
+    shutdown_worker_pool()
+    assert (
+        get_worker_pool(n_workers=2, callable_function_for_on_batch=run_one_batch, model=model)
+        is not parallel_batch_runner.pool
+    )
+    shutdown_worker_pool()
+
+
+def test_parallel_batch_runner_quantize():
+    model = make_model()
+    batches = [torch.rand(4, 16) for _ in range(3)]
+
+    # the quantized model is checked once, here, and then the workers are given it
+    parallel_batch_runner = ParallelBatchRunner(
+        n_workers=2,
+        callable_function_for_on_batch=run_one_batch,
+        model=model,
+        quantize=True,
+        quantize_tolerance_mw=1e6,
+    )
+    futures = [parallel_batch_runner.submit(batch=batch, n_examples=4) for batch in batches]
+    assert all(len(future.result()) == 4 for future in futures)
+    parallel_batch_runner.close()
+    assert parallel_batch_runner.model is not model
+
+    # otherwise the workers are given the float model
+    parallel_batch_runner = ParallelBatchRunner(
+        n_workers=2,
+        callable_function_for_on_batch=run_one_batch,
+        model=model,
+        quantize=True,
+        quantize_tolerance_mw=-1,
+    )
+    futures = [parallel_batch_runner.submit(batch=batch, n_examples=4) for batch in batches]
+    assert all(len(future.result()) == 4 for future in futures)
+    parallel_batch_runner.close()
+    assert parallel_batch_runner.model is model
+    shutdown_worker_pool()
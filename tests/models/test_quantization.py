@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+import torch
+from torch import nn
+
+from nowcasting_forecast.models.quantization import check_quantized_forecasts, quantize_model
+
+
+def test_quantize_model():
+    model = nn.Sequential(nn.Linear(64, 32), nn.ReLU(), nn.Linear(32, 4)).eval()
+    quantized_model = quantize_model(model)
+
+    # the float model is not changed
+    assert isinstance(model[0], nn.Linear)
+    assert isinstance(quantized_model[0], torch.ao.nn.quantized.dynamic.Linear)
+    assert isinstance(quantized_model[2], torch.ao.nn.quantized.dynamic.Linear)
+
+    x = torch.rand(8, 64)
+    with torch.inference_mode():
+        torch.testing.assert_close(quantized_model(x), model(x), atol=0.05, rtol=0.05)
+
+    # only made once
+    assert quantize_model(model) is quantized_model
+
+
+def test_quantize_model_error():
+    with pytest.raises(NotImplementedError):
+        quantize_model(lambda batch: batch)
+
+
+def test_check_quantized_forecasts():
+    float_forecasts = pd.DataFrame({"forecast_gsp_pv_outturn_mw": [10.0, 20.0, 30.0]})
+    quantized_forecasts = pd.DataFrame({"forecast_gsp_pv_outturn_mw": [10.1, 19.5, 30.0]})
+
+    assert check_quantized_forecasts(
+        float_forecasts=float_forecasts, quantized_forecasts=quantized_forecasts, tolerance_mw=1
+    )
+    assert not check_quantized_forecasts(
+        float_forecasts=float_forecasts, quantized_forecasts=quantized_forecasts, tolerance_mw=0.1
+    )
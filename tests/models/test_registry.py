@@ -0,0 +1,40 @@
+import pytest
+
+from nowcasting_forecast.models.cnn.export import TorchScriptBackend
+from nowcasting_forecast.models.cnn.model import Model as CNN_Model
+from nowcasting_forecast.models.nwp_simple_trained.model import Model
+from nowcasting_forecast.models.registry import get_input_slices, get_registered_model
+
+
+def test_get_registered_model_error():
+    with pytest.raises(NotImplementedError):
+        get_registered_model("not_a_model")
+
+
+def test_get_configuration():
+    configuration = get_registered_model("cnn").get_configuration()
+
+    # the cnn does not read the hrv satellite data, so it is not loaded
+    assert configuration.input_data.hrvsatellite is None
+    assert configuration.input_data.satellite is not None
+    assert configuration.input_data.gsp.is_live
+
+    configuration = get_registered_model("nwp_simple_trained").get_configuration()
+    assert list(configuration.input_data.nwp.nwp_channels) == ["dswrf"]
+    # the gsp data source gives the locations of the examples
+    assert configuration.input_data.gsp is not None
+    assert configuration.input_data.satellite is None
+
+
+def test_get_input_slices():
+    model = CNN_Model()
+    input_slices = get_input_slices(TorchScriptBackend(model=model))
+    assert input_slices == model.input_slices()
+
+    # the pv systems the cnn reads are pushed down into the configuration
+    configuration = get_registered_model("cnn").get_configuration(input_slices=input_slices)
+    assert configuration.input_data.pv.n_pv_systems_per_example == 128
+    assert configuration.input_data.gsp.n_gsp_per_example == 32
+
+    assert get_input_slices(Model()) is None
+    assert get_input_slices(None) is None
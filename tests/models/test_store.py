@@ -0,0 +1,91 @@
+import os
+import tempfile
+
+import pytest
+
+from nowcasting_forecast.models.store import get_model_file, get_sha256, load_manifest
+
+
+def write_weights(filename: str, data: bytes):
+    with open(filename, "wb") as f:
+        f.write(data)
+
+
+def test_get_model_file():
+    with tempfile.TemporaryDirectory() as tempdir:
+        remote_filename = os.path.join(tempdir, "weights.ckpt")
+        store_dir = os.path.join(tempdir, "store")
+        write_weights(remote_filename, b"weights v1")
+
+        local_filename = get_model_file(remote_filename=remote_filename, store_dir=store_dir)
+        assert local_filename.startswith(store_dir)
+        with open(local_filename, "rb") as f:
+            assert f.read() == b"weights v1"
+
+        # the remote has not changed, so the same file is used
+        same_local_filename = get_model_file(remote_filename=remote_filename, store_dir=store_dir)
+        assert same_local_filename == local_filename
+
+        # the remote has changed, so the new weights are downloaded
+        write_weights(remote_filename, b"weights version 2")
+        new_local_filename = get_model_file(remote_filename=remote_filename, store_dir=store_dir)
+        with open(new_local_filename, "rb") as f:
+            assert f.read() == b"weights version 2"
+        assert not os.path.exists(local_filename)
+
+
+def test_get_model_file_offline_and_pinned():
+    with tempfile.TemporaryDirectory() as tempdir:
+        remote_filename = f"file://{os.path.join(tempdir, 'weights.ckpt')}"
+        store_dir = os.path.join(tempdir, "store")
+        write_weights(remote_filename[len("file://") :], b"weights v1")
+
+        # nothing in the store yet
+        with pytest.raises(FileNotFoundError):
+            get_model_file(remote_filename=remote_filename, store_dir=store_dir, offline=True)
+
+        local_filename = get_model_file(remote_filename=remote_filename, store_dir=store_dir)
+        manifest = load_manifest(os.path.dirname(os.path.dirname(local_filename)))
+
+        # the remote is not used at all, offline or with the pinned revision
+        os.remove(remote_filename[len("file://") :])
+        for kwargs in [dict(offline=True), dict(revision=manifest["revision"])]:
+            assert (
+                get_model_file(remote_filename=remote_filename, store_dir=store_dir, **kwargs)
+                == local_filename
+            )
+
+        # a different pinned revision is not in the store
+        with pytest.raises(Exception):
+            get_model_file(remote_filename=remote_filename, store_dir=store_dir, revision="other")
+
+
+def test_get_model_file_sha256():
+    with tempfile.TemporaryDirectory() as tempdir:
+        remote_filename = os.path.join(tempdir, "weights.ckpt")
+        store_dir = os.path.join(tempdir, "store")
+        write_weights(remote_filename, b"weights v1")
+
+        with pytest.raises(ValueError):
+            get_model_file(remote_filename=remote_filename, store_dir=store_dir, sha256="0" * 64)
+        with pytest.raises(FileNotFoundError):
+            get_model_file(remote_filename=remote_filename, store_dir=store_dir, offline=True)
+
+        sha256 = get_sha256(remote_filename)
+        local_filename = get_model_file(
+            remote_filename=remote_filename, store_dir=store_dir, sha256=sha256
+        )
+
+        # a changed file in the store is not used
+        write_weights(local_filename, b"changed")
+        with pytest.raises(FileNotFoundError):
+            get_model_file(remote_filename=remote_filename, store_dir=store_dir, offline=True)
+
+        local_filename = get_model_file(remote_filename=remote_filename, store_dir=store_dir)
+        assert get_sha256(local_filename) == sha256
+
+
+def test_get_model_file_error():
+    with tempfile.TemporaryDirectory() as tempdir:
+        with pytest.raises(FileNotFoundError):
+            get_model_file(remote_filename="weights.ckpt", store_dir=tempdir)
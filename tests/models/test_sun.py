@@ -1,8 +1,10 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 from freezegun import freeze_time
 from nowcasting_datamodel.models.models import StatusSQL
 from nowcasting_datamodel.read.read import get_latest_status
+from nowcasting_dataset.data_sources.gsp.eso import get_gsp_metadata_from_eso
+from nowcasting_dataset.geospatial import calculate_azimuth_and_elevation_angle
 
 from nowcasting_forecast import N_GSP
 from nowcasting_forecast.models.sun import (
@@ -29,6 +31,37 @@ def test_filter_forecasts_on_sun_elevation(forecasts):
     assert forecasts[0].forecast_values[1].expected_power_generation_megawatts == 1
 
 
+def test_filter_forecasts_on_sun_elevation_same_as_one_gsp_at_a_time(forecasts):
+    # target times over sunrise and sunset, different for each gsp
+    start = datetime(2023, 1, 1, 6, tzinfo=timezone.utc)
+    for i, forecast in enumerate(forecasts):
+        for j, forecast_value in enumerate(forecast.forecast_values):
+            forecast_value.target_time = start + timedelta(minutes=30 * j + 5 * i)
+            forecast_value.expected_power_generation_megawatts = 1
+
+    # calculate the sun elevation for one gsp at a time
+    metadata = get_gsp_metadata_from_eso()
+    expected = []
+    for forecast in forecasts:
+        gsp_metadata = metadata[metadata.gsp_id == forecast.location.gsp_id].iloc[0]
+        sun_df = calculate_azimuth_and_elevation_angle(
+            latitude=gsp_metadata.centroid_lat,
+            longitude=gsp_metadata.centroid_lon,
+            datestamps=[forecast_value.target_time for forecast_value in forecast.forecast_values],
+        )
+        expected.append([0 if elevation < 0 else 1 for elevation in sun_df["elevation"]])
+
+    _ = filter_forecasts_on_sun_elevation(forecasts)
+
+    values = [
+        [value.expected_power_generation_megawatts for value in forecast.forecast_values]
+        for forecast in forecasts
+    ]
+    assert values == expected
+    # there are values with the sun up and down
+    assert 0 in sum(expected, []) and 1 in sum(expected, [])
+
+
 @freeze_time("2023-01-01 12:00:00")
 def test_drop_forecast_on_sun_elevation_day(db_session):
     status = StatusSQL(message="", status="ok")
@@ -1,12 +1,18 @@
 import os
 import tempfile
+from datetime import datetime, timedelta, timezone
 
+import numpy as np
+import pandas as pd
+import pytest
 from freezegun import freeze_time
 from nowcasting_datamodel.models import (
+    Forecast,
     ForecastSQL,
     InputDataLastUpdatedSQL,
     LocationSQL,
     MLModelSQL,
+    national_gb_label,
 )
 from nowcasting_dataset.config.save import save_yaml_configuration
 
@@ -14,7 +20,17 @@ from nowcasting_forecast.models.nwp_solar_simple import (
     nwp_irradiance_simple,
     nwp_irradiance_simple_run_one_batch,
 )
-from nowcasting_forecast.models.utils import general_forecast_run_all_batches
+from nowcasting_forecast.models.utils import (
+    MLResult,
+    MLResults,
+    convert_one_gsp_id_to_forecast_sql,
+    convert_to_forecast_sql,
+    general_forecast_run_all_batches,
+    get_locations,
+    make_results_df,
+    validate_results_df,
+)
+from nowcasting_forecast.utils import count_database_queries
 
 
 @freeze_time("2023-01-01 12:00:00")
@@ -38,6 +54,29 @@ def test_general_run_all_batches(batch, configuration, db_session, input_data_la
         assert len(f) == 4
 
 
+@freeze_time("2023-01-01 12:00:00")
+def test_general_run_all_batches_in_memory(
+    batch, configuration, db_session, input_data_last_updated, status
+):
+    with tempfile.TemporaryDirectory() as tempdir:
+        configuration.output_data.filepath = tempdir
+        configuration_file = os.path.join(tempdir, "configuration.yaml")
+        save_yaml_configuration(configuration=configuration)
+
+        f = general_forecast_run_all_batches(
+            n_gsps=4,
+            configuration_file=configuration_file,
+            add_national_forecast=False,
+            session=db_session,
+            callable_function_for_on_batch=nwp_irradiance_simple_run_one_batch,
+            model_name="test_model",
+            batches=[batch],
+        )
+
+        assert len(f) == 4
+        assert not os.path.exists(os.path.join(tempdir, "live"))
+
+
 @freeze_time("2023-01-01 12:00:00")
 def test_general_batches_and_national(
     batch, configuration, db_session, input_data_last_updated, status
@@ -109,3 +148,133 @@ def test_general_run_all_batches_check_locations(
             == batch.metadata.batch_size * 2
         )
         assert len(db_session.query(MLModelSQL).all()) == 1
+
+
+def test_make_results_df():
+    predictions = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [7.0, 8.0, 9.0]], dtype=np.float32)
+    t0s = [datetime(2023, 1, 1, 12), datetime(2023, 1, 1, 12, 30), datetime(2023, 1, 1, 13)]
+
+    results_df = make_results_df(
+        predictions=predictions,
+        gsp_ids=[3, 1, 2],
+        t0_datetimes_utc=t0s,
+        horizon_minutes=[30, 60, 90],
+        n_examples=2,
+    )
+
+    # the same as making a row for each example and horizon, with the last example left out
+    expected = pd.DataFrame(
+        [
+            dict(
+                t0_datetime_utc=t0s[i].replace(tzinfo=timezone.utc),
+                target_datetime_utc=t0s[i].replace(tzinfo=timezone.utc)
+                + timedelta(minutes=30) * (t_index + 1),
+                forecast_gsp_pv_outturn_mw=float(predictions[i, t_index]),
+                gsp_id=[3, 1][i],
+            )
+            for i in range(2)
+            for t_index in range(3)
+        ]
+    )
+    pd.testing.assert_frame_equal(results_df, expected, check_exact=True)
+
+
+def test_validate_results_df():
+    results_df = pd.DataFrame(
+        {
+            "t0_datetime_utc": [datetime(2023, 1, 1, 12)] * 2,
+            "target_datetime_utc": [datetime(2023, 1, 1, 12), datetime(2023, 1, 1, 12, 30)],
+            "forecast_gsp_pv_outturn_mw": [-1, 2.5],
+            "gsp_id": [1, 1],
+        }
+    )
+
+    validated_df = validate_results_df(results_df)
+
+    assert (validated_df["forecast_gsp_pv_outturn_mw"] == [0, 2.5]).all()
+    assert str(validated_df["target_datetime_utc"].dt.tz) == "UTC"
+    # the original dataframe is not changed
+    assert results_df["forecast_gsp_pv_outturn_mw"].iloc[0] == -1
+
+
+def test_validate_results_df_gsp_id_out_of_range():
+    results_df = pd.DataFrame(
+        {
+            "t0_datetime_utc": [datetime(2023, 1, 1, 12, tzinfo=timezone.utc)],
+            "target_datetime_utc": [datetime(2023, 1, 1, 12, tzinfo=timezone.utc)],
+            "forecast_gsp_pv_outturn_mw": [1.0],
+            "gsp_id": [318],
+        }
+    )
+
+    with pytest.raises(Exception):
+        validate_results_df(results_df)
+
+
+def test_convert_to_forecast_sql(db_session, input_data_last_updated):
+    target_datetimes_utc = [datetime(2023, 1, 1, 12, 30 * i, tzinfo=timezone.utc) for i in range(2)]
+    results_df = pd.DataFrame(
+        {
+            "t0_datetime_utc": datetime(2023, 1, 1, 12, tzinfo=timezone.utc),
+            "target_datetime_utc": target_datetimes_utc * 3,
+            "forecast_gsp_pv_outturn_mw": [1.0, -2.0, 3.0, 4.0, 5.0, 6.0],
+            "gsp_id": [2, 2, 1, 1, 3, 3],
+        }
+    )
+
+    forecasts = convert_to_forecast_sql(
+        results_df=results_df, session=db_session, model_name="test_model"
+    )
+
+    # forecasts are in the order of the gsp ids in the dataframe
+    assert [forecast.location.gsp_id for forecast in forecasts] == [2, 1, 3]
+    values = [value.expected_power_generation_megawatts for value in forecasts[0].forecast_values]
+    assert values == [1.0, 0.0]
+    assert forecasts[0].forecast_values[1].target_time == target_datetimes_utc[1]
+    _ = Forecast.from_orm(forecasts[2])
+
+
+def test_convert_one_gsp_id_to_forecast_sql(db_session, input_data_last_updated):
+    results = MLResults(
+        forecasts=[
+            MLResult(
+                t0_datetime_utc=datetime(2023, 1, 1, 12, tzinfo=timezone.utc),
+                target_datetime_utc=datetime(2023, 1, 1, 12, 30 * i, tzinfo=timezone.utc),
+                forecast_gsp_pv_outturn_mw=value,
+                gsp_id=1,
+            )
+            for i, value in enumerate([1.0, -2.0])
+        ]
+    )
+    ml_model = MLModelSQL(name="test_model", version="0.0.1")
+
+    forecast = convert_one_gsp_id_to_forecast_sql(
+        results_for_one_gsp_id=results,
+        session=db_session,
+        input_data_last_updated=input_data_last_updated,
+        ml_model=ml_model,
+    )
+
+    assert forecast.location.gsp_id == 1
+    values = [value.expected_power_generation_megawatts for value in forecast.forecast_values]
+    assert values == [1.0, 0.0]
+
+
+def test_get_locations(db_session):
+    location = LocationSQL(gsp_id=1, label="GSP_1")
+    db_session.add(location)
+    db_session.commit()
+
+    locations = get_locations(session=db_session, gsp_ids=[0, 1, 2, 2])
+
+    assert sorted(locations.keys()) == [0, 1, 2]
+    assert locations[1] is location
+    assert locations[0].label == national_gb_label
+    assert locations[2].label == "GSP_2"
+    assert len(db_session.query(LocationSQL).all()) == 3
+
+    # all the locations now exist, so they are got in one query
+    with count_database_queries(engine=db_session.get_bind()) as counter:
+        locations = get_locations(session=db_session, gsp_ids=[0, 1, 2])
+    assert counter.n_queries == 1
+    assert len(locations) == 3
@@ -0,0 +1,43 @@
+import numpy as np
+import torch
+from nowcasting_dataloader.batch import BatchML
+
+from nowcasting_forecast.models.xr_utils import NWP_DIMS, to_tensor
+
+
+def test_to_tensor_shares_memory(batch):
+    nwp = batch.nwp.data.astype(np.float32)
+
+    tensor = to_tensor(nwp, dims=NWP_DIMS)
+
+    assert tensor.shape == nwp.transpose(*NWP_DIMS).shape
+    assert np.shares_memory(tensor.numpy(), nwp.values)
+    assert (tensor.numpy() == nwp.transpose(*NWP_DIMS).values).all()
+    # the data array is not changed
+    assert nwp.dims != NWP_DIMS
+
+
+def test_to_tensor_copies_other_dtypes(batch):
+    tensor = to_tensor(batch.nwp.data)
+    assert tensor.dtype == torch.float32
+    assert not np.shares_memory(tensor.numpy(), batch.nwp.data.values)
+
+    time = to_tensor(batch.nwp.time, dtype=torch.float64)
+    expected = torch.tensor(batch.nwp.time.data.astype(int), dtype=torch.float64)
+    assert torch.equal(time, expected)
+
+
+def test_batch_ml_is_the_same(batch):
+    expected = {
+        "data": batch.nwp.data.transpose(*NWP_DIMS).values,
+        "time": batch.nwp.time.values.astype(int),
+        "init_time": batch.nwp.init_time.values.astype(int),
+        "x": batch.nwp.x_osgb.values,
+        "y": batch.nwp.y_osgb.values,
+    }
+
+    batch_ml = BatchML.from_batch(batch=batch)
+
+    for name, value in expected.items():
+        tensor = getattr(batch_ml.nwp, name)
+        assert torch.equal(tensor, torch.tensor(value, dtype=tensor.dtype))
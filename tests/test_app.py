@@ -1,5 +1,6 @@
 import os
 import tempfile
+import threading
 
 import pytest
 import xarray as xr
@@ -10,7 +11,7 @@ from nowcasting_datamodel.models import Forecast, ForecastSQL, LocationSQL
 from nowcasting_datamodel.fake import make_fake_me_latest
 
 from nowcasting_forecast import N_GSP
-from nowcasting_forecast.app import run
+from nowcasting_forecast.app import run, serve_forecasts
 
 
 def test_fake(db_connection, me_latest):
@@ -68,6 +69,22 @@ def test_fake_twice(db_connection: DatabaseConnection, me_latest):
         assert len(locations) == 10 + 1
 
 
+def test_fake_serve(db_connection: DatabaseConnection, me_latest):
+    # the trigger is already set, so the second forecast is made straight away
+    trigger = threading.Event()
+    trigger.set()
+
+    serve_forecasts(connection=db_connection, fake=True, n_gsps=10, n_cycles=2, trigger=trigger)
+
+    assert not trigger.is_set()
+    with db_connection.get_session() as session:
+        forecasts = session.query(ForecastSQL).all()
+        assert len(forecasts) == (10 + 1) * 3  # 10 gsp + national, and the historic ones
+
+        locations = session.query(LocationSQL).all()
+        assert len(locations) == 10 + 1
+
+
 def test_not_fake(
     db_connection: DatabaseConnection,
     nwp_data: xr.Dataset,
@@ -105,6 +122,52 @@ def test_not_fake(
             assert len(forecasts[0].forecast_values) > 1
 
 
+def test_not_fake_streaming(
+    db_connection: DatabaseConnection,
+    nwp_data: xr.Dataset,
+    input_data_last_updated,
+    sat_data,
+    hrv_sat_data,
+    gsp_yields_and_systems,
+    pv_yields_and_systems,
+    me_latest,
+):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # save nwp data
+        nwp_path = f"{temp_dir}/unittest.netcdf"
+        nwp_data.to_netcdf(nwp_path, engine="h5netcdf")
+        os.environ["NWP_PATH"] = nwp_path
+        hrv_sat_path = f"{temp_dir}/hrv_sat_unittest.zarr.zip"
+        with zarr.ZipStore(hrv_sat_path) as store:
+            hrv_sat_data.to_zarr(store, compute=True)
+        os.environ["HRV_SAT_PATH"] = hrv_sat_path
+        sat_path = f"{temp_dir}/sat_unittest.zarr.zip"
+        with zarr.ZipStore(sat_path) as store:
+            sat_data.to_zarr(store, compute=True)
+        os.environ["SAT_PATH"] = sat_path
+
+        runner = CliRunner()
+        response = runner.invoke(
+            run,
+            [
+                "--db-url",
+                db_connection.url,
+                "--fake",
+                "false",
+                "--n-gsps",
+                "10",
+                "--streaming",
+                "true",
+            ],
+        )
+        assert response.exit_code == 0, response
+
+        with db_connection.get_session() as session:
+            forecasts = session.query(ForecastSQL).all()
+            assert len(forecasts) == (10 + 1) * 2  # 10 gsp + national, x2 for historic ones too
+            assert len(forecasts[0].forecast_values) > 1
+
+
 @pytest.mark.skip("CI doesnt have access to AWS for model weights")
 def test_mwp_1(db_connection: DatabaseConnection, nwp_data: xr.Dataset, input_data_last_updated):
     with tempfile.TemporaryDirectory() as temp_dir:
@@ -134,3 +197,68 @@ def test_mwp_1(db_connection: DatabaseConnection, nwp_data: xr.Dataset, input_da
             _ = Forecast.from_orm(forecasts[0])
             assert len(forecasts) == 10 + 1  # 10 gsp + national
             assert len(forecasts[0].forecast_values) > 1
+
+
+@pytest.mark.skip("CI doesnt have access to AWS for model weights")
+def test_ensemble(
+    db_connection: DatabaseConnection,
+    nwp_data: xr.Dataset,
+    input_data_last_updated,
+    sat_data,
+    hrv_sat_data,
+    gsp_yields_and_systems,
+    pv_yields_and_systems,
+    me_latest,
+):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # save nwp data
+        nwp_path = f"{temp_dir}/unittest.netcdf"
+        nwp_data.to_netcdf(nwp_path, engine="h5netcdf")
+        os.environ["NWP_PATH"] = nwp_path
+        hrv_sat_path = f"{temp_dir}/hrv_sat_unittest.zarr.zip"
+        with zarr.ZipStore(hrv_sat_path) as store:
+            hrv_sat_data.to_zarr(store, compute=True)
+        os.environ["HRV_SAT_PATH"] = hrv_sat_path
+        sat_path = f"{temp_dir}/sat_unittest.zarr.zip"
+        with zarr.ZipStore(sat_path) as store:
+            sat_data.to_zarr(store, compute=True)
+        os.environ["SAT_PATH"] = sat_path
+
+        runner = CliRunner()
+        response = runner.invoke(
+            run,
+            [
+                "--db-url",
+                db_connection.url,
+                "--fake",
+                "false",
+                "--model-name",
+                "cnn,nwp_simple_trained",
+                "--blend-weights",
+                "cnn:0.7,nwp_simple_trained:0.3",
+                "--n-gsps",
+                "10",
+            ],
+        )
+        assert response.exit_code == 0, response
+
+        with db_connection.get_session() as session:
+            forecasts = session.query(ForecastSQL).all()
+            model_names = {forecast.model.name for forecast in forecasts}
+            assert model_names == {"cnn", "nwp_simple_trained", "blend"}
+            assert len(forecasts) == (10 + 1) * 2 * 3  # x2 for historic ones, x3 for the models
+
+
+def test_quantize_backend_error():
+    response = CliRunner().invoke(
+        run, ["--backend", "torchscript", "--quantize", "true", "--db-url", "sqlite://"]
+    )
+    assert response.exit_code == 2
+    assert "--quantize" in response.output
+
+
+def test_onnxruntime_backend_not_installed(monkeypatch):
+    monkeypatch.setattr("nowcasting_forecast.models.cnn.export.onnxruntime", None)
+    response = CliRunner().invoke(run, ["--backend", "onnxruntime", "--db-url", "sqlite://"])
+    assert response.exit_code == 2
+    assert "onnxruntime" in response.output
@@ -10,8 +10,9 @@ from nowcasting_dataset.config.save import save_yaml_configuration
 from nowcasting_dataset.data_sources.gsp.gsp_model import GSP
 from nowcasting_dataset.data_sources.pv.pv_model import PV
 from nowcasting_dataset.data_sources.satellite.satellite_model import Satellite
+from nowcasting_dataset.dataset.batch import Batch
 
-from nowcasting_forecast.batch import make_batches
+from nowcasting_forecast.batch import BatchProducer, make_batches
 from nowcasting_forecast.utils import floor_minutes_dt
 
 
@@ -130,3 +131,54 @@ def test_make_batches_pvnet_v1(
         gsp = GSP(gsp)
         assert len(gsp.time.values[0]) == 5
         assert pd.to_datetime(gsp.time.values[0, -1]).isoformat() == now_30
+
+
+def test_batch_producer(nwp_data):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # save nwp data
+        nwp_path = f"{temp_dir}/unittest.netcdf"
+        nwp_data.to_netcdf(nwp_path, engine="h5netcdf")
+        os.environ["NWP_PATH"] = nwp_path
+
+        with BatchProducer(temporary_dir=temp_dir, n_gsps=10) as batch_producer:
+            batches = list(batch_producer)
+        batch_producer.log_overlap()
+        assert not batch_producer.thread.is_alive()
+
+        assert len(batches) == 1
+        assert len(batches[0].metadata.ids) == 10
+        assert batches[0].nwp is not None
+
+        # the batches are kept in memory
+        assert not os.path.exists(f"{temp_dir}/live/nwp/000000.nc")
+
+
+def test_batch_producer_stop(monkeypatch):
+    def iterate_batches(**kwargs):
+        """Never runs out of batches"""
+        batch_idx = 0
+        while True:
+            yield batch_idx
+            batch_idx += 1
+
+    monkeypatch.setattr("nowcasting_forecast.batch.make_manager", lambda **kwargs: None)
+    monkeypatch.setattr("nowcasting_forecast.batch.iterate_batches", iterate_batches)
+
+    # stop before all the batches have been used, the thread is waiting to add the next one
+    with BatchProducer(max_queue_size=1) as batch_producer:
+        assert next(iter(batch_producer)) == 0
+    assert not batch_producer.thread.is_alive()
+
+
+def test_make_batches_in_memory(nwp_data):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # save nwp data
+        nwp_path = f"{temp_dir}/unittest.netcdf"
+        nwp_data.to_netcdf(nwp_path, engine="h5netcdf")
+        os.environ["NWP_PATH"] = nwp_path
+
+        batches = make_batches(temporary_dir=temp_dir, n_gsps=40, in_memory=True)
+
+        assert len(batches) == 2
+        assert isinstance(batches[0], Batch)
+        assert not os.path.exists(f"{temp_dir}/live/nwp/000000.nc")
@@ -0,0 +1,69 @@
+import os
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nowcasting_forecast.capacity import DEFAULT_CAPACITY_FILE, CapacityStore, get_capacity_store
+
+
+def test_get_capacity():
+    expected = pd.read_csv(DEFAULT_CAPACITY_FILE, index_col=["gsp_id"])
+    gsp_ids = [5, 1, 317, 5]
+
+    capacity = get_capacity_store().get_capacity(gsp_ids=gsp_ids)
+
+    assert (capacity == expected.loc[gsp_ids, "installedcapacity_mwp"].values).all()
+
+    # the same, with the t0s, as the capacity does not change over time
+    t0s = [datetime(2020, 1, 1)] * len(gsp_ids)
+    assert (get_capacity_store().get_capacity(gsp_ids=gsp_ids, t0s=t0s) == capacity).all()
+
+    with pytest.raises(KeyError):
+        get_capacity_store().get_capacity(gsp_ids=[1, 1000])
+
+
+def test_get_capacity_as_of():
+    store = CapacityStore(
+        capacity=pd.DataFrame(
+            {
+                "datetime_gmt": ["2022-01-01", "2022-01-01", "2022-07-01", "2022-07-01"],
+                "gsp_id": [1, 2, 1, 3],
+                "installedcapacity_mwp": [10, 20, 11, 30],
+            }
+        )
+    )
+
+    t0s = [
+        datetime(2021, 6, 1),
+        datetime(2022, 3, 1, tzinfo=timezone.utc),
+        datetime(2022, 7, 1),
+        datetime(2023, 1, 1),
+    ]
+    assert (store.get_capacity(gsp_ids=[1, 1, 1, 1], t0s=t0s) == [10, 10, 11, 11]).all()
+
+    # gsp 2 keeps its capacity, and gsp 3 has its first capacity before it was added
+    assert (store.get_capacity(gsp_ids=[2, 2, 3, 3], t0s=t0s) == [20, 20, 30, 30]).all()
+
+    # the latest capacity
+    assert (store.get_capacity(gsp_ids=[1, 2, 3]) == [11, 20, 30]).all()
+    assert store.get_capacity(gsp_ids=np.array([[1], [3]])).shape == (2, 1)
+
+
+def test_get_capacity_store_refresh():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "gsp_capacity.csv")
+        pd.DataFrame({"gsp_id": [1], "installedcapacity_mwp": [10]}).to_csv(filename, index=False)
+
+        store = get_capacity_store(filename=filename)
+        assert get_capacity_store(filename=filename) is store
+        assert store.get_capacity(gsp_ids=[1])[0] == 10
+
+        # the file has changed, so it is loaded again
+        pd.DataFrame({"gsp_id": [1], "installedcapacity_mwp": [12]}).to_csv(filename, index=False)
+        os.utime(filename, (0, 0))
+        assert get_capacity_store(filename=filename).get_capacity(gsp_ids=[1])[0] == 12
+
+        assert get_capacity_store(filename=filename, refresh=True) is not store
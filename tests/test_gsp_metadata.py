@@ -0,0 +1,76 @@
+import os
+import shutil
+import time
+
+import pandas as pd
+import pytest
+
+import nowcasting_forecast.gsp_metadata
+from nowcasting_forecast.gsp_metadata import get_gsp_metadata, refresh_gsp_metadata
+
+snapshot_file = os.path.join(os.path.dirname(__file__), "data", "gsp_metadata.csv")
+
+
+def eso_metadata():
+    return pd.DataFrame(
+        {
+            "gsp_id": [1, 2, 2],
+            "centroid_lat": [50.0, 51.0, 52.0],
+            "centroid_lon": [-1.0, -2.0, -3.0],
+            "region_name": ["a", "b", "c"],
+        }
+    )
+
+
+def offline():
+    raise ConnectionError("No internet")
+
+
+def test_get_gsp_metadata_from_snapshot(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "gsp_metadata.csv")
+    shutil.copy(snapshot_file, cache_file)
+    monkeypatch.setattr(nowcasting_forecast.gsp_metadata, "get_gsp_metadata_from_eso", offline)
+
+    metadata = get_gsp_metadata(cache_file=cache_file)
+
+    assert metadata.index.name == "gsp_id"
+    assert len(metadata) == 5
+    assert metadata.loc[1, "centroid_lat"] == 50.4843
+
+    # loaded once per process
+    assert get_gsp_metadata(cache_file=cache_file) is metadata
+
+
+def test_get_gsp_metadata_old_snapshot_offline(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "gsp_metadata.csv")
+    shutil.copy(snapshot_file, cache_file)
+    one_day_ago = time.time() - 24 * 60 * 60
+    os.utime(cache_file, (one_day_ago, one_day_ago))
+    monkeypatch.setattr(nowcasting_forecast.gsp_metadata, "get_gsp_metadata_from_eso", offline)
+
+    metadata = get_gsp_metadata(cache_file=cache_file, ttl_hours=1)
+
+    assert len(metadata) == 5
+
+
+def test_get_gsp_metadata_no_snapshot_offline(tmp_path, monkeypatch):
+    monkeypatch.setattr(nowcasting_forecast.gsp_metadata, "get_gsp_metadata_from_eso", offline)
+
+    with pytest.raises(ConnectionError):
+        get_gsp_metadata(cache_file=str(tmp_path / "gsp_metadata.csv"))
+
+
+def test_refresh_gsp_metadata(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "gsp_metadata.csv")
+    shutil.copy(snapshot_file, cache_file)
+    monkeypatch.setattr(nowcasting_forecast.gsp_metadata, "get_gsp_metadata_from_eso", eso_metadata)
+
+    metadata = refresh_gsp_metadata(cache_file=cache_file)
+
+    assert list(metadata.index) == [1, 2]
+    assert list(metadata.columns) == ["centroid_lat", "centroid_lon"]
+    assert metadata.loc[2, "centroid_lat"] == 51.0
+
+    # the snapshot has been updated
+    snapshot = pd.read_csv(cache_file, index_col="gsp_id")
+    pd.testing.assert_frame_equal(snapshot, metadata)
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+
+from nowcasting_forecast.profiling import profile_run, stage
+
+
+@stage("decorated")
+def add_one(x):
+    return x + 1
+
+
+def test_stage_profiling_off():
+    with stage("nothing"):
+        pass
+
+    assert add_one(1) == 2
+
+
+def test_profile_run():
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        report_filename = os.path.join(temporary_dir, "report.json")
+
+        with profile_run(report_filename=report_filename) as report:
+            with stage("first"):
+                pass
+            for _ in range(3):
+                add_one(1)
+
+        assert report.stages["first"]["count"] == 1
+        assert report.stages["decorated"]["count"] == 3
+
+        with open(report_filename) as file:
+            report_dict = json.load(file)
+
+        assert report_dict["total"]["wall_seconds"] > 0
+        assert report_dict["stages"]["first"]["wall_seconds"] >= 0
+        assert report_dict["stages"]["decorated"]["peak_rss_mb"] > 0
+        assert not os.path.exists(f"{report_filename}.prof")
+
+    # profiling is now off, so this is not added to the report
+    with stage("first"):
+        pass
+    assert report.stages["first"]["count"] == 1
+
+
+def test_profile_run_cprofile():
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        report_filename = os.path.join(temporary_dir, "report.json")
+
+        with profile_run(report_filename=report_filename, use_cprofile=True):
+            add_one(1)
+
+        assert os.path.exists(report_filename)
+        assert os.path.exists(f"{report_filename}.prof")
+
+
+def test_profile_run_off():
+    with profile_run() as report:
+        add_one(1)
+
+    assert report is None
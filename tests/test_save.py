@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+
+import pytest
+from nowcasting_datamodel.fake import make_fake_forecasts
+from nowcasting_datamodel.models import (
+    ForecastSQL,
+    ForecastValueLatestSQL,
+    ForecastValueSevenDaysSQL,
+    ForecastValueSQL,
+)
+
+from nowcasting_forecast.save import save_forecasts
+from nowcasting_forecast.utils import count_database_queries, floor_minutes_dt
+
+
+def make_forecasts(session):
+    # recent forecasts, so they are not removed from the latest and last seven days tables
+    t0_datetime_utc = floor_minutes_dt(datetime.now(timezone.utc))
+    return make_fake_forecasts(
+        gsp_ids=list(range(1, 11)), session=session, t0_datetime_utc=t0_datetime_utc
+    )
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_save_forecasts(db_session, bulk):
+    forecasts = make_forecasts(session=db_session)
+    n_values = sum(len(forecast.forecast_values) for forecast in forecasts)
+
+    save_forecasts(
+        forecasts=forecasts, session=db_session, apply_adjuster=False, bulk=bulk, chunk_size=100
+    )
+
+    assert db_session.query(ForecastSQL).filter(ForecastSQL.historic == False).count() == 10
+    assert db_session.query(ForecastSQL).filter(ForecastSQL.historic == True).count() == 10
+    assert db_session.query(ForecastValueSQL).count() == n_values
+    assert db_session.query(ForecastValueLatestSQL).count() == n_values
+    assert db_session.query(ForecastValueSevenDaysSQL).count() == n_values
+
+
+def test_save_forecasts_bulk_twice(db_session):
+    forecasts = make_forecasts(session=db_session)
+    n_values = sum(len(forecast.forecast_values) for forecast in forecasts)
+    save_forecasts(
+        forecasts=forecasts, session=db_session, apply_adjuster=False, bulk=True, chunk_size=100
+    )
+
+    forecasts = make_forecasts(session=db_session)
+    with count_database_queries(engine=db_session.get_bind()) as counter:
+        save_forecasts(forecasts=forecasts, session=db_session, apply_adjuster=False, bulk=True)
+
+    # historic forecasts are reused, and the latest values are updated, not added
+    assert db_session.query(ForecastSQL).filter(ForecastSQL.historic == False).count() == 20
+    assert db_session.query(ForecastSQL).filter(ForecastSQL.historic == True).count() == 10
+    assert db_session.query(ForecastValueSQL).count() == 2 * n_values
+    assert db_session.query(ForecastValueLatestSQL).count() == n_values
+    assert db_session.query(ForecastValueSevenDaysSQL).count() == 2 * n_values
+
+    # the number of queries does not depend on the number of forecasts
+    assert counter.n_queries < 20